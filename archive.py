@@ -0,0 +1,101 @@
+"""Processing of JAR and APK files without extracting them.
+
+Entries are read from the archive one at a time. When rewriting an archive,
+only the entries that were actually modified are compressed again, all other
+entries are copied over as raw (still compressed) bytes.
+"""
+import copy
+import re
+import struct
+import zipfile
+
+import dex
+import java
+
+__all__ = ['Archive']
+
+_class_entry = re.compile(r'.*\.class$')
+_dex_entry = re.compile(r'(.*/)?classes\d*\.dex$')
+
+# size of a local file header, excluding the filename and extra field
+_local_header = struct.Struct('<4s5H3L2H')
+
+class Archive:
+    def __init__(self, fname):
+        """Opens a JAR or APK file."""
+        self.zip = zipfile.ZipFile(fname)
+
+    def __iter__(self):
+        """Yields (name, object) for each .class and classes*.dex entry,
+        parsed into a ClassFile or a (lazy) DexFile respectively."""
+        for zinfo in self.zip.infolist():
+            obj = self._parse(zinfo)
+            if obj is not None:
+                yield zinfo.filename, obj
+
+    def _parse(self, zinfo):
+        if _class_entry.match(zinfo.filename):
+            return java.ClassFile(self.zip.read(zinfo))
+        if _dex_entry.match(zinfo.filename):
+            return dex.DexFile(self.zip.read(zinfo), lazy=True)
+
+    def rewrite(self, fname, callback):
+        """Writes a new archive to fname in a single pass.
+
+        callback(name, obj) is invoked for each .class and classes*.dex
+        entry and returns either the new contents of the entry or None to
+        keep the entry as-is. Unchanged entries, as well as all other
+        entries, are copied without decompressing them. Note that this
+        invalidates any APK or JAR signature.
+        """
+        out = zipfile.ZipFile(fname, 'w', allowZip64=True)
+        try:
+            for zinfo in self.zip.infolist():
+                obj = self._parse(zinfo)
+                data = callback(zinfo.filename, obj) if obj else None
+                if data is None:
+                    self._copy(zinfo, out)
+                else:
+                    info = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+                    info.compress_type = zinfo.compress_type
+                    info.external_attr = zinfo.external_attr
+                    out.writestr(info, data)
+        finally:
+            out.close()
+
+    def _copy(self, zinfo, out, chunksize=1024*1024):
+        # copies the local header, the compressed data and the data
+        # descriptor (if any) of an entry as-is
+        fp = self.zip.fp
+        fp.seek(zinfo.header_offset)
+        header = fp.read(_local_header.size)
+        name_length, extra_length = _local_header.unpack(header)[-2:]
+        length = _local_header.size + name_length + extra_length + \
+            zinfo.compress_size
+
+        if zinfo.flag_bits & 0x08:
+            zip64 = max(zinfo.file_size, zinfo.compress_size) >= \
+                zipfile.ZIP64_LIMIT
+            fp.seek(zinfo.header_offset + length)
+            length += 20 if zip64 else 12
+            if fp.read(4) == 'PK\x07\x08':
+                length += 4
+
+        info = copy.copy(zinfo)
+        info.header_offset = out.fp.tell()
+
+        fp.seek(zinfo.header_offset)
+        while length:
+            buf = fp.read(min(length, chunksize))
+            if not buf:
+                raise zipfile.BadZipfile('Truncated entry: %s' %
+                    zinfo.filename)
+            out.fp.write(buf)
+            length -= len(buf)
+
+        out.filelist.append(info)
+        out.NameToInfo[info.filename] = info
+        out._didModify = True
+
+    def close(self):
+        self.zip.close()
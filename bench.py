@@ -0,0 +1,429 @@
+"""Benchmarks of the parse, resolve, disassemble and rebuild phases.
+
+Inputs are synthetic .dex and .class files of a controlled size, generated
+by dex_file() and class_file(). Each phase is timed separately and reported
+in MB/s and items/s, results are appended to a JSONL file along with the
+git revision so regressions between revisions are visible.
+
+    python sbi.py bench [-s small|large] [-r repeat] [-o bench.jsonl]
+"""
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import time
+import timeit
+import zlib
+
+import cfg
+import dex
+import java
+import peephole
+
+__all__ = ['dex_file', 'class_file', 'run', 'SIZES']
+
+def _uleb128(value):
+    return dex._uleb128x(value)
+
+def dex_file(classes=4, methods=3, fields=2, strings=10, blocks=2,
+        tries=False):
+    """Generates a dex file with the given number of classes, methods and
+    fields per class and strings. Each method has blocks times a
+    const-string, sget and invoke-static followed by a branch, with tries
+    all of it is covered by a try of which the catch-all handler is the
+    final return-void."""
+    strs = set(['V', 'I', 'VI', 'Ljava/lang/Object;', 'Bench.java'])
+    strs.update('Lcom/bench/C%05d;' % x for x in xrange(classes))
+    strs.update('m%05d' % x for x in xrange(methods))
+    strs.update('f%05d' % x for x in xrange(fields))
+    strs.update('s%06d' % x for x in xrange(strings))
+    strs = sorted(strs)
+    string_idx = dict((x, idx) for idx, x in enumerate(strs))
+
+    types = sorted(['V', 'I', 'Ljava/lang/Object;'] +
+        ['Lcom/bench/C%05d;' % x for x in xrange(classes)])
+    type_idx = dict((x, idx) for idx, x in enumerate(types))
+
+    # ()V and (I)V, the type_list of the latter is filled in later on
+    protos = [[string_idx['V'], type_idx['V'], 0],
+        [string_idx['VI'], type_idx['V'], 0]]
+
+    field_ids, method_ids = [], []
+    for x in xrange(classes):
+        class_idx = type_idx['Lcom/bench/C%05d;' % x]
+        for y in xrange(fields):
+            field_ids.append((class_idx, type_idx['I'],
+                string_idx['f%05d' % y]))
+        for y in xrange(methods):
+            method_ids.append((class_idx, y % 2, string_idx['m%05d' % y]))
+
+    offset = 0x70
+    offsets = {}
+    for name, size, count in (('string_ids', 4, len(strs)),
+            ('type_ids', 4, len(types)), ('proto_ids', 12, len(protos)),
+            ('field_ids', 8, len(field_ids)),
+            ('method_ids', 8, len(method_ids)),
+            ('class_defs', 32, classes)):
+        offsets[name] = offset
+        offset += size * count
+    data_off = offset
+
+    data, end = [], [data_off]
+    def emit(buf, align=1):
+        offset = end[0] + (-end[0] % align)
+        data.append('\x00' * (offset - end[0]) + buf)
+        end[0] = offset + len(buf)
+        return offset
+
+    string_data = [emit(_uleb128(len(x)) + x + '\x00') for x in strs]
+    protos[1][2] = type_list = emit(struct.pack('<IH', 1, type_idx['I']), 4)
+
+    code_items = []
+    for x in xrange(classes * methods):
+        insns = []
+        for y in xrange(blocks):
+            insns += [0x001a, string_idx['s%06d' % ((x + y) % strings)]
+                if strings else 0]
+            if field_ids:
+                insns += [0x0060, (x + y) % len(field_ids)]
+            insns += [0x0071, (x + y) % len(method_ids), 0]
+        insns += [0x0038, 3, 0x0012, 0x000e]
+        buf = struct.pack('<4H2I', 1, 0, 1, int(tries), 0, len(insns)) + \
+            struct.pack('<%dH' % len(insns), *insns)
+        if tries:
+            # the try_item and the encoded_catch_handler_list of a single
+            # catch-all handler
+            buf += '\x00\x00' * (len(insns) % 2) + struct.pack('<IHH', 0,
+                len(insns), 1) + '\x01\x00' + _uleb128(len(insns) - 1)
+        code_items.append(emit(buf, 4))
+
+    class_data = []
+    for x in xrange(classes):
+        buf = _uleb128(fields) + _uleb128(0) + _uleb128(methods) + \
+            _uleb128(0)
+        for y in xrange(fields):
+            buf += _uleb128(1 if y else x * fields) + _uleb128(9)
+        for y in xrange(methods):
+            buf += _uleb128(1 if y else x * methods) + _uleb128(9) + \
+                _uleb128(code_items[x * methods + y])
+        class_data.append(emit(buf))
+
+    items = [(0x0000, 1, 0), (0x0001, len(strs), offsets['string_ids']),
+        (0x0002, len(types), offsets['type_ids']),
+        (0x0003, len(protos), offsets['proto_ids']),
+        (0x0004, len(field_ids), offsets['field_ids']),
+        (0x0005, len(method_ids), offsets['method_ids']),
+        (0x0006, classes, offsets['class_defs']),
+        (0x2002, len(strs), string_data[0]), (0x1001, 1, type_list)]
+    if code_items:
+        items.append((0x2001, len(code_items), code_items[0]))
+    if class_data:
+        items.append((0x2000, classes, class_data[0]))
+    map_off = end[0] + (-end[0] % 4)
+    items.append((0x1000, 1, map_off))
+    emit(struct.pack('<I', len(items)) + ''.join(struct.pack('<2H2I',
+        typ, 0, count, offset) for typ, count, offset in items), 4)
+    data = ''.join(data)
+
+    ids = [struct.pack('<I', x) for x in string_data]
+    ids += [struct.pack('<I', string_idx[x]) for x in types]
+    ids += [struct.pack('<3I', *x) for x in protos]
+    ids += [struct.pack('<2HI', *x) for x in field_ids]
+    ids += [struct.pack('<2HI', *x) for x in method_ids]
+    for x in xrange(classes):
+        ids.append(struct.pack('<8I', type_idx['Lcom/bench/C%05d;' % x], 1,
+            type_idx['Ljava/lang/Object;'], 0, string_idx['Bench.java'], 0,
+            class_data[x], 0))
+
+    size = data_off + len(data)
+    header = struct.pack('<20sII4s17I', '', size, 0x70, '\x78\x56\x34\x12',
+        0, 0, map_off, len(strs), offsets['string_ids'], len(types),
+        offsets['type_ids'], len(protos), offsets['proto_ids'],
+        len(field_ids), offsets['field_ids'], len(method_ids),
+        offsets['method_ids'], classes, offsets['class_defs'],
+        size - data_off, data_off)
+    buf = header + ''.join(ids) + data
+    buf = hashlib.sha1(buf[20:]).digest() + buf[20:]
+    return 'dex\n035\x00' + struct.pack('<I', zlib.adler32(buf) &
+        0xffffffff) + buf
+
+class _ConstantPool:
+    def __init__(self):
+        self.entries, self.index, self.count = [], {}, 1
+
+    def add(self, key, raw, slots=1):
+        if key not in self.index:
+            self.index[key] = self.count
+            self.entries.append(raw)
+            self.count += slots
+        return self.index[key]
+
+    def utf8(self, value):
+        return self.add(('Utf8', value),
+            struct.pack('>BH', 1, len(value)) + value)
+
+    def class_(self, name):
+        return self.add(('Class', name),
+            struct.pack('>BH', 7, self.utf8(name)))
+
+    def string(self, value):
+        return self.add(('String', value),
+            struct.pack('>BH', 8, self.utf8(value)))
+
+    def integer(self, value):
+        return self.add(('Integer', value), struct.pack('>Bi', 3, value))
+
+    def long(self, value):
+        return self.add(('Long', value), struct.pack('>Bq', 5, value), 2)
+
+    def double(self, value):
+        return self.add(('Double', value), struct.pack('>Bd', 6, value), 2)
+
+    def methodref(self, class_, name, descriptor):
+        name_and_type = self.add(('NameAndType', name, descriptor),
+            struct.pack('>BHH', 12, self.utf8(name), self.utf8(descriptor)))
+        return self.add(('Methodref', class_, name, descriptor),
+            struct.pack('>BHH', 10, self.class_(class_), name_and_type))
+
+def class_file(methods=10, strings=20, longs=10, blocks=2, name='Bench'):
+    """Generates a class file with the given number of methods, String
+    constants and Long, Double (and Integer) constants. Each method has
+    blocks times an ldc, ldc2_w and invokestatic, a branch and an
+    exception handler."""
+    pool = _ConstantPool()
+    this, super_ = pool.class_(name), pool.class_('java/lang/Object')
+    code_attribute = pool.utf8('Code')
+
+    constants = [pool.string('s%06d' % x) for x in xrange(strings)]
+    wide = []
+    for x in xrange(longs):
+        wide.append(pool.long(x * 1000003))
+        wide.append(pool.double(x + 0.5))
+        pool.integer(x * 7)
+    refs = [pool.methodref(name, 'm%05d' % x, '(I)V')
+        for x in xrange(methods)]
+
+    method_info = []
+    for x in xrange(methods):
+        # iconst_0, ifeq +6, goto +3
+        code = '\x03\x99\x00\x06\xa7\x00\x03'
+        for y in xrange(blocks):
+            idx = x * blocks + y
+            if constants:
+                # ldc_w, pop
+                code += struct.pack('>BHB', 0x13,
+                    constants[idx % len(constants)], 0x57)
+            if wide:
+                # ldc2_w, pop2
+                code += struct.pack('>BHB', 0x14, wide[idx % len(wide)],
+                    0x58)
+            # invokestatic
+            code += struct.pack('>BH', 0xb8, refs[idx % len(refs)])
+        # return
+        code += '\xb1'
+
+        attribute = struct.pack('>HHI', 4, 2, len(code)) + code + \
+            struct.pack('>5H', 1, 7, len(code) - 1, len(code) - 1, 0) + \
+            struct.pack('>H', 0)
+        method_info.append(struct.pack('>4H', 9, pool.utf8('m%05d' % x),
+            pool.utf8('(I)V'), 1) + struct.pack('>HI', code_attribute,
+            len(attribute)) + attribute)
+
+    source_file = pool.utf8('SourceFile'), pool.utf8(name + '.java')
+    return '\xca\xfe\xba\xbe' + struct.pack('>3H', 0, 50, pool.count) + \
+        ''.join(pool.entries) + struct.pack('>5H', 0x21, this, super_, 0,
+        0) + struct.pack('>H', methods) + ''.join(method_info) + \
+        struct.pack('>HHIH', 1, source_file[0], 2, source_file[1])
+
+# the arguments to dex_file() and class_file() for each size
+SIZES = {
+    'small': ((200, 10, 4, 2000, 2), (200, 200, 50, 2)),
+    'large': ((2000, 20, 8, 20000, 3), (3000, 2000, 500, 3)),
+}
+
+def _best(fn, repeat, setup=None):
+    # returns the fastest of repeat runs of fn and its (last) result, setup
+    # (if any) is run before each run and its result is passed on to fn
+    best = None
+    for _ in xrange(repeat):
+        args = (setup(),) if setup else ()
+        start = timeit.default_timer()
+        ret = fn(*args)
+        duration = timeit.default_timer() - start
+        if best is None or duration < best:
+            best = duration
+    return best, ret
+
+def _bench_dex(data, repeat):
+    parse, root = _best(lambda: dex._DexFile.parse(data), repeat)
+    header = root.header
+
+    # the id sections, which are decoded and resolved upfront even in lazy
+    # mode (the class definitions are parsed by the construct phase)
+    resolve, d = _best(lambda: dex.DexFile(data, lazy=True), repeat)
+    ids = header.string_ids_size + header.type_ids_size + \
+        header.proto_ids_size + header.field_ids_size + header.method_ids_size
+
+    def xrefs():
+        d._xrefs = None
+        return d.xrefs()
+    xrefs, _ = _best(xrefs, repeat)
+
+    offsets = sorted(set(x for _, x in d._code_items()))
+    code_units = sum(len(d._insns(x)) for x in offsets)
+
+    disasm, code = _best(lambda d: [list(x.instructions)
+        for _, x in d._code_item_list()], repeat, lambda: dex.DexFile(data))
+    instructions = sum(len(x) for x in code)
+    reencode, _ = _best(lambda: [dex.assemble(x) for x in code], repeat)
+    graphs, _ = _best(lambda: [cfg.dex_cfg(d._insns(x), cfg.dex_tries(data,
+        x)) for x in offsets], repeat)
+
+    # every code item grows, so the data section has to be laid out again
+    def grown():
+        d = dex.DexFile(data)
+        for _, x in d._code_item_list():
+            x.insns.append(0)
+        return d
+    rebuild, _ = _best(lambda d: d.build0(), repeat, grown)
+
+    buf = ''.join(dex._uleb128x(x * 37) for x in xrange(100000))
+    leb128, _ = _best(lambda: dex.uleb128_array(buf, 0, 100000), repeat)
+
+    return [
+        ('dex.parse', parse, len(data), header.class_defs_size),
+        ('dex.resolve', resolve, len(data), ids),
+        ('dex.xrefs', xrefs, len(data), code_units),
+        ('dex.disassemble', disasm, len(data), instructions),
+        ('dex.reencode', reencode, len(data), instructions),
+        ('dex.cfg', graphs, len(data), len(offsets)),
+        ('dex.rebuild', rebuild, len(data), len(offsets)),
+        ('dex.leb128', leb128, len(buf), 100000),
+    ]
+
+def _code_attributes(c):
+    for x in c.root.MethodInfo:
+        for y in x.AttributeInfo:
+            if y.attribute_name.value == 'Code':
+                yield y
+
+def _reparsed(data):
+    # a ClassFile of which the structures are parsed but not resolved yet
+    c = java.ClassFile(data)
+    c.root = java.ClassFile.parse(data)
+    return c
+
+def _modified(data):
+    # a ClassFile of which the code of every method has to be re-encoded
+    c = java.ClassFile(data)
+    for y in _code_attributes(c):
+        y.instructions.append(y.instructions[-1])
+    return c
+
+# removes the constants the synthetic class files load and discard
+_rules = peephole.Peephole([
+    peephole.Rule([peephole.Ins(('ldc', 'ldc_w'), cp=lambda x:
+        x.tag == 'CONSTANT_String'), peephole.Ins('pop')], []),
+    peephole.Rule([peephole.Ins('ldc2_w'), peephole.Ins('pop2')], []),
+])
+
+def _disassembled(data):
+    # a ClassFile of which the code of every method is disassembled
+    c = java.ClassFile(data)
+    for y in _code_attributes(c):
+        list(y.instructions)
+    return c
+
+def _relabeled(data):
+    # a ClassFile with Labels of which the rules removed instructions, i.e.,
+    # its branches and exception tables have to be resolved again
+    c = java.ClassFile(data)
+    for y in _code_attributes(c):
+        y.instructions, y.exception_table = java.label(y.instructions,
+            y.exception_table)
+    _rules.apply_class(c)
+    return c
+
+def _bench_class(data, repeat):
+    parse, root = _best(lambda: java.ClassFile.parse(data), repeat)
+    resolve, _ = _best(lambda c: c._resolve(), repeat,
+        lambda: _reparsed(data))
+    c = java.ClassFile(data)
+    disasm, instructions = _best(lambda c: sum(len(y.instructions)
+        for y in _code_attributes(c)), repeat, lambda: java.ClassFile(data))
+
+    rebuild, buf = _best(c.build0, repeat)
+    assert buf == data, 'rebuilding the class file changed it'
+    reencode, _ = _best(lambda c: c.build0(), repeat,
+        lambda: _modified(data))
+    rewrite, _ = _best(_rules.apply_class, repeat,
+        lambda: _disassembled(data))
+    assemble, _ = _best(lambda c: c.build0(), repeat,
+        lambda: _relabeled(data))
+    graphs, _ = _best(lambda c: [cfg.java_cfg(y.instructions,
+        y.exception_table) for y in _code_attributes(c)], repeat,
+        lambda: _disassembled(data))
+
+    methods = len(root.MethodInfo)
+    return [
+        ('class.parse', parse, len(data), len(root.ConstantPoolInfo)),
+        ('class.resolve', resolve, len(data), methods),
+        ('class.disassemble', disasm, len(data), instructions),
+        ('class.rebuild', rebuild, len(data), methods),
+        ('class.reencode', reencode, len(data), methods),
+        ('class.peephole', rewrite, len(data), instructions),
+        ('class.assemble', assemble, len(data), methods),
+        ('class.cfg', graphs, len(data), methods),
+    ]
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+            'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(size='small', repeat=3):
+    """Runs all benchmarks, returns a dict of phase to (seconds, MB/s,
+    items/s)."""
+    dex_args, class_args = SIZES[size]
+    ret = {}
+    for name, duration, length, items in \
+            _bench_dex(dex_file(*dex_args), repeat) + \
+            _bench_class(class_file(*class_args), repeat):
+        duration = max(duration, 1e-9)
+        ret[name] = (round(duration, 6), round(length / duration / 1e6, 3),
+            round(items / duration, 1))
+    return ret
+
+def _previous(fname, size):
+    # the most recent results for the same size, if any
+    ret = None
+    if os.path.exists(fname):
+        for line in open(fname):
+            record = json.loads(line)
+            if record['size'] == size:
+                ret = record
+    return ret
+
+def report(results, out, size='small', repeat=3, fname='bench.jsonl'):
+    """Writes the results to out, compared against the previous results in
+    fname, and appends them to fname."""
+    previous = _previous(fname, size) if fname else None
+    out.write('%-20s %10s %10s %14s %s\n' % ('phase', 'seconds', 'MB/s',
+        'items/s', '(vs %s)' % previous['revision'] if previous else ''))
+    for name in sorted(results):
+        seconds, mbs, items = results[name]
+        line = '%-20s %10.4f %10.2f %14.1f' % (name, seconds, mbs, items)
+        if previous and previous['results'].get(name, [0])[0]:
+            before = previous['results'][name][0]
+            line += ' %+6.1f%%' % ((seconds - before) / before * 100)
+        out.write(line + '\n')
+
+    if fname:
+        with open(fname, 'a') as f:
+            f.write(json.dumps({'revision': _revision(),
+                'time': int(time.time()), 'size': size, 'repeat': repeat,
+                'results': results}, sort_keys=True) + '\n')
@@ -0,0 +1,182 @@
+"""Content-addressed, on-disk cache of parsed ClassFile and DexFile objects.
+
+Identical inputs (e.g., the same support library bundled with thousands of
+samples) are only parsed once, later on they're loaded from the cache, which
+is keyed by the SHA-1 of the file contents.
+
+Only the parsed structures of a file are stored (see ClassFile.parse() and
+DexFile.parse()), as marshalled tuples rather than pickles, i.e., loading
+an entry never runs any code. They're resolved again on every load, which
+is cheap compared to parsing. Entries which can't be loaded, e.g., written
+by another version, are parsed again.
+"""
+from array import array
+import hashlib
+import marshal
+import os
+import struct
+import tempfile
+
+from construct import Container, FlagsContainer, ListContainer, \
+    LazyContainer
+
+import dex
+import java
+
+__all__ = ['ParseCache']
+
+# bumped whenever the layout of the cached structures changes
+VERSION = 5
+
+_header = struct.Struct('<4sI')
+_MAGIC = 'SBIC'
+
+_containers = Container, FlagsContainer
+
+def _dump(root):
+    # the structures as nested tuples, ('c', class, keys, values) for a
+    # Container (its keys being an index into a table of unique key lists),
+    # ('l', values) for a ListContainer, ('a', typecode, string) for an
+    # array, ('p', entries, offsets) for a ConstantPool and plain values
+    # for everything else, construct's LazyContainers (the data section of
+    # a DexFile) are read again from the file itself
+    keys, table = {}, []
+    def dump(x):
+        if x.__class__ in _containers:
+            order = tuple(x.__keys_order__)
+            if order not in keys:
+                keys[order] = len(table)
+                table.append(order)
+            return ('c', _containers.index(x.__class__), keys[order],
+                [dump(x[y]) for y in order])
+        if isinstance(x, ListContainer):
+            return 'l', map(dump, x)
+        if isinstance(x, array):
+            return 'a', x.typecode, x.tostring()
+        if isinstance(x, java.ConstantPool):
+            return 'p', map(dump, x.entries), x._offsets
+        if isinstance(x, LazyContainer):
+            return None
+        if isinstance(x, (tuple, list, dict)):
+            raise TypeError('Unexpected %s in the parsed structures' %
+                x.__class__.__name__)
+        return x
+    return table, dump(root)
+
+def _load(values):
+    table, root = values
+    def load(x):
+        if x.__class__ is not tuple:
+            return x
+        if x[0] == 'c':
+            ret = _containers[x[1]]()
+            order = list(table[x[2]])
+            dict.update(ret, zip(order, map(load, x[3])))
+            object.__setattr__(ret, '__keys_order__', order)
+            return ret
+        if x[0] == 'l':
+            return ListContainer(map(load, x[1]))
+        if x[0] == 'a':
+            return array(x[1], x[2])
+        if x[0] == 'p':
+            ret = java.ConstantPool()
+            for y, offset in zip(x[1], x[2]):
+                ret.append(load(y), tuple(offset))
+            return ret
+        raise ValueError('Unknown cached structure: %r' % (x[0],))
+    return load(root)
+
+class ParseCache:
+    def __init__(self, path, max_size=1024*1024*1024):
+        """Opens (or creates) a cache directory which is kept at roughly
+        max_size bytes by evicting the least recently used entries."""
+        self.path, self.max_size = path, max_size
+        self._size = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def classfile(self, data):
+        """Returns a ClassFile for data, parsed or from the cache."""
+        return java.ClassFile(data, self._get('class', data,
+            java.ClassFile.parse))
+
+    def dexfile(self, data):
+        """Returns a (non-lazy) DexFile for data, parsed or from the
+        cache."""
+        return dex.DexFile(data, root=self._get('dex', data,
+            dex.DexFile.parse))
+
+    def _fname(self, kind, data):
+        key = hashlib.sha1(data).hexdigest()
+        return os.path.join(self.path, key[:2], '%s-%s' % (kind, key))
+
+    def _get(self, kind, data, parse):
+        fname = self._fname(kind, data)
+        try:
+            with open(fname, 'rb') as f:
+                ret = self._read(f.read())
+            # the modification time serves as the last access time
+            os.utime(fname, None)
+            return ret
+        except Exception:
+            # missing, stale or corrupt, any of which is a cache miss
+            pass
+
+        ret = parse(data)
+        self._store(fname, ret)
+        return ret
+
+    def _read(self, buf):
+        magic, version = _header.unpack_from(buf)
+        if magic != _MAGIC or version != VERSION:
+            raise ValueError('not a cache entry of this version')
+        return _load(marshal.loads(buf[_header.size:]))
+
+    def _store(self, fname, root):
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+
+        # write to a temporary file first, so concurrent readers (e.g.,
+        # other batch workers) never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_header.pack(_MAGIC, VERSION))
+            marshal.dump(_dump(root), f, 2)
+        os.rename(tmp, fname)
+
+        if self._size is None:
+            self._size = sum(size for _, _, size in self._entries())
+        else:
+            self._size += os.path.getsize(fname)
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        # yields (mtime, fname, size) for each entry in the cache
+        for root, _, files in os.walk(self.path):
+            for fname in files:
+                fname = os.path.join(root, fname)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                yield st.st_mtime, fname, st.st_size
+
+    def evict(self):
+        """Evicts the least recently used entries until the cache fits in
+        max_size bytes."""
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+        for _, fname, size in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.unlink(fname)
+            except OSError:
+                pass
+            self._size -= size
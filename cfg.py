@@ -0,0 +1,435 @@
+"""Control-flow graphs of the methods of ClassFiles and DexFiles.
+
+A CFG splits the instructions of a method into basic blocks and connects
+them by their normal successors (fall-through, branches and switches) and
+their exceptional successors (the handlers of the tries covering them). All
+of it is held in a few integer arrays, indexed by block number, e.g.,
+
+    g = cfg.method_cfg(classfile, classfile.root.MethodInfo[0])
+    for block in g.order():
+        print g.offsets[block], g.successors(block), g.handlers(block)
+
+Block 0 is the entry of the method. Blocks are split at try boundaries and
+handlers only, i.e., an exception edge means any instruction in the block
+may throw, not necessarily its last one.
+
+method_cfg() builds the graph of a method on first use and keeps it as long
+as the method doesn't change, so analyses can be chained without building
+it again. java_cfg() and dex_cfg() build one from scratch.
+"""
+from array import array
+import bisect
+import struct
+import weakref
+
+import dex
+import java
+import timing
+
+__all__ = ['CFG', 'java_cfg', 'dex_cfg', 'dex_tries', 'method_cfg',
+    'invalidate']
+
+def _csr(lists):
+    # a list of lists as the start of each list (plus the end of the last
+    # one) into a flat array of all of them
+    starts, flat = array('I', [0]), array('I')
+    for x in lists:
+        flat.extend(x)
+        starts.append(len(flat))
+    return starts, flat
+
+def _unique(values):
+    ret, seen = [], set()
+    for x in values:
+        if x not in seen:
+            seen.add(x)
+            ret.append(x)
+    return ret
+
+class CFG(object):
+    """The basic blocks of a method and the edges between them.
+
+    Block b holds the instructions starts[b] up to starts[b+1], by their
+    index in the instructions the graph was built from, and starts at
+    offsets[b] (bytes for Java methods, code units for dex methods). Both
+    arrays end with the total number of instructions and the code size.
+    """
+    __slots__ = ('starts', 'offsets', '_succ_start', '_succ', '_exc_start',
+        '_exc', '_pred_start', '_pred', '_order', '_idom')
+
+    def __init__(self, starts, offsets, successors, handlers):
+        self.starts, self.offsets = starts, offsets
+        self._succ_start, self._succ = _csr(successors)
+        self._exc_start, self._exc = _csr(handlers)
+        self._pred_start = self._pred = self._order = self._idom = None
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __repr__(self):
+        return '<cfg, %d blocks, %d edges>' % (len(self),
+            len(self._succ) + len(self._exc))
+
+    def successors(self, block):
+        """The blocks control flows to from the end of block."""
+        return self._succ[self._succ_start[block]:
+            self._succ_start[block+1]]
+
+    def handlers(self, block):
+        """The exception handlers of block."""
+        return self._exc[self._exc_start[block]:self._exc_start[block+1]]
+
+    def predecessors(self, block):
+        """The blocks of which block is a successor or handler."""
+        if self._pred_start is None:
+            preds = [[] for _ in xrange(len(self))]
+            for x in xrange(len(self)):
+                for y in _unique(self.successors(x) + self.handlers(x)):
+                    preds[y].append(x)
+            self._pred_start, self._pred = _csr(preds)
+        return self._pred[self._pred_start[block]:
+            self._pred_start[block+1]]
+
+    def block_at(self, offset):
+        """The block containing the instruction at offset."""
+        if not 0 <= offset < self.offsets[-1]:
+            raise IndexError('offset out of range: %d' % offset)
+        return bisect.bisect_right(self.offsets, offset, 0, len(self)) - 1
+
+    def order(self):
+        """The blocks reachable from the entry in reverse postorder."""
+        if self._order is not None:
+            return self._order
+
+        # an iterative depth-first search, an entry of the stack being a
+        # block and an iterator over its successors yet to visit
+        following = lambda x: iter(self.successors(x) + self.handlers(x))
+        postorder, seen = array('I'), set([0])
+        stack = [(0, following(0))] if len(self) else []
+        while stack:
+            block, successors = stack[-1]
+            for x in successors:
+                if x not in seen:
+                    seen.add(x)
+                    stack.append((x, following(x)))
+                    break
+            else:
+                stack.pop()
+                postorder.append(block)
+
+        postorder.reverse()
+        self._order = postorder
+        return postorder
+
+    def dominators(self):
+        """The immediate dominator of each block, the entry being its own
+        and -1 for the blocks which are unreachable.
+
+        Cooper, Harvey and Kennedy's iterative algorithm, over both the
+        normal and the exceptional edges.
+        """
+        if self._idom is not None:
+            return self._idom
+
+        order = self.order()
+        index = dict((x, idx) for idx, x in enumerate(order))
+        idom = array('i', [-1] * len(self))
+        if order:
+            idom[0] = 0
+
+        changed = True
+        while changed:
+            changed = False
+            for block in order[1:]:
+                new = -1
+                for x in self.predecessors(block):
+                    if idom[x] < 0:
+                        continue
+                    if new < 0:
+                        new = x
+                        continue
+                    # the nearest common dominator of x and new
+                    while x != new:
+                        while index[x] > index[new]:
+                            x = idom[x]
+                        while index[new] > index[x]:
+                            new = idom[new]
+                if idom[block] != new:
+                    idom[block] = new
+                    changed = True
+
+        self._idom = idom
+        return idom
+
+    def dominates(self, a, b):
+        """Whether block a dominates block b."""
+        idom = self.dominators()
+        if idom[b] < 0:
+            return False
+        while b != a and b != 0:
+            b = idom[b]
+        return b == a
+
+def _build(offsets, flow, tries):
+    """Builds a CFG of instructions at offsets (plus the end of the code),
+    flow being {index: (targets, falls through)} of the instructions which
+    don't just fall through and tries a list of (start, end, handlers), by
+    instruction index."""
+    with timing.span('cfg.build'):
+        count = len(offsets) - 1
+        leaders = set([0])
+        for idx, (targets, _) in flow.iteritems():
+            leaders.add(idx + 1)
+            leaders.update(targets)
+        for start, end, handlers in tries:
+            leaders.add(start)
+            leaders.add(end)
+            leaders.update(handlers)
+        starts = sorted(x for x in leaders if 0 <= x < count)
+        block = dict(zip(starts, xrange(len(starts))))
+        starts.append(count)
+
+        successors = []
+        for idx in xrange(len(starts) - 1):
+            last = starts[idx+1] - 1
+            targets, falls = flow.get(last, ((), True))
+            ret = [block[x] for x in targets]
+            if falls and last + 1 < count:
+                ret.insert(0, idx + 1)
+            successors.append(_unique(ret))
+
+        handlers = [[] for _ in xrange(len(starts) - 1)]
+        for start, end, targets in tries:
+            if start >= end or start not in block:
+                continue
+            targets = _unique(block[x] for x in targets)
+            idx = block[start]
+            while starts[idx] < end:
+                handlers[idx] += [x for x in targets
+                    if x not in handlers[idx]]
+                idx += 1
+
+        ret = CFG(array('I', starts), array('I', [offsets[x]
+            for x in starts]), successors, handlers)
+    timing.count('cfg.blocks', len(ret))
+    return ret
+
+# opcodes of the Java instructions which don't just fall through: returns,
+# athrow and ret (jsr is assumed to return to the next instruction)
+_java_exits = frozenset(range(0xac, 0xb2) + [0xbf, 0xa9])
+
+def java_cfg(instructions, exception_table=()):
+    """Builds the CFG of the instructions of a Java method and its
+    exception table, either as disassembled or with Labels (of which the
+    offsets are those before widening any branches, see
+    java.assemble())."""
+    instructions = list(instructions)
+
+    # the offset of each instruction, the first instruction (or Label) at
+    # each offset and the index of each Label
+    offsets, at, labels, offset = [], {}, {}, 0
+    for idx, x in enumerate(instructions):
+        offsets.append(offset)
+        at.setdefault(offset, idx)
+        if x.__class__ is java.Label:
+            labels[x] = idx
+        elif x.__class__ is java.Switch:
+            offset += java._switch_size(x, offset)
+            continue
+        offset += len(x.code)
+    offsets.append(offset)
+    at.setdefault(offset, len(instructions))
+
+    def target(x, origin):
+        if x.__class__ is java.Label:
+            return labels[x]
+        return at[origin + x]
+
+    try:
+        return _java_cfg(instructions, exception_table, offsets, at, labels,
+            target)
+    except KeyError as e:
+        x = e.args[0]
+        raise Exception('Branch to %s' % ('a Label not part of the '
+            'instructions' if x.__class__ is java.Label else
+            'the middle of an instruction: %d' % x))
+
+def _java_cfg(instructions, exception_table, offsets, at, labels, target):
+    flow = {}
+    for idx, x in enumerate(instructions):
+        cls = x.__class__
+        if cls is java.Label:
+            continue
+        op = ord(x.code[0])
+        if cls is java.Branch:
+            targets = [labels[x.target]]
+        elif cls is java.Switch:
+            targets = [labels[x.default]] + [labels[y] if y.__class__ is
+                java.Label else labels[y[1]] for y in x.targets]
+        elif op in java._branches:
+            targets = [at[offsets[idx] + struct.unpack('>h', x.code[1:3])[0]]]
+        elif op in java._long_branches:
+            targets = [at[offsets[idx] + struct.unpack('>i', x.code[1:5])[0]]]
+        elif op == java._TABLESWITCH or op == java._LOOKUPSWITCH:
+            y = java._label_switch(op, x.code, offsets[idx], lambda y: y)
+            targets = [at[y.default]] + [at[z] if isinstance(z, int) else
+                at[z[1]] for z in y.targets]
+        elif op in _java_exits or op == 0xc4 and x.code[1] == '\xa9':
+            flow[idx] = (), False
+            continue
+        else:
+            continue
+        flow[idx] = targets, op not in (java._GOTO, java._GOTO_W,
+            java._TABLESWITCH, java._LOOKUPSWITCH)
+
+    tries = [[target(y[z], 0) for z in java._pcs] for y in exception_table]
+    return _build(offsets, flow, [(start, end, [handler])
+        for start, end, handler in tries])
+
+# opcodes of the Dalvik returns and throw, the gotos, the if-* and the
+# switches (all of which fall through when no case matches)
+_dex_exits = frozenset(range(0x0e, 0x12) + [0x27])
+_dex_gotos = {0x28: '10t', 0x29: '20t', 0x2a: '30t'}
+_dex_ifs = frozenset(range(0x32, 0x3e))
+_dex_switches = 0x2b, 0x2c
+
+def dex_tries(data, code_off):
+    """Decodes the tries of the code item at code_off as (start_addr,
+    end_addr, [handler addrs])."""
+    tries_size, = struct.unpack_from('<H', data, code_off + 6)
+    if not tries_size:
+        return []
+    size, = struct.unpack_from('<I', data, code_off + 12)
+    offset = code_off + 16 + size * 2 + size % 2 * 2
+    handlers = offset + tries_size * 8
+
+    ret = []
+    for _ in xrange(tries_size):
+        start, count, handler_off = struct.unpack_from('<IHH', data, offset)
+        offset += 8
+        # an encoded_catch_handler: type_idx and addr pairs followed by a
+        # catch-all addr if the size is not positive
+        pairs, end = dex._leb128_at(data, handlers + handler_off,
+            dex._sleb128)
+        addrs = []
+        for idx in xrange(abs(pairs) * 2 + (pairs <= 0)):
+            value, end = dex._leb128_at(data, end)
+            if idx % 2 or idx == abs(pairs) * 2:
+                addrs.append(value)
+        ret.append((start, start + count, addrs))
+    return ret
+
+def dex_cfg(insns, tries=()):
+    """Builds the CFG of the code units of a dex method and its tries (see
+    dex_tries()). Payloads are blocks of their own without successors."""
+    offsets, flow, pc, count = [], {}, 0, len(insns)
+    while pc < count:
+        idx = len(offsets)
+        offsets.append(pc)
+        op = insns[pc] & 0xff
+        if not op and insns[pc] > 0xff:
+            flow[idx] = (), False
+            pc += dex._payload_length(insns, pc)
+            continue
+
+        if op in _dex_gotos:
+            delta, = dex._formats[_dex_gotos[op]][0](insns, pc)
+            flow[idx] = [pc + delta], False
+        elif op in _dex_ifs:
+            flow[idx] = [pc + dex._s16(insns[pc+1])], True
+        elif op in _dex_switches:
+            payload = pc + dex._s32(insns[pc+1] | insns[pc+2] << 16)
+            size = insns[payload+1]
+            # packed: ident, size, first_key, targets, sparse: ident, size,
+            # keys, targets
+            first = payload + (4 if op == 0x2b else 2 + size * 2)
+            flow[idx] = [pc + dex._s32(insns[first+x*2] |
+                insns[first+x*2+1] << 16) for x in xrange(size)], True
+        elif op in _dex_exits:
+            flow[idx] = (), False
+        pc += dex._insn_info[op][0]
+    offsets.append(pc)
+
+    # from code units to instruction indices
+    def at(pc):
+        idx = bisect.bisect_left(offsets, pc)
+        if idx == len(offsets) or offsets[idx] != pc:
+            raise Exception('Branch to the middle of an instruction: %d' %
+                pc)
+        return idx
+
+    flow = dict((idx, (map(at, targets), falls))
+        for idx, (targets, falls) in flow.iteritems())
+    tries = [(at(start), at(end), map(at, handlers))
+        for start, end, handlers in tries]
+    return _build(offsets, flow, tries)
+
+# file -> {method key: (the method's instructions and their version when
+# its CFG was built, ..., CFG)}
+_cfgs = weakref.WeakKeyDictionary()
+
+def method_cfg(obj, method):
+    """Returns the CFG of a method of a ClassFile (a MethodInfo) or of a
+    DexFile (an encoded_method), or None if it has no code.
+
+    The graph is kept until the method changes, i.e., until its
+    instructions are replaced or altered through their Instructions (see
+    Instructions.version), or its exception table changes. Instructions
+    which are modified in place, or lists of instructions which are altered
+    rather than replaced, require invalidate().
+
+    Dex code items which have tries can't change in size, as their tries
+    (and handlers) aren't updated.
+    """
+    cfgs = _cfgs.setdefault(obj, {})
+    if isinstance(obj, java.ClassFile):
+        for y in method.AttributeInfo:
+            if y.attribute_name.value == 'Code':
+                break
+        else:
+            return None
+        instructions = y.instructions
+        version = getattr(instructions, 'version', None)
+        table = [tuple(x[z] for z in java._pcs + ('catch_type',))
+            for x in y.exception_table]
+        entry = cfgs.get(id(method))
+        if entry is None or entry[0] is not method or \
+                entry[1] is not instructions or entry[2] != version or \
+                entry[3] != table:
+            entry = cfgs[id(method)] = method, instructions, version, \
+                table, java_cfg(instructions, y.exception_table)
+        return entry[4]
+
+    if not method.code_off:
+        return None
+    # without a code item the raw instructions are used, which don't change
+    x = dict.get(method, 'code_item')
+    instructions = x.instructions if x is not None else None
+    version = getattr(instructions, 'version', None)
+    entry = cfgs.get(method.code_off)
+    if entry is None or entry[0] is not instructions or \
+            entry[1] != version:
+        if x is not None and x.instructions.loaded:
+            insns = dex.assemble(x.instructions)
+        elif x is not None:
+            insns = x.insns
+        else:
+            insns = obj._insns(method.code_off)
+        # the tries are those of the file, they only hold for the code as
+        # long as it keeps its length
+        tries = dex_tries(obj.data, method.code_off)
+        if tries and len(insns) != len(obj._insns(method.code_off)):
+            raise Exception('The tries of a resized code item are not '
+                'updated, its CFG would be wrong')
+        entry = cfgs[method.code_off] = instructions, version, \
+            dex_cfg(insns, tries)
+    return entry[2]
+
+def invalidate(obj, method=None):
+    """Drops the CFG of a method of obj, or of all of its methods."""
+    if method is None:
+        _cfgs.pop(obj, None)
+    elif isinstance(obj, java.ClassFile):
+        _cfgs.get(obj, {}).pop(id(method), None)
+    else:
+        _cfgs.get(obj, {}).pop(method.code_off, None)
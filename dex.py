@@ -1,60 +1,117 @@
 from construct import *
-from pyasm2 import dalvik
-
-def _uleb128(data):
+from construct.lib.py3compat import BytesIO
+from array import array
+from collections import OrderedDict
+import bisect
+import hashlib
+import mmap
+import re
+import struct
+import sys
+import zlib
+
+from instructions import Instructions
+from java import Descriptor
+import timing
+
+def _leb128(data, offset=0):
     value = 0
-    for x in xrange(5):
-        value += (data[x] & 127) << (7 * x)
-        if not data[x] & 128:
-            break
-    if x == 4 and data[x] & 128 or value >= 2**32:
+    try:
+        for x in xrange(5):
+            value |= (data[offset+x] & 127) << (7 * x)
+            if not data[offset+x] & 128:
+                return x + 1, value
+    except IndexError:
+        raise FieldError('Truncated leb128 encoding')
+    raise Exception('Invalid leb128 encoding')
+
+def _uleb128(data, offset=0):
+    if data[offset] < 128:
+        return 1, data[offset]
+    length, value = _leb128(data, offset)
+    if value >= 2**32:
         raise Exception('Invalid uleb128 encoding')
-    return x + 1, value
+    return length, value
 
 def _uleb128x(value):
     data = ''
-    while value:
-        data += chr(128 + (value & 127))
-        value /= 128
-    return data[:-1] + chr(128 ^ ord(data[-1]))
+    while value >= 128:
+        data += chr(128 | value & 127)
+        value >>= 7
+    return data + chr(value)
 
-def _uleb128p1(data):
-    length, value = _uleb128(data)
+def _uleb128p1(data, offset=0):
+    length, value = _uleb128(data, offset)
     return length, value - 1
 
 def _uleb128p1x(value):
-    return _uleb128(value + 1)
+    return _uleb128x(value + 1)
 
-def _sleb128(data):
-    length, value = _uleb128(data)
+def _sleb128(data, offset=0):
+    length, value = _leb128(data, offset)
     if value & (2 ** (7 * length - 1)):
         value -= 2 ** (7 * length)
     return length, value
 
 def _sleb128x(value):
-    return _uleb128x(value if value >= 0 else 2**32 - value)
-
-class _ULEB128(Adapter):
-    def _decode(self, obj, context): return _uleb128(obj)[1]
-    def _encode(self, obj, context): return _uleb128x(obj)
-
-class _ULEB128p1(Adapter):
-    def _decode(self, obj, context): return _uleb128p1(obj)[1]
-    def _encode(self, obj, context): return _uleb128p1x(obj)
-
-class _SLEB128(Adapter):
-    def _decode(self, obj, context): return _sleb128(obj)[1]
-    def _encode(self, obj, context): return _sleb128x(obj)
-
-def _LEB128(name, typ):
-    return Embed(Struct(None,
-        RepeatUntil(lambda obj, ctx: not obj & 128, Byte(name + '_bytes')),
-        typ(Value(name, lambda ctx: getattr(ctx, name + '_bytes')))))
-
-# adapters for ULEB128, SLEB128, ULEB128p1
-def ULEB128(name): return _LEB128(name, _ULEB128)
-def SLEB128(name): return _LEB128(name, _SLEB128)
-def ULEB128p1(name): return _LEB128(name, _ULEB128p1)
+    data = ''
+    while not -64 <= value < 64:
+        data += chr(128 | value & 127)
+        value >>= 7
+    return data + chr(value & 127)
+
+class _LEB128(Construct):
+    """Decodes a LEB128 value directly from the stream.
+
+    Reads at most five bytes at once and seeks back to the end of the
+    encoded value, rather than parsing it byte by byte.
+    """
+    __slots__ = ['decode', 'encode']
+
+    def __init__(self, name, decode, encode):
+        Construct.__init__(self, name)
+        self.decode, self.encode = decode, encode
+
+    def _parse(self, stream, context):
+        data = bytearray(stream.read(5))
+        if not data:
+            raise FieldError('expected a LEB128 value, found end of stream')
+        length, value = self.decode(data)
+        stream.seek(length - len(data), 1)
+        return value
+
+    def _build(self, obj, stream, context):
+        stream.write(self.encode(obj))
+
+    def _sizeof(self, context):
+        raise SizeofError('LEB128 values are variable-length')
+
+# constructs for ULEB128, SLEB128, ULEB128p1
+def ULEB128(name): return _LEB128(name, _uleb128, _uleb128x)
+def SLEB128(name): return _LEB128(name, _sleb128, _sleb128x)
+def ULEB128p1(name): return _LEB128(name, _uleb128p1, _uleb128p1x)
+
+def uleb128_array(data, offset, count):
+    """Decodes count consecutive ULEB128 values starting at offset.
+
+    Returns an array('I') with the values and the offset right after the
+    last value.
+    """
+    buf = bytearray(data[offset:offset+5*count])
+    ret = array('I')
+    append, pos, end = ret.append, 0, len(buf)
+    for _ in xrange(count):
+        if pos >= end:
+            raise FieldError('expected %d LEB128 values, found end of data '
+                'after %d' % (count, len(ret)))
+        value = buf[pos]
+        if value < 128:
+            pos += 1
+        else:
+            length, value = _uleb128(buf, pos)
+            pos += length
+        append(value)
+    return ret, offset + pos
 
 def access_flags():
     return FlagsEnum(Value('access_flags', lambda ctx: ctx.access_flags_),
@@ -107,85 +164,124 @@ def mutf8_string(name):
         Value(name, lambda ctx: getattr(ctx,
             '%s_bytes' % name).replace('\xc0\x80', '\x00'))))
 
-_signed_int_types = {1: SLInt8, 2: SLInt16, 4: SLInt32, 8: SLInt64}
-_unsigned_int_types = {1: ULInt8, 2: ULInt16, 4: ULInt32, 8: ULInt64}
-_float_types = {4: LFloat32, 8: LFloat64}
-
-def _sign_extend(value, length):
-    return value.ljust(length, '\xff' if ord(value[0]) & 0x80 else '\x00')
-
-def _signed_int(name, length):
-    return Embed(Struct(None,
-        MetaField('%s_bytes' % name, lambda ctx: ctx.value_arg+1),
-        Value(name, lambda ctx: _unsigned_int_types[length](None).parse(
-            _sign_extend(getattr(ctx, '%s_bytes' % name), length)))))
-
-def _unsigned_int(name, length):
-    return Embed(Struct(None,
-        MetaField('%s_bytes' % name, lambda ctx: ctx.value_arg+1),
-        Value(name, lambda ctx: _unsigned_int_types[length](None).parse(
-            getattr(ctx, '%s_bytes' % name).ljust(length, '\x00')))))
-
-def _float(name, size):
-    return Embed(Struct(None,
-        MetaField('%s_bytes' % name, lambda ctx: ctx.value_arg+1),
-        Value(name, lambda ctx: _float_types[length](None).parse(
-            getattr(ctx, '%s_bytes' % name).rjust(length, '\x00')))))
-
-encoded_value = Struct('encoded_value',
-    Embed(BitStruct(None,
-        BitField('value_arg', 3),
-        Enum(BitField('value_type', 5),
-            VALUE_BYTE = 0x00,
-            VALUE_SHORT = 0x02,
-            VALUE_CHAR = 0x03,
-            VALUE_INT = 0x04,
-            VALUE_LONG = 0x06,
-            VALUE_FLOAT = 0x10,
-            VALUE_DOUBLE = 0x11,
-            VALUE_STRING = 0x17,
-            VALUE_TYPE = 0x18,
-            VALUE_FIELD = 0x19,
-            VALUE_METHOD = 0x1a,
-            VALUE_ENUM = 0x1b,
-            VALUE_ARRAY = 0x1c,
-            VALUE_ANNOTATION = 0x1d,
-            VALUE_NULL = 0x1e,
-            VALUE_BOOLEAN = 0x1f
-    ))),
-    Embed(Switch(None, lambda ctx: ctx.value_type, {
-        'VALUE_BYTE': _signed_int('value', 1),
-        'VALUE_SHORT': _signed_int('value', 2),
-        'VALUE_CHAR': _unsigned_int('value', 2),
-        'VALUE_INT': _signed_int('value', 4),
-        'VALUE_LONG': _signed_int('value', 8),
-        'VALUE_FLOAT': _float('value', 4),
-        'VALUE_DOUBLE': _float('value', 8),
-        'VALUE_STRING': _unsigned_int('index', 4),
-        'VALUE_TYPE': _unsigned_int('index', 4),
-        'VALUE_FIELD': _unsigned_int('index', 4),
-        'VALUE_METHOD': _unsigned_int('index', 4),
-        'VALUE_ENUM': _unsigned_int('index', 4),
-        'VALUE_ARRAY': Embed(Value(None, lambda ctx: encoded_array)),
-        'VALUE_ANNOTATION': Embed(Value(None,
-            lambda ctx: encoded_annotation)),
-        'VALUE_NULL': Pass,
-        'VALUE_BOOLEAN': Value('value', lambda ctx: IfThenElse(None,
-            lambda ctx: ctx.value_arg, True, False)),
-    })))
-
-encoded_array = Struct('encoded_array',
-    ULEB128('size'),
-    MetaArray(lambda ctx: ctx.size, Rename('values', encoded_value)))
-
-annotation_element = Struct('annotation_element',
-    ULEB128('name_idx'),
-    Rename('value', encoded_value))
-
-encoded_annotation = Struct('encoded_annotation',
-    ULEB128('type_idx'),
-    ULEB128('size'),
-    MetaArray(lambda ctx: ctx.size, Rename('elements', annotation_element)))
+# encoded_value types by value_type, and those which are sign-extended
+_value_types = {
+    0x00: 'VALUE_BYTE', 0x02: 'VALUE_SHORT', 0x03: 'VALUE_CHAR',
+    0x04: 'VALUE_INT', 0x06: 'VALUE_LONG', 0x10: 'VALUE_FLOAT',
+    0x11: 'VALUE_DOUBLE', 0x15: 'VALUE_METHOD_TYPE',
+    0x16: 'VALUE_METHOD_HANDLE', 0x17: 'VALUE_STRING', 0x18: 'VALUE_TYPE',
+    0x19: 'VALUE_FIELD', 0x1a: 'VALUE_METHOD', 0x1b: 'VALUE_ENUM',
+    0x1c: 'VALUE_ARRAY', 0x1d: 'VALUE_ANNOTATION', 0x1e: 'VALUE_NULL',
+    0x1f: 'VALUE_BOOLEAN',
+}
+_signed_values = 0x00, 0x02, 0x04, 0x06
+
+_visibilities = {0: 'VISIBILITY_BUILD', 1: 'VISIBILITY_RUNTIME',
+    2: 'VISIBILITY_SYSTEM'}
+
+def _container(*items):
+    # a Container of (key, value) items, in order
+    ret = Container()
+    ret.update(items)
+    return ret
+
+# the encoded values, annotations and static values of class definitions
+# are decoded by hand, straight from the data, when they're first accessed
+# (see DexFile._class_values()), each function returns the decoded item and
+# the offset right after it
+
+def _encoded_value(data, offset):
+    arg, typ = ord(data[offset]) >> 5, ord(data[offset]) & 0x1f
+    if typ not in _value_types:
+        raise Exception('Invalid value type: 0x%02x' % typ)
+    ret = _container(('value_arg', arg), ('value_type', _value_types[typ]))
+    offset += 1
+
+    if typ == 0x1c:
+        x, offset = _encoded_array(data, offset)
+        # (note that values is a method of Containers as well)
+        ret.size, ret['values'] = x.size, x['values']
+    elif typ == 0x1d:
+        x, offset = _encoded_annotation(data, offset)
+        ret.type_idx, ret.size, ret.elements = x.type_idx, x.size, x.elements
+    elif typ == 0x1e:
+        ret.value = None
+    elif typ == 0x1f:
+        ret.value = bool(arg)
+    elif typ == 0x10 or typ == 0x11:
+        # the bytes given are the most significant ones
+        size = 4 if typ == 0x10 else 8
+        ret.value, = struct.unpack('<f' if typ == 0x10 else '<d',
+            data[offset:offset+arg+1].rjust(size, '\x00'))
+        offset += arg + 1
+    else:
+        value = 0
+        for x in xrange(offset + arg, offset - 1, -1):
+            value = value << 8 | ord(data[x])
+        if typ in _signed_values and value >> arg * 8 + 7:
+            value -= 1 << arg * 8 + 8
+        if typ <= 0x06:
+            ret.value = value
+        else:
+            ret.index = value
+        offset += arg + 1
+    return ret, offset
+
+def _encoded_array(data, offset):
+    size, offset = _leb128_at(data, offset)
+    values = []
+    for _ in xrange(size):
+        x, offset = _encoded_value(data, offset)
+        values.append(x)
+    return _container(('size', size), ('values', values)), offset
+
+def _encoded_annotation(data, offset):
+    type_idx, offset = _leb128_at(data, offset)
+    size, offset = _leb128_at(data, offset)
+    elements = []
+    for _ in xrange(size):
+        name_idx, offset = _leb128_at(data, offset)
+        value, offset = _encoded_value(data, offset)
+        elements.append(_container(('name_idx', name_idx), ('value', value)))
+    return _container(('type_idx', type_idx), ('size', size),
+        ('elements', elements)), offset
+
+def _annotation_item(data, offset):
+    visibility = ord(data[offset])
+    if visibility not in _visibilities:
+        raise Exception('Invalid visibility: %d' % visibility)
+    x, offset = _encoded_annotation(data, offset + 1)
+    return _container(('visibility', _visibilities[visibility]),
+        ('encoded_annotation', x)), offset
+
+def _annotation_set_item(data, offset):
+    size, = struct.unpack_from('<I', data, offset)
+    offsets = struct.unpack_from('<%dI' % size, data, offset + 4)
+    return _container(('size', size), ('annotation_off_item', [_container(
+        ('annotation_off', x), ('annotation_item', _annotation_item(data,
+        x)[0])) for x in offsets])), offset + 4 + size * 4
+
+def _annotations_directory_item(data, offset):
+    class_off, fields, methods, parameters = struct.unpack_from('<4I', data,
+        offset)
+    ret = _container(('class_annotations_off', class_off),
+        ('annotation_set_item', _annotation_set_item(data, class_off)[0]
+            if class_off else None),
+        ('fields_size', fields), ('annotated_methods_size', methods),
+        ('annotated_parameters_size', parameters))
+    offset += 16
+    for name, key, count in (('field_annotation', 'field_idx', fields),
+            ('method_annotation', 'method_idx', methods),
+            ('parameter_annotation', 'method_idx', parameters)):
+        values = struct.unpack_from('<%dI' % (count * 2), data, offset)
+        ret[name] = [_container((key, values[x]),
+            ('annotations_off', values[x+1])) for x in xrange(0, count * 2, 2)]
+        offset += count * 8
+    return ret, offset
+
+def _encoded_array_item(data, offset):
+    x, offset = _encoded_array(data, offset)
+    return _container(('encoded_array', x)), offset
 
 string_data_item = Struct('string_data_item',
     ULEB128('utf16_size'),
@@ -222,19 +318,30 @@ encoded_method = Struct('encoded_method',
         Pointer(lambda ctx: ctx.code_off,
             LazyBound('code_item', lambda: code_item))))
 
-class_data_item = Struct('class_data_item',
-    ULEB128('static_fields_size'),
-    ULEB128('instance_fields_size'),
-    ULEB128('direct_methods_size'),
-    ULEB128('virtual_methods_size'),
-    Rename('static_fields', MetaArray(lambda ctx: ctx.static_fields_size,
-        encoded_field)),
-    Rename('instance_fields', MetaArray(lambda ctx: ctx.instance_fields_size,
-        encoded_field)),
-    Rename('direct_methods', MetaArray(lambda ctx: ctx.direct_methods_size,
-        encoded_method)),
-    Rename('virtual_methods', MetaArray(lambda ctx: ctx.virtual_methods_size,
-        encoded_method)))
+# encoded_method without following code_off, used by the lazy DexFile
+_lazy_encoded_method = Struct('encoded_method',
+    ULEB128('method_idx_diff'),
+    ULEB128('access_flags_'),
+    access_flags(),
+    ULEB128('code_off'))
+
+def _class_data_item(method):
+    return Struct('class_data_item',
+        ULEB128('static_fields_size'),
+        ULEB128('instance_fields_size'),
+        ULEB128('direct_methods_size'),
+        ULEB128('virtual_methods_size'),
+        Rename('static_fields', MetaArray(lambda ctx: ctx.static_fields_size,
+            encoded_field)),
+        Rename('instance_fields', MetaArray(
+            lambda ctx: ctx.instance_fields_size, encoded_field)),
+        Rename('direct_methods', MetaArray(
+            lambda ctx: ctx.direct_methods_size, method)),
+        Rename('virtual_methods', MetaArray(
+            lambda ctx: ctx.virtual_methods_size, method)))
+
+class_data_item = _class_data_item(encoded_method)
+_lazy_class_data_item = _class_data_item(_lazy_encoded_method)
 
 type_item = Struct('type_item',
     ULInt16('type_idx'))
@@ -269,6 +376,32 @@ encoded_catch_handler_list = Struct('encoded_catch_handler_list',
     MetaArray(lambda ctx: abs(ctx.size), encoded_catch_handler),
     If(lambda ctx: ctx.size, ULEB128('catch_all_addr')))
 
+def _code_units_str(insns):
+    # code units as a (little-endian) string
+    insns = array('H', insns)
+    if sys.byteorder != 'little':
+        insns.byteswap()
+    return insns.tostring()
+
+class _CodeUnits(Construct):
+    """Reads the instructions of a code item as an array of code units in
+    one go, rather than parsing them one by one."""
+    def _parse(self, stream, context):
+        length = context.insn_size * 2
+        data = stream.read(length)
+        if len(data) != length:
+            raise FieldError('expected %d, found %d' % (length, len(data)))
+        ret = array('H', data)
+        if sys.byteorder != 'little':
+            ret.byteswap()
+        return ret
+
+    def _build(self, obj, stream, context):
+        stream.write(_code_units_str(obj))
+
+    def _sizeof(self, context):
+        return context.insn_size * 2
+
 code_item = Struct('code_item',
     ULInt16('registers_size'),
     ULInt16('ins_size'),
@@ -276,11 +409,348 @@ code_item = Struct('code_item',
     ULInt16('tries_size'),
     ULInt32('debug_info_off'),
     ULInt32('insn_size'),
-    MetaArray(lambda ctx: ctx.insn_size, ULInt16('insns')),
-    Rename('tries', Aligned(MetaArray(lambda ctx: ctx.tries_size, try_item))),
+    _CodeUnits('insns'),
+    # the tries are 4-byte aligned
+    If(lambda ctx: ctx.tries_size and ctx.insn_size % 2, Padding(2)),
+    Rename('tries', MetaArray(lambda ctx: ctx.tries_size, try_item)),
     Rename('handlers', If(lambda ctx: ctx.tries_size,
         encoded_catch_handler_list)))
 
+def _ops(fmt, index, *names):
+    return [(name, fmt, index) for name in names]
+
+def _binops(suffix, fmt):
+    return [(name + suffix, fmt, None) for name in ('add-int', 'sub-int',
+        'mul-int', 'div-int', 'rem-int', 'and-int', 'or-int', 'xor-int',
+        'shl-int', 'shr-int', 'ushr-int', 'add-long', 'sub-long', 'mul-long',
+        'div-long', 'rem-long', 'and-long', 'or-long', 'xor-long', 'shl-long',
+        'shr-long', 'ushr-long', 'add-float', 'sub-float', 'mul-float',
+        'div-float', 'rem-float', 'add-double', 'sub-double', 'mul-double',
+        'div-double', 'rem-double')]
+
+# Dalvik opcodes as (mnemonic, format, index type), indexed by opcode. The
+# first digit of the format is the length of the instruction in code units.
+DALVIK_OPCODES = (
+    _ops('10x', None, 'nop') +
+    _ops('12x', None, 'move') +
+    _ops('22x', None, 'move/from16') +
+    _ops('32x', None, 'move/16') +
+    _ops('12x', None, 'move-wide') +
+    _ops('22x', None, 'move-wide/from16') +
+    _ops('32x', None, 'move-wide/16') +
+    _ops('12x', None, 'move-object') +
+    _ops('22x', None, 'move-object/from16') +
+    _ops('32x', None, 'move-object/16') +
+    _ops('11x', None, 'move-result', 'move-result-wide', 'move-result-object',
+        'move-exception') +
+    _ops('10x', None, 'return-void') +
+    _ops('11x', None, 'return', 'return-wide', 'return-object') +
+    _ops('11n', None, 'const/4') +
+    _ops('21s', None, 'const/16') +
+    _ops('31i', None, 'const') +
+    _ops('21h', None, 'const/high16') +
+    _ops('21s', None, 'const-wide/16') +
+    _ops('31i', None, 'const-wide/32') +
+    _ops('51l', None, 'const-wide') +
+    _ops('21h', None, 'const-wide/high16') +
+    _ops('21c', 'string', 'const-string') +
+    _ops('31c', 'string', 'const-string/jumbo') +
+    _ops('21c', 'type', 'const-class') +
+    _ops('11x', None, 'monitor-enter', 'monitor-exit') +
+    _ops('21c', 'type', 'check-cast') +
+    _ops('22c', 'type', 'instance-of') +
+    _ops('12x', None, 'array-length') +
+    _ops('21c', 'type', 'new-instance') +
+    _ops('22c', 'type', 'new-array') +
+    _ops('35c', 'type', 'filled-new-array') +
+    _ops('3rc', 'type', 'filled-new-array/range') +
+    _ops('31t', None, 'fill-array-data') +
+    _ops('11x', None, 'throw') +
+    _ops('10t', None, 'goto') +
+    _ops('20t', None, 'goto/16') +
+    _ops('30t', None, 'goto/32') +
+    _ops('31t', None, 'packed-switch', 'sparse-switch') +
+    _ops('23x', None, 'cmpl-float', 'cmpg-float', 'cmpl-double',
+        'cmpg-double', 'cmp-long') +
+    _ops('22t', None, 'if-eq', 'if-ne', 'if-lt', 'if-ge', 'if-gt', 'if-le') +
+    _ops('21t', None, 'if-eqz', 'if-nez', 'if-ltz', 'if-gez', 'if-gtz',
+        'if-lez') +
+    _ops('10x', None, *['unused-%02x' % x for x in xrange(0x3e, 0x44)]) +
+    _ops('23x', None, 'aget', 'aget-wide', 'aget-object', 'aget-boolean',
+        'aget-byte', 'aget-char', 'aget-short', 'aput', 'aput-wide',
+        'aput-object', 'aput-boolean', 'aput-byte', 'aput-char',
+        'aput-short') +
+    _ops('22c', 'field', 'iget', 'iget-wide', 'iget-object', 'iget-boolean',
+        'iget-byte', 'iget-char', 'iget-short', 'iput', 'iput-wide',
+        'iput-object', 'iput-boolean', 'iput-byte', 'iput-char',
+        'iput-short') +
+    _ops('21c', 'field', 'sget', 'sget-wide', 'sget-object', 'sget-boolean',
+        'sget-byte', 'sget-char', 'sget-short', 'sput', 'sput-wide',
+        'sput-object', 'sput-boolean', 'sput-byte', 'sput-char',
+        'sput-short') +
+    _ops('35c', 'method', 'invoke-virtual', 'invoke-super',
+        'invoke-direct', 'invoke-static', 'invoke-interface') +
+    _ops('10x', None, 'unused-73') +
+    _ops('3rc', 'method', 'invoke-virtual/range', 'invoke-super/range',
+        'invoke-direct/range', 'invoke-static/range',
+        'invoke-interface/range') +
+    _ops('10x', None, 'unused-79', 'unused-7a') +
+    _ops('12x', None, 'neg-int', 'not-int', 'neg-long', 'not-long',
+        'neg-float', 'neg-double', 'int-to-long', 'int-to-float',
+        'int-to-double', 'long-to-int', 'long-to-float', 'long-to-double',
+        'float-to-int', 'float-to-long', 'float-to-double', 'double-to-int',
+        'double-to-long', 'double-to-float', 'int-to-byte', 'int-to-char',
+        'int-to-short') +
+    _binops('', '23x') +
+    _binops('/2addr', '12x') +
+    _ops('22s', None, 'add-int/lit16', 'rsub-int', 'mul-int/lit16',
+        'div-int/lit16', 'rem-int/lit16', 'and-int/lit16', 'or-int/lit16',
+        'xor-int/lit16') +
+    _ops('22b', None, 'add-int/lit8', 'rsub-int/lit8', 'mul-int/lit8',
+        'div-int/lit8', 'rem-int/lit8', 'and-int/lit8', 'or-int/lit8',
+        'xor-int/lit8', 'shl-int/lit8', 'shr-int/lit8', 'ushr-int/lit8') +
+    _ops('10x', None, *['unused-%02x' % x for x in xrange(0xe3, 0xfa)]) +
+    _ops('45cc', 'method', 'invoke-polymorphic') +
+    _ops('4rcc', 'method', 'invoke-polymorphic/range') +
+    _ops('35c', 'call_site', 'invoke-custom') +
+    _ops('3rc', 'call_site', 'invoke-custom/range') +
+    _ops('21c', 'method_handle', 'const-method-handle') +
+    _ops('21c', 'proto', 'const-method-type'))
+
+assert len(DALVIK_OPCODES) == 256
+
+# instruction length in code units and index type, indexed by opcode
+_insn_info = [(int(fmt[0]), index, fmt == '31c')
+    for _, fmt, index in DALVIK_OPCODES]
+
+def _payload_length(insns, pc):
+    # length of a packed-switch, sparse-switch or fill-array-data payload,
+    # which start with a nop with a non-zero identifier
+    ident = insns[pc] >> 8
+    if ident == 1:
+        return 4 + insns[pc+1] * 2
+    if ident == 2:
+        return 2 + insns[pc+1] * 4
+    if ident == 3:
+        size = insns[pc+2] | insns[pc+3] << 16
+        return 4 + (size * insns[pc+1] + 1) / 2
+    raise Exception('Invalid payload identifier: %d' % ident)
+
+def _s4(x): return x - 0x10 if x & 0x8 else x
+def _s8(x): return x - 0x100 if x & 0x80 else x
+def _s16(x): return x - 0x10000 if x & 0x8000 else x
+def _s32(x): return x - 0x100000000 if x & 0x80000000 else x
+def _s64(x): return x - 2**64 if x & 2**63 else x
+
+def _regs35(u, pc):
+    # the argument registers of the 35c and 45cc formats
+    return [u[pc+2] & 0xf, u[pc+2] >> 4 & 0xf, u[pc+2] >> 8 & 0xf,
+        u[pc+2] >> 12, u[pc] >> 8 & 0xf][:u[pc] >> 12]
+
+def _regs35x(op, regs, idx, *extra):
+    x = list(regs) + [0] * (5 - len(regs))
+    return [op | len(regs) << 12 | x[4] << 8, idx,
+        x[0] | x[1] << 4 | x[2] << 8 | x[3] << 12] + list(extra)
+
+def _regs3r(u, pc):
+    return range(u[pc+2], u[pc+2] + (u[pc] >> 8))
+
+# decoders and encoders of the operands of each instruction format, the
+# operands are given in the order of the format's letters (e.g., vA, vB and
+# field@CCCC for 22c). The 35c/3rc and 45cc/4rcc formats take a list of
+# argument registers followed by the index (and the proto index).
+def _high16(u, pc):
+    # the literal of const/high16 and const-wide/high16, the top 16 bits of
+    # a 32-bit and a 64-bit value respectively
+    if u[pc] & 0xff == 0x15:
+        return _s32(u[pc+1] << 16)
+    return _s64(u[pc+1] << 48)
+
+_formats = {
+    '10x': (lambda u, pc: [],
+        lambda op, o: [op]),
+    '12x': (lambda u, pc: [u[pc] >> 8 & 0xf, u[pc] >> 12],
+        lambda op, o: [op | o[0] << 8 | o[1] << 12]),
+    '11n': (lambda u, pc: [u[pc] >> 8 & 0xf, _s4(u[pc] >> 12)],
+        lambda op, o: [op | o[0] << 8 | (o[1] & 0xf) << 12]),
+    '11x': (lambda u, pc: [u[pc] >> 8],
+        lambda op, o: [op | o[0] << 8]),
+    '10t': (lambda u, pc: [_s8(u[pc] >> 8)],
+        lambda op, o: [op | (o[0] & 0xff) << 8]),
+    '20t': (lambda u, pc: [_s16(u[pc+1])],
+        lambda op, o: [op, o[0] & 0xffff]),
+    '22x': (lambda u, pc: [u[pc] >> 8, u[pc+1]],
+        lambda op, o: [op | o[0] << 8, o[1]]),
+    '21t': (lambda u, pc: [u[pc] >> 8, _s16(u[pc+1])],
+        lambda op, o: [op | o[0] << 8, o[1] & 0xffff]),
+    '21h': (lambda u, pc: [u[pc] >> 8, _high16(u, pc)],
+        lambda op, o: [op | o[0] << 8,
+            o[1] >> (16 if op == 0x15 else 48) & 0xffff]),
+    '21c': (lambda u, pc: [u[pc] >> 8, u[pc+1]],
+        lambda op, o: [op | o[0] << 8, o[1]]),
+    '23x': (lambda u, pc: [u[pc] >> 8, u[pc+1] & 0xff, u[pc+1] >> 8],
+        lambda op, o: [op | o[0] << 8, o[1] | o[2] << 8]),
+    '22b': (lambda u, pc: [u[pc] >> 8, u[pc+1] & 0xff, _s8(u[pc+1] >> 8)],
+        lambda op, o: [op | o[0] << 8, o[1] | (o[2] & 0xff) << 8]),
+    '22t': (lambda u, pc: [u[pc] >> 8 & 0xf, u[pc] >> 12, _s16(u[pc+1])],
+        lambda op, o: [op | o[0] << 8 | o[1] << 12, o[2] & 0xffff]),
+    '22c': (lambda u, pc: [u[pc] >> 8 & 0xf, u[pc] >> 12, u[pc+1]],
+        lambda op, o: [op | o[0] << 8 | o[1] << 12, o[2]]),
+    '30t': (lambda u, pc: [_s32(u[pc+1] | u[pc+2] << 16)],
+        lambda op, o: [op, o[0] & 0xffff, o[0] >> 16 & 0xffff]),
+    '32x': (lambda u, pc: [u[pc+1], u[pc+2]],
+        lambda op, o: [op, o[0], o[1]]),
+    '31i': (lambda u, pc: [u[pc] >> 8, _s32(u[pc+1] | u[pc+2] << 16)],
+        lambda op, o: [op | o[0] << 8, o[1] & 0xffff, o[1] >> 16 & 0xffff]),
+    '31c': (lambda u, pc: [u[pc] >> 8, u[pc+1] | u[pc+2] << 16],
+        lambda op, o: [op | o[0] << 8, o[1] & 0xffff, o[1] >> 16]),
+    '35c': (lambda u, pc: [_regs35(u, pc), u[pc+1]],
+        lambda op, o: _regs35x(op, o[0], o[1])),
+    '3rc': (lambda u, pc: [_regs3r(u, pc), u[pc+1]],
+        lambda op, o: [op | len(o[0]) << 8, o[1], o[0][0] if o[0] else 0]),
+    '45cc': (lambda u, pc: [_regs35(u, pc), u[pc+1], u[pc+3]],
+        lambda op, o: _regs35x(op, o[0], o[1], o[2])),
+    '4rcc': (lambda u, pc: [_regs3r(u, pc), u[pc+1], u[pc+3]],
+        lambda op, o: [op | len(o[0]) << 8, o[1], o[0][0] if o[0] else 0,
+            o[2]]),
+    '51l': (lambda u, pc: [u[pc] >> 8, _s64(u[pc+1] | u[pc+2] << 16 |
+            u[pc+3] << 32 | u[pc+4] << 48)],
+        lambda op, o: [op | o[0] << 8] + [o[1] >> x & 0xffff
+            for x in (0, 16, 32, 48)]),
+}
+_formats['21s'] = _formats['21t']
+_formats['22s'] = _formats['22t']
+_formats['31t'] = _formats['31i']
+
+# the kind of each operand per format: a register, a list of registers, a
+# literal, a branch offset or an index
+_operand_kinds = {
+    '10x': '', '12x': 'rr', '11n': 'rl', '11x': 'r', '10t': 'b', '20t': 'b',
+    '22x': 'rr', '21t': 'rb', '21s': 'rl', '21h': 'rl', '21c': 'ri',
+    '23x': 'rrr', '22b': 'rrl', '22t': 'rrb', '22s': 'rrl', '22c': 'rri',
+    '30t': 'b', '32x': 'rr', '31i': 'rl', '31t': 'rb', '31c': 'ri',
+    '35c': 'Ri', '3rc': 'Ri', '45cc': 'Rii', '4rcc': 'Rii', '51l': 'rl',
+}
+
+_operand_str = {
+    'r': lambda x: 'v%d' % x,
+    'R': lambda x: '{%s}' % ', '.join('v%d' % y for y in x),
+    'l': lambda x: '#%d' % x,
+    'b': lambda x: '%+d' % x,
+    'i': lambda x: '@%d' % x,
+}
+
+_insn_decoders = [_formats[fmt][0] for _, fmt, _ in DALVIK_OPCODES]
+
+_payloads = {1: 'packed-switch-payload', 2: 'sparse-switch-payload',
+    3: 'fill-array-data-payload'}
+
+class DalvikInstruction(object):
+    """A Dalvik instruction, or a switch or array data payload.
+
+    The instruction is encoded from op and operands, which can thus be
+    changed freely (as long as the operands fit the instruction format).
+    ref is the resolved string, type, field, method or proto the index of
+    the instruction refers to, if any. Payloads keep their raw code units.
+    """
+    __slots__ = 'op', 'operands', 'ref', 'payload'
+
+    def __init__(self, op, operands=None, ref=None, payload=None):
+        self.op, self.operands = op, operands or []
+        self.ref, self.payload = ref, payload
+
+    @property
+    def mnemonic(self):
+        if self.payload is not None:
+            return _payloads[self.payload[0] >> 8]
+        return DALVIK_OPCODES[self.op][0]
+
+    @property
+    def format(self):
+        return DALVIK_OPCODES[self.op][1]
+
+    @property
+    def length(self):
+        """The length of the instruction in code units."""
+        if self.payload is not None:
+            return len(self.payload)
+        return _insn_info[self.op][0]
+
+    @property
+    def index(self):
+        if self.payload is None and DALVIK_OPCODES[self.op][2]:
+            return self.operands[_operand_kinds[self.format].index('i')]
+
+    @property
+    def units(self):
+        """The encoded instruction as a list of code units."""
+        if self.payload is not None:
+            return list(self.payload)
+        return _formats[self.format][1](self.op, self.operands)
+
+    @property
+    def code(self):
+        """The encoded instruction as a (little-endian) string."""
+        return struct.pack('<%dH' % self.length, *self.units)
+
+    def __str__(self):
+        if self.payload is not None:
+            return self.mnemonic
+        ret = '%s %s' % (self.mnemonic, ', '.join(_operand_str[kind](x)
+            for kind, x in zip(_operand_kinds[self.format], self.operands)))
+        if self.ref is not None:
+            ret += ' ; ' + _ref_str(self.ref)
+        return ret.strip()
+
+    def __repr__(self):
+        return '<%s>' % self
+
+def _ref_str(x):
+    if isinstance(x, basestring):
+        return x
+    if 'shorty' in x:
+        return str(x.descriptor)
+    if 'proto' in x:
+        return '%s->%s%s' % (x.class_, x.name, _ref_str(x.proto))
+    if 'type_' in x:
+        return '%s->%s:%s' % (x.class_, x.name, x.type_)
+    return str(x)
+
+def disassemble(insns, resolve=None):
+    """Decodes an array (or list) of code units into DalvikInstructions.
+
+    resolve(kind, idx) is called for each instruction with an index, kind
+    being the index type of the instruction (string, type, field, method,
+    proto, call_site or method_handle), and returns its ref.
+    """
+    ret, pc, count = [], 0, len(insns)
+    while pc < count:
+        op = insns[pc] & 0xff
+        if not op and insns[pc] > 0xff:
+            length = _payload_length(insns, pc)
+            ret.append(DalvikInstruction(0, payload=insns[pc:pc+length]))
+            pc += length
+            continue
+
+        length, kind, _ = _insn_info[op]
+        x = DalvikInstruction(op, _insn_decoders[op](insns, pc))
+        if kind is not None and resolve is not None:
+            x.ref = resolve(kind, x.index)
+        ret.append(x)
+        pc += length
+    return ret
+
+def assemble(instructions):
+    """Encodes DalvikInstructions into an array of code units.
+
+    Instructions are encoded as-is, branch offsets and the alignment of
+    payloads are not adjusted.
+    """
+    ret = array('H')
+    for x in instructions:
+        ret.extend(x.units)
+    return ret
+
 field_annotation = Struct('field_annotation',
     ULInt32('field_idx'),
     ULInt32('annotations_off'))
@@ -293,33 +763,6 @@ parameter_annotation = Struct('parameter_annotation',
     ULInt32('method_idx'),
     ULInt32('annotations_off'))
 
-annotation_item = Struct('annotation_item',
-    Enum(Byte('visibility'),
-        VISIBILITY_BUILD = 0,
-        VISIBILITY_RUNTIME = 1,
-        VISIBILITY_SYSTEM = 2),
-    encoded_annotation)
-
-annotation_off_item = Struct('annotation_off_item',
-    ULInt32('annotation_off'),
-    Pointer(lambda ctx: ctx.annotation_off, annotation_item))
-
-annotation_set_item = Struct('annotation_set_item',
-    ULInt32('size'),
-    MetaArray(lambda ctx: ctx.size, annotation_off_item))
-
-annotations_directory_item = Struct('annotations_directory_item',
-    ULInt32('class_annotations_off'),
-    If(lambda ctx: ctx.class_annotations_off,
-        Pointer(lambda ctx: ctx.class_annotations_off, annotation_set_item)),
-    ULInt32('fields_size'),
-    ULInt32('annotated_methods_size'),
-    ULInt32('annotated_parameters_size'),
-    MetaArray(lambda ctx: ctx.fields_size, field_annotation),
-    MetaArray(lambda ctx: ctx.annotated_methods_size, method_annotation),
-    MetaArray(lambda ctx: ctx.annotated_parameters_size,
-        parameter_annotation))
-
 annotation_set_ref_item = Struct('annotation_set_ref_item',
     ULInt32('annotations_off'))
 
@@ -327,9 +770,6 @@ annotation_set_ref_list = Struct('annotation_set_ref_list',
     ULInt32('size'),
     MetaArray(lambda ctx: ctx.size, annotation_set_ref_item))
 
-encoded_array_item = Struct('encoded_array_item',
-    encoded_array)
-
 map_item = Struct('map_item',
     Enum(ULInt16('type'),
         TYPE_HEADER_ITEM = 0x0000,
@@ -339,6 +779,8 @@ map_item = Struct('map_item',
         TYPE_FIELD_ID_ITEM = 0x0004,
         TYPE_METHOD_ID_ITEM = 0x0005,
         TYPE_CLASS_DEF_ITEM = 0x0006,
+        TYPE_CALL_SITE_ID_ITEM = 0x0007,
+        TYPE_METHOD_HANDLE_ITEM = 0x0008,
         TYPE_MAP_LIST = 0x1000,
         TYPE_TYPE_LIST = 0x1001,
         TYPE_ANNOTATION_SET_REF_LIST = 0x1002,
@@ -349,7 +791,8 @@ map_item = Struct('map_item',
         TYPE_DEBUG_INFO_ITEM = 0x2003,
         TYPE_ANNOTATION_ITEM = 0x2004,
         TYPE_ENCODED_ARRAY_ITEM = 0x2005,
-        TYPE_ANNOTATIONS_DIRECTORY_ITEM = 0x2006),
+        TYPE_ANNOTATIONS_DIRECTORY_ITEM = 0x2006,
+        TYPE_HIDDENAPI_CLASS_DATA_ITEM = 0xF000),
     ULInt16('unused'),
     ULInt32('size'),
     ULInt32('offset'))
@@ -367,15 +810,25 @@ class_def_item = Struct('class_def_item',
     Rename('interfaces', If(lambda ctx: ctx.interfaces_off,
         Pointer(lambda ctx: ctx.interfaces_off, type_list))),
     ULInt32('source_file_idx'),
+    # the annotations and static values are decoded on first access
     ULInt32('annotations_off'),
-    If(lambda ctx: ctx.annotations_off,
-        Pointer(lambda ctx: ctx.annotations_off, annotations_directory_item)),
     ULInt32('class_data_off'),
     If(lambda ctx: ctx.class_data_off,
         Pointer(lambda ctx: ctx.class_data_off, class_data_item)),
-    ULInt32('static_values_off'),
-    Rename('static_values', If(lambda ctx: ctx.static_values_off,
-        Pointer(lambda ctx: ctx.static_values_off, encoded_array_item))))
+    ULInt32('static_values_off'))
+
+# class_def_item without following any of its offsets, used by the lazy
+# DexFile which only parses the pointed-to items on first access
+_lazy_class_def_item = Struct('class_def_item',
+    ULInt32('class_idx'),
+    ULInt32('access_flags_'),
+    access_flags(),
+    ULInt32('superclass_idx'),
+    ULInt32('interfaces_off'),
+    ULInt32('source_file_idx'),
+    ULInt32('annotations_off'),
+    ULInt32('class_data_off'),
+    ULInt32('static_values_off'))
 
 NO_INDEX = 0xffffffff
 
@@ -383,79 +836,886 @@ def id_section(off, size, item):
     return Pointer(lambda ctx: getattr(ctx.header, off),
         MetaArray(lambda ctx: getattr(ctx.header, size), item))
 
-_DexFile = Struct('DexFile',
-    Rename('header', header_item),
+# the fixed-size id sections are decoded in bulk by IdTable rather than
+# through the *_id_item constructs, their columns are given as tuples of
+# (name, array typecode, index of the column in the item)
+_id_tables = (
+    ('string_id_item', 'string_ids', 4, (('string_data_off', 'I', 0),)),
+    ('type_id_item', 'type_ids', 4, (('descriptor_idx', 'I', 0),)),
+    ('proto_id_item', 'proto_ids', 12, (('shorty_idx', 'I', 0),
+        ('return_type_idx', 'I', 1), ('parameters_off', 'I', 2))),
+    ('field_id_item', 'field_ids', 8, (('class_idx', 'H', 0),
+        ('type_idx', 'H', 1), ('name_idx', 'I', 1))),
+    ('method_id_item', 'method_ids', 8, (('class_idx', 'H', 0),
+        ('proto_idx', 'H', 1), ('name_idx', 'I', 1))),
+)
+
+_DexFileHeader = Struct('DexFile',
+    Rename('header', header_item))
+
+_data_section = OnDemand(Pointer(lambda ctx: ctx.header.data_off,
+    MetaField('data', lambda ctx: ctx.header.data_size)))
 
-    id_section('string_ids_off', 'string_ids_size', string_id_item),
-    id_section('type_ids_off', 'type_ids_size', type_id_item),
-    id_section('proto_ids_off', 'proto_ids_size', proto_id_item),
-    id_section('field_ids_off', 'field_ids_size', field_id_item),
-    id_section('method_ids_off', 'method_ids_size', method_id_item),
+_DexFile = Struct('DexFile',
+    Embed(_DexFileHeader),
     id_section('class_defs_off', 'class_defs_size', class_def_item),
 
-    OnDemand(Pointer(lambda ctx: ctx.header.data_off,
-        MetaField('data', lambda ctx: ctx.header.data_size))))
+    _data_section)
+
+class IdTable:
+    """Fixed-size id items, decoded in bulk and stored as one array per
+    column rather than as a list of Containers.
+
+    The columns are available as attributes, e.g. table.name_idx[idx].
+    Indexing the table returns a Container for the item, which is resolved
+    through the resolve callback (if any) when it's first accessed and the
+    very same Container from then on, i.e., changes to it are kept (the
+    columns remain as parsed).
+    """
+    def __init__(self, name, data, offset, count, size, columns,
+            resolve=None):
+        self.name, self._resolve = name, resolve
+        self._columns = [column for column, _, _ in columns]
+        self._count = count
+        self._items = [None] * count
+
+        raw, views = data[offset:offset+count*size], {}
+        for column, typecode, idx in columns:
+            if typecode not in views:
+                views[typecode] = array(typecode, raw)
+                if sys.byteorder != 'little':
+                    views[typecode].byteswap()
+            stride = size / views[typecode].itemsize
+            setattr(self, column, views[typecode][idx::stride])
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[x] for x in xrange(*idx.indices(self._count))]
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError('%s index out of range' % self.name)
+        x = self._items[idx]
+        if x is None:
+            x = self._items[idx] = Container()
+            for column in self._columns:
+                x[column] = getattr(self, column)[idx]
+            if self._resolve:
+                self._resolve(x)
+        return x
+
+    def __iter__(self):
+        for idx in xrange(self._count):
+            yield self[idx]
+
+    def __repr__(self):
+        return '<%s table, %d items, %d resolved>' % (self.name,
+            self._count, self._count - self._items.count(None))
+
+class StringPool:
+    """The strings of a DexFile, decoded on first access.
+
+    Only the string_data_off column is kept around, strings are decoded
+    (and interned) when they're indexed and kept in a bounded LRU cache.
+    find() and search() match against the raw string data, without
+    decoding each string.
+    """
+    def __init__(self, data, offsets, cache_size=65536):
+        self.data, self.offsets = data, offsets
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[x] for x in xrange(*idx.indices(len(self)))]
+
+        ret = self._cache.pop(idx, None)
+        if ret is None:
+            start = self._start(self.offsets[idx])
+            end = self.data.find('\x00', start)
+            ret = intern(self.data[start:end].replace('\xc0\x80', '\x00'))
+        self._cache[idx] = ret
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return ret
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def __repr__(self):
+        return '<string pool, %d strings, %d cached>' % (len(self),
+            len(self._cache))
+
+    def _start(self, offset):
+        # skip the utf16_size
+        return offset + _uleb128(bytearray(self.data[offset:offset+5]))[0]
+
+    def _sort(self):
+        if self._sorted is None:
+            order = sorted(xrange(len(self)), key=self.offsets.__getitem__)
+            self._sorted = [self.offsets[x] for x in order], order
+        return self._sorted
+
+    def _lookup(self, start, end):
+        # returns the index of the string containing data[start:end]
+        offsets, order = self._sorted
+        idx = bisect.bisect_right(offsets, start) - 1
+        if idx < 0:
+            return None
+        begin = self._start(offsets[idx])
+        # the match has to lie within the string, e.g., not in padding or
+        # other data between two strings, or in the next string's size
+        if not begin <= start <= end <= self.data.find('\x00', begin):
+            return None
+        return order[idx]
+
+    def find(self, substring):
+        """Returns the indices of all strings containing substring."""
+        substring = substring.replace('\x00', '\xc0\x80')
+        offsets = self._sort()[0]
+        if not offsets:
+            return []
+
+        # the string data is searched in one go, from the first string up
+        # to the terminator of the last one
+        lo = offsets[0]
+        hi = self.data.find('\x00', self._start(offsets[-1])) + 1
+        ret = set()
+        pos = self.data.find(substring, lo, hi)
+        while pos >= 0:
+            idx = self._lookup(pos, pos + len(substring))
+            if idx is not None:
+                ret.add(idx)
+            pos = self.data.find(substring, pos + 1, hi)
+        return sorted(ret)
+
+    def search(self, pattern, flags=0):
+        """Returns the indices of all strings matching the regex pattern.
+
+        The pattern is matched against the raw (MUTF-8) data of each string
+        on its own, so "^" and "$" anchor at its start and end.
+        """
+        pattern = re.compile(pattern, flags)
+        ret = []
+        for idx, offset in enumerate(self.offsets):
+            start = self._start(offset)
+            end = self.data.find('\x00', start)
+            if pattern.search(self.data[start:end]):
+                ret.append(idx)
+        return ret
+
+class XrefIndex:
+    """Cross-references from code to strings, types, fields and methods.
+
+    Built in one linear pass over the instructions of every code item in
+    the DexFile. Each of strings, types, fields and methods maps an index
+    into the respective id section to a list of (method_idx, pc) tuples,
+    pc being the offset of the referencing instruction in code units.
+    """
+    kinds = 'string', 'type', 'field', 'method'
+
+    def __init__(self, dex):
+        self.strings, self.types, self.fields, self.methods = \
+            refs = {}, {}, {}, {}
+        tables = dict(zip(self.kinds, refs))
+
+        for method_idx, code_off in dex._code_items():
+            insns = dex._insns(code_off)
+            timing.count('dex.code_units', len(insns))
+            pc, count = 0, len(insns)
+            while pc < count:
+                op = insns[pc] & 0xff
+                if not op and insns[pc] > 0xff:
+                    pc += _payload_length(insns, pc)
+                    continue
+
+                length, kind, wide = _insn_info[op]
+                if kind in tables:
+                    idx = insns[pc+1]
+                    if wide:
+                        idx |= insns[pc+2] << 16
+                    tables[kind].setdefault(idx, []).append((method_idx, pc))
+                pc += length
+
+    def refs(self, kind, idx):
+        """Returns the code locations referencing a kind (string, type,
+        field or method) with the given index."""
+        return getattr(self, kind + 's').get(idx, [])
+
+class _LazyContainer(Container):
+    """Container of which some members are only decoded when accessed."""
+    __slots__ = ['__loaders__']
+
+    def __init__(self, obj, **loaders):
+        Container.__init__(self)
+        object.__setattr__(self, '__loaders__', loaders)
+        self.update(obj)
+
+    def __missing__(self, key):
+        if key not in self.__loaders__:
+            raise KeyError(key)
+        value = self[key] = self.__loaders__.pop(key)()
+        return value
+
+    def copy(self):
+        # the members which aren't loaded yet remain lazy in the copy
+        return self.__class__(self, **self.__loaders__)
+
+class _LazyList:
+    """Read-only list which decodes each entry when it's first accessed."""
+    def __init__(self, count, load):
+        self._items = [None] * count
+        self._load = load
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[x] for x in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self._items)
+        ret = self._items[idx]
+        if ret is None:
+            ret = self._items[idx] = self._load(idx)
+        return ret
+
+    def __iter__(self):
+        for idx in xrange(len(self._items)):
+            yield self[idx]
+
+    def __repr__(self):
+        return '<%d lazy items, %d decoded>' % (len(self._items),
+            len(self._items) - self._items.count(None))
+
+_TYPE_CALL_SITE_ID_ITEM = 0x0007
+_TYPE_MAP_LIST = 0x1000
+_TYPE_ANNOTATION_SET_REF_LIST = 0x1002
+_TYPE_ANNOTATION_SET_ITEM = 0x1003
+_TYPE_CLASS_DATA_ITEM = 0x2000
+_TYPE_CODE_ITEM = 0x2001
+_TYPE_ANNOTATIONS_DIRECTORY_ITEM = 0x2006
+
+# the data items which are byte-aligned, all others are 4-byte aligned
+_unaligned_types = 0x2000, 0x2002, 0x2003, 0x2004, 0x2005
+
+def _leb128_at(data, offset, decode=_uleb128):
+    # returns the LEB128 value at offset and the offset right after it
+    length, value = decode(bytearray(data[offset:offset+5]))
+    return value, offset + length
+
+def _code_item_end(data, offset):
+    tries, = struct.unpack_from('<H', data, offset + 6)
+    size, = struct.unpack_from('<I', data, offset + 12)
+    end = offset + 16 + size * 2
+    if not tries:
+        return end
+
+    # skip the padding, the tries and the encoded_catch_handler_list
+    end += size % 2 * 2 + tries * 8
+    count, end = _leb128_at(data, end)
+    for _ in xrange(count):
+        handlers, end = _leb128_at(data, end, _sleb128)
+        for _ in xrange(abs(handlers) * 2 + (handlers <= 0)):
+            _, end = _leb128_at(data, end)
+    return end
+
+class ClassData:
+    """A class_data_item, of which the ULEB128 values are decoded in bulk.
+
+    values holds the sizes of the static fields, instance fields, direct
+    methods and virtual methods, followed by (field_idx_diff, access_flags)
+    for each field and (method_idx_diff, access_flags, code_off) for each
+    method. end is the offset right after the item.
+    """
+    def __init__(self, data, offset):
+        sizes, end = uleb128_array(data, offset, 4)
+        values, self.end = uleb128_array(data, end,
+            2 * (sizes[0] + sizes[1]) + 3 * (sizes[2] + sizes[3]))
+        self.values = sizes + values
+
+    @property
+    def methods_start(self):
+        # the index of the values of the first method
+        return 4 + 2 * (self.values[0] + self.values[1])
+
+    def fields(self):
+        """Yields (field_idx, access_flags) for each static field, then for
+        each instance field."""
+        values, field_idx = self.values, 0
+        for idx in xrange(4, self.methods_start, 2):
+            # the field index restarts for the instance fields
+            if idx == 4 + 2 * values[0]:
+                field_idx = 0
+            field_idx += values[idx]
+            yield field_idx, values[idx+1]
+
+    def methods(self):
+        """Yields (method_idx, access_flags, code_off) for each direct
+        method, then for each virtual method."""
+        values, method_idx, start = self.values, 0, self.methods_start
+        for idx in xrange(start, len(values), 3):
+            # the method index restarts for the virtual methods
+            if idx == start + 3 * values[2]:
+                method_idx = 0
+            method_idx += values[idx]
+            yield method_idx, values[idx+1], values[idx+2]
+
+def _adler32_combine(adler1, adler2, length2):
+    # the Adler-32 of two concatenated blocks, as zlib's adler32_combine()
+    a1, b1 = adler1 & 0xffff, adler1 >> 16
+    a2, b2 = adler2 & 0xffff, adler2 >> 16
+    a = (a1 + a2 - 1) % 65521
+    b = (b1 + b2 + length2 * (a1 - 1)) % 65521
+    return b << 16 | a
+
+def _sign(buf, chunksize=1024*1024):
+    """Updates the signature and checksum of a dex file in place.
+
+    Both are computed in a single pass over the file. The checksum includes
+    the signature, so the checksum of everything following the signature is
+    combined with the one of the signature afterwards.
+    """
+    sha1, adler = hashlib.sha1(), 1
+    for offset in xrange(32, len(buf), chunksize):
+        chunk = buffer(buf, offset, chunksize)
+        sha1.update(chunk)
+        adler = zlib.adler32(chunk, adler)
+
+    buf[12:32] = signature = sha1.digest()
+    struct.pack_into('<I', buf, 8, _adler32_combine(
+        zlib.adler32(signature) & 0xffffffff, adler & 0xffffffff,
+        len(buf) - 32))
+
+class _Layout:
+    """The data section of a dex file laid out again, for code items that
+    changed in size.
+
+    The sections are placed in their original order, the code items and
+    class_data_items one by one (the latter are re-encoded as the offsets
+    of the code items change), all other sections as a whole.
+    """
+    def __init__(self, data, header, code_items):
+        self.data, self.header = data, header
+        self.code_items = code_items
+
+        count, = struct.unpack_from('<I', data, header.map_off)
+        self.map = sorted((struct.unpack_from('<HxxII', data,
+            header.map_off + 4 + x * 12) for x in xrange(count)),
+            key=lambda x: x[2])
+
+        # the items of the code and class data sections as (offset, end)
+        self.items = {_TYPE_CODE_ITEM: [], _TYPE_CLASS_DATA_ITEM: []}
+        self.class_data = {}
+        for typ, size, offset in self.map:
+            for _ in xrange(size if typ in self.items else 0):
+                if typ == _TYPE_CODE_ITEM:
+                    offset += -offset % 4
+                    end = _code_item_end(data, offset)
+                else:
+                    x = self.class_data[offset] = ClassData(data, offset)
+                    end = x.end
+                self.items[typ].append((offset, end))
+                offset = end
+
+        # old offset -> new offset for each of those items, starting off
+        # unchanged, then laid out again until the offsets are stable
+        self.moved = dict((x, x) for items in self.items.values()
+            for x, _ in items)
+        for _ in xrange(16):
+            moved = self.moved
+            self._place()
+            if self.moved == moved:
+                break
+        else:
+            raise Exception('Unable to lay out the data section')
+
+    def _class_data(self, offset):
+        # the re-encoded class_data_item at offset, None if the offsets of
+        # its code items did not change
+        x = self.class_data[offset]
+        code_offs = x.values[x.methods_start+2::3]
+        translated = [self.translate(y) for y in code_offs]
+        if translated == code_offs.tolist():
+            return None
+        values = x.values[:]
+        values[x.methods_start+2::3] = array('I', translated)
+        return ''.join(_uleb128x(x) for x in values)
+
+    def _place(self):
+        moved = {}
+        # pieces of the new data section as (offset, raw data or original
+        # offset, length), the sections which are moved as a whole as
+        # (original offset, original end, offset) and all data sections as
+        # (type, size, offset)
+        self.pieces, self.sections = [], []
+        self.blocks = [(0, self.header.data_off, 0)]
+
+        ends = [offset for _, _, offset in self.map[1:]] + \
+            [self.header.data_off + self.header.data_size]
+        cursor = self.header.data_off
+        for (typ, size, offset), end in zip(self.map, ends):
+            if offset < self.header.data_off:
+                continue
+
+            cursor += -cursor % (1 if typ in _unaligned_types else 4)
+            self.sections.append((typ, size, cursor))
+            if typ not in self.items:
+                self.blocks.append((offset, end, cursor))
+                self.pieces.append((cursor, offset, end - offset))
+                cursor += end - offset
+                continue
+
+            for offset, end in self.items[typ]:
+                if typ == _TYPE_CODE_ITEM:
+                    cursor += -cursor % 4
+                    raw = self.code_items.get(offset)
+                else:
+                    raw = self._class_data(offset)
+                moved[offset] = cursor
+                if raw is None:
+                    self.pieces.append((cursor, offset, end - offset))
+                    cursor += end - offset
+                else:
+                    self.pieces.append((cursor, raw, len(raw)))
+                    cursor += len(raw)
+
+        self.blocks.sort()
+        self._starts = [x[0] for x in self.blocks]
+        self.moved, self.size = moved, cursor
+
+    def translate(self, offset):
+        """Returns the new offset of something at offset originally."""
+        if not offset:
+            return 0
+        if offset in self.moved:
+            return self.moved[offset]
+        old, end, start = self.blocks[bisect.bisect_right(self._starts,
+            offset) - 1]
+        if end <= offset:
+            raise Exception('Offset 0x%x is not part of any section' %
+                offset)
+        return start + offset - old
+
+    def build(self):
+        data, header = self.data, self.header
+        buf = bytearray(self.size)
+        buf[:header.data_off] = buffer(data, 0, header.data_off)
+        for offset, raw, length in self.pieces:
+            if isinstance(raw, basestring):
+                buf[offset:offset+length] = raw
+            else:
+                buf[offset:offset+length] = buffer(data, raw, length)
+
+        def patch(offset, count=1, stride=4):
+            for offset in xrange(offset, offset + count * stride, stride):
+                value, = struct.unpack_from('<I', buf, offset)
+                struct.pack_into('<I', buf, offset, self.translate(value))
+
+        struct.pack_into('<I', buf, 32, self.size)
+        patch(52)
+        struct.pack_into('<I', buf, 104, self.size - header.data_off)
+        patch(header.string_ids_off, header.string_ids_size)
+        patch(header.proto_ids_off + 8, header.proto_ids_size, 12)
+        for x in (12, 20, 24, 28):
+            patch(header.class_defs_off + x, header.class_defs_size, 32)
+
+        for typ, size, offset in self.sections:
+            if typ == _TYPE_CALL_SITE_ID_ITEM:
+                patch(offset, size)
+            elif typ == _TYPE_MAP_LIST:
+                count, = struct.unpack_from('<I', buf, offset)
+                patch(offset + 12, count, 12)
+            elif typ in (_TYPE_ANNOTATION_SET_REF_LIST,
+                    _TYPE_ANNOTATION_SET_ITEM):
+                for _ in xrange(size):
+                    count, = struct.unpack_from('<I', buf, offset)
+                    patch(offset + 4, count)
+                    offset += 4 + count * 4
+            elif typ == _TYPE_ANNOTATIONS_DIRECTORY_ITEM:
+                for _ in xrange(size):
+                    patch(offset)
+                    count = sum(struct.unpack_from('<3I', buf, offset + 4))
+                    patch(offset + 20, count, 8)
+                    offset += 16 + count * 8
+
+        # the debug_info_off of the code items
+        for offset, _ in self.items[_TYPE_CODE_ITEM]:
+            patch(self.moved[offset] + 8)
+        return buf
 
 class DexFile:
-    def __init__(self, data):
-        self.root = _DexFile.parse(data)
-
-        def _str_(idx):
-            return self.root.string_id_item[idx]
-
-        def _proto_(idx):
-            return self.root.proto_id_item[idx]
-
-        def _desc_(idx):
-            if idx == NO_INDEX:
-                return 'Ljava/lang/Object;'
-            return self.root.type_id_item[idx]
+    def __init__(self, data, lazy=False, root=None):
+        """Parses a DexFile from a string or a memory-mapped file.
+
+        In lazy mode only the header and the id sections are parsed upfront,
+        class definitions, their class data and code items are parsed (and
+        cached) the first time they are accessed.
+
+        root are the structures parse() returned for the same data earlier
+        (e.g., from cache.py), in which case data isn't parsed again.
+        """
+        self.data = data
+        self._stream = data if isinstance(data, mmap.mmap) else BytesIO(data)
+        timing.count('dex.bytes', len(data))
+
+        with timing.span('dex.parse'):
+            if root is not None:
+                if lazy:
+                    raise Exception('A lazy DexFile has no parsed '
+                        'structures to start from')
+                # (the data section is read from this file's stream)
+                self.root = root
+                root.data = _data_section._parse(self._stream, root)
+            elif lazy:
+                self.root = _DexFileHeader.parse_stream(self._stream)
+                self.root.class_def_item = _LazyList(
+                    self.root.header.class_defs_size, self._class_def)
+            else:
+                self.root = _DexFile.parse_stream(self._stream)
+
+        with timing.span('dex.id_tables'):
+            resolve = self._resolvers()
+            for name, section, size, columns in _id_tables:
+                count = getattr(self.root.header, section + '_size')
+                self.root[name] = IdTable(name, data,
+                    getattr(self.root.header, section + '_off'), count,
+                    size, columns, resolve.get(name))
+                timing.count('dex.' + section, count)
 
         # simplify string_id_item
-        for idx, x in enumerate(self.root.string_id_item):
-            self.root.string_id_item[idx] = x.string_data_item.data
+        self.root.string_id_item = StringPool(data,
+            self.root.string_id_item.string_data_off)
 
         # resolve & simplify type_id_item
-        for idx, x in enumerate(self.root.type_id_item):
-            self.root.type_id_item[idx] = _str_(x.descriptor_idx)
-
-        # resolve proto_id_item
-        for x in self.root.proto_id_item:
-            x.shorty = _str_(x.shorty_idx)
-            x.return_type = _desc_(x.return_type_idx)
-
-        # resolve field_id_items
-        for x in self.root.field_id_item:
-            x.class_ = _desc_(x.class_idx)
-            x.type_ = _desc_(x.type_idx)
-            x.name = _str_(x.name_idx)
-
-        # resolve method_id_items
-        for x in self.root.method_id_item:
-            x.class_ = _desc_(x.class_idx)
-            x.proto = _proto_(x.proto_idx)
-            x.name = _str_(x.name_idx)
-
-            # resolve & simplify method_id_item.proto.parameters
-            if isinstance(x.proto.parameters, Container):
-                x.proto.parameters = [_desc_(y.type_idx)
-                    for y in x.proto.parameters.type_item]
+        with timing.span('dex.types'):
+            self.root.type_id_item = [self._str_(idx)
+                for idx in self.root.type_id_item.descriptor_idx]
+
+        # type_list items are shared between protos, the strings, types,
+        # fields, methods and protos referenced by instructions are shared
+        # between instructions
+        self._type_lists = {}
+        self._refs = {}
+        self._xrefs = None
 
         # resolve class_def_item
-        for x in self.root.class_def_item:
-            x.class_ = _desc_(x.class_idx)
-            x.superclass = _desc_(x.superclass_idx)
-            x.source_file = _str_(x.source_file_idx)
+        timing.count('dex.class_defs', self.root.header.class_defs_size)
+        if not lazy:
+            with timing.span('dex.class_defs'):
+                class_defs = self.root.class_def_item
+                for idx, x in enumerate(class_defs):
+                    x = class_defs[idx] = _LazyContainer(x,
+                        **self._class_values(x))
+                    self._resolve_class_def(x)
+                for _, x in self._code_item_list():
+                    self._resolve_code_item(x)
+
+    @staticmethod
+    def parse(data):
+        """Parses the structures of a (non-lazy) DexFile, i.e., its header,
+        class definitions, class data and code items, without resolving
+        anything."""
+        return _DexFile.parse_stream(data if isinstance(data, mmap.mmap)
+            else BytesIO(data))
+
+    @classmethod
+    def open(cls, fname, lazy=True):
+        """Memory-maps a DexFile, which is parsed lazily by default.
+
+        The mapping is released by close(), or at the end of a with block,
+        e.g., "with DexFile.open(fname) as d: ...".
+        """
+        with open(fname, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),
+                lazy=lazy)
+
+    def close(self):
+        """Unmaps a memory-mapped DexFile, which can't be used after."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def _str_(self, idx):
+        if idx == NO_INDEX:
+            return None
+        return self.root.string_id_item[idx]
+
+    def _proto_(self, idx):
+        return self.root.proto_id_item[idx]
+
+    def _desc_(self, idx):
+        if idx == NO_INDEX:
+            return 'Ljava/lang/Object;'
+        return self.root.type_id_item[idx]
+
+    def _parse_at(self, con, offset):
+        self._stream.seek(offset)
+        return con.parse_stream(self._stream)
+
+    def _resolve_proto(self, x):
+        x.shorty = self._str_(x.shorty_idx)
+        x.return_type = self._desc_(x.return_type_idx)
+        x.parameters = self._type_list(x.parameters_off)
+        x.descriptor = Descriptor.from_proto(x)
+
+    def _resolve_field(self, x):
+        x.class_ = self._desc_(x.class_idx)
+        x.type_ = self._desc_(x.type_idx)
+        x.name = self._str_(x.name_idx)
+
+    def _resolve_method(self, x):
+        x.class_ = self._desc_(x.class_idx)
+        x.proto = self._proto_(x.proto_idx)
+        x.name = self._str_(x.name_idx)
+
+    def _type_list(self, offset):
+        if not offset:
+            return None
+        if offset not in self._type_lists:
+            self._type_lists[offset] = [self._desc_(y.type_idx)
+                for y in self._parse_at(type_list, offset).type_item]
+        return self._type_lists[offset]
+
+    def _resolve_class_def(self, x):
+        x.class_ = self._desc_(x.class_idx)
+        x.superclass = self._desc_(x.superclass_idx)
+        x.source_file = self._str_(x.source_file_idx)
+
+    def _class_def(self, idx):
+        with timing.span('dex.class_def'):
+            return self._lazy_class_def(idx)
+
+    def _lazy_class_def(self, idx):
+        x = self._parse_at(_lazy_class_def_item,
+            self.root.header.class_defs_off + idx * 32)
+
+        off = x.interfaces_off
+        x = _LazyContainer(x,
+            interfaces=lambda: self._parse_at(type_list, off) if off
+                else None,
+            class_data_item=lambda: self._class_data(x.class_data_off),
+            **self._class_values(x))
+        self._resolve_class_def(x)
+        return x
+
+    def _class_values(self, x):
+        # loaders of the annotations and static values of a class def
+        def decode(name, decoder, offset):
+            if not offset:
+                return None
+            with timing.span(name):
+                return decoder(self.data, offset)[0]
+        return {
+            'annotations_directory_item': lambda: decode('dex.annotations',
+                _annotations_directory_item, x.annotations_off),
+            'static_values': lambda: decode('dex.static_values',
+                _encoded_array_item, x.static_values_off),
+        }
+
+    def annotations(self, offset):
+        """Decodes the annotation_set_item at offset, e.g., the
+        annotations_off of a field_annotation or method_annotation."""
+        with timing.span('dex.annotations'):
+            return _annotation_set_item(self.data, offset)[0]
+
+    def _class_data(self, offset):
+        if not offset:
+            return None
+
+        with timing.span('dex.class_data'):
+            x = self._parse_at(_lazy_class_data_item, offset)
+        for methods in (x.direct_methods, x.virtual_methods):
+            for idx, y in enumerate(methods):
+                methods[idx] = _LazyContainer(y,
+                    code_item=lambda off=y.code_off: self._code_item(off))
+        return x
+
+    def _code_item(self, offset):
+        if not offset:
+            return None
+        with timing.span('dex.code_item'):
+            x = self._parse_at(code_item, offset)
+        self._resolve_code_item(x)
+        return x
+
+    def _code_item_list(self):
+        # yields (code_off, code_item) for each code item parsed so far,
+        # i.e., all of them unless this is a lazy DexFile (dict.get() is
+        # used in order not to load anything)
+        class_defs = self.root.class_def_item
+        if isinstance(class_defs, _LazyList):
+            class_defs = filter(None, class_defs._items)
+
+        for x in class_defs:
+            class_data = dict.get(x, 'class_data_item')
+            if not class_data:
+                continue
+            for y in class_data.direct_methods + class_data.virtual_methods:
+                if dict.get(y, 'code_item'):
+                    yield y.code_off, y.code_item
+
+    def _resolve_code_item(self, x):
+        # the instructions are disassembled on first use
+        x.instructions = Instructions(x.insns, self._disassemble)
+
+    def _ref(self, kind, idx):
+        try:
+            return self._refs[kind, idx]
+        except KeyError:
+            pass
+
+        ret = None
+        if kind == 'string':
+            ret = self._str_(idx)
+        elif kind == 'type':
+            ret = self._desc_(idx)
+        elif kind in ('field', 'method', 'proto'):
+            ret = self.root[kind + '_id_item'][idx]
+        self._refs[kind, idx] = ret
+        return ret
+
+    def _disassemble(self, insns):
+        with timing.span('dex.disassemble'):
+            ret = disassemble(insns, self._ref)
+        timing.count('dex.instructions', len(ret))
+        return ret
+
+    def _rebuild_code_item(self, x):
+        """Re-encodes the instructions of a code item, if they were
+        disassembled and changed."""
+        if not x.instructions.loaded:
+            return False
+        insns = assemble(x.instructions)
+        if insns == x.insns:
+            return False
+        x.insns, x.insn_size = insns, len(insns)
+        return True
+
+    def _code_item_str(self, offset, insns):
+        # the code item at offset with its instructions replaced, the tries
+        # and handlers are kept as-is
+        data = self.data
+        tries, = struct.unpack_from('<H', data, offset + 6)
+        size, = struct.unpack_from('<I', data, offset + 12)
+        ret = data[offset:offset+12] + struct.pack('<I', len(insns)) + \
+            _code_units_str(insns)
+        if tries:
+            ret += '\x00\x00' * (len(insns) % 2) + data[offset+16+size*2+
+                size%2*2:_code_item_end(data, offset)]
+        return ret
+
+    def build0(self, fname=None):
+        """Rebuild the DexFile.
+
+        This function assumes only the instructions of code items are
+        altered. The tries and debug info of a code item are not updated,
+        so code items which have either can't change in size.
+
+        If no code item changed in size, the new instructions are patched
+        into a copy of the original file. Otherwise the data section is laid
+        out again and all offsets are updated accordingly. Either way the
+        checksum and signature are recomputed.
+        """
+        changed = {}
+        for offset, x in self._code_item_list():
+            self._rebuild_code_item(x)
+            if x.insns != self._insns(offset):
+                changed[offset] = x.insns
+
+        for offset, insns in changed.items():
+            if len(insns) == len(self._insns(offset)):
+                continue
+            tries, debug_info_off = struct.unpack_from('<HI', self.data,
+                offset + 6)
+            if tries or debug_info_off:
+                raise Exception('The code item at 0x%x changed in size but '
+                    'its tries and debug info would not be updated' %
+                    offset)
+
+        with timing.span('dex.rebuild'):
+            header = self.root.header
+            if all(len(insns) == len(self._insns(offset))
+                    for offset, insns in changed.items()):
+                buf = bytearray(self.data)
+                for offset, insns in changed.items():
+                    buf[offset+16:offset+16+len(insns)*2] = \
+                        _code_units_str(insns)
+            else:
+                if header.link_size:
+                    raise Exception('Relocating the link section of a '
+                        'DexFile is not supported')
+                buf = _Layout(self.data, header, dict((offset,
+                    self._code_item_str(offset, insns))
+                    for offset, insns in changed.items())).build()
+            _sign(buf)
+
+        buf = str(buf)
+        if fname:
+            file(fname, 'wb').write(buf)
+        return buf
+
+    def _code_items(self):
+        # yields (method_idx, code_off) for each method with code, straight
+        # from the raw class_def_item and class_data_item
+        header = self.root.header
+        class_defs = array('I', self.data[header.class_defs_off:
+            header.class_defs_off+header.class_defs_size*32])
+        if sys.byteorder != 'little':
+            class_defs.byteswap()
+
+        for offset in class_defs[6::8]:
+            if not offset:
+                continue
+            for method_idx, _, code_off in ClassData(self.data,
+                    offset).methods():
+                if code_off:
+                    yield method_idx, code_off
+
+    def _insns(self, code_off):
+        # the raw instructions of a code item as an array of code units
+        size, = struct.unpack('<I', self.data[code_off+12:code_off+16])
+        ret = array('H', self.data[code_off+16:code_off+16+size*2])
+        if sys.byteorder != 'little':
+            ret.byteswap()
+        return ret
+
+    def _resolvers(self):
+        return {
+            'proto_id_item': self._resolve_proto,
+            'field_id_item': self._resolve_field,
+            'method_id_item': self._resolve_method,
+        }
+
+    def xrefs(self):
+        """Returns the XrefIndex of this file, it's built on first use."""
+        if self._xrefs is None:
+            with timing.span('dex.xrefs'):
+                self._xrefs = XrefIndex(self)
+        return self._xrefs
 
     def __str__(self):
         return self.root.__str__()
 
 if __name__ == '__main__':
-    import sys, jsbeautifier
+    # the DexFile class of the dex module rather than that of __main__
+    import dex, export
     if len(sys.argv) < 2:
         print 'Usage: %s <dex-file>' % sys.argv[0]
         exit(0)
 
-    b = DexFile(open(sys.argv[1], 'rb').read())
-    a = b.root
-    print jsbeautifier.beautify(a.__str__())
+    with dex.DexFile.open(sys.argv[1]) as d:
+        export.export(d, export.JsonlWriter(sys.stdout), sys.argv[1])
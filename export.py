@@ -0,0 +1,208 @@
+"""Streaming export of DexFiles and ClassFiles as JSON lines or CSV tables.
+
+Rather than formatting the entire construct tree of a file, its classes,
+fields, methods, strings and instructions are decoded one class at a time
+(through model) and written out as flat records, so memory use doesn't grow
+with the size of the file, e.g.,
+
+    with dex.DexFile.open('classes.dex') as d:
+        export.export(d, export.JsonlWriter(sys.stdout), 'classes.dex')
+
+Each record belongs to one of the tables below and holds its columns, in
+order. With JsonlWriter every line is a JSON object with an additional
+"table" key, CsvWriter writes one CSV file per table instead.
+"""
+import csv
+import json
+import os
+from pyasm2 import java as _java
+
+import dex
+import java
+import model
+
+__all__ = ['TABLES', 'records', 'export', 'JsonlWriter', 'CsvWriter']
+
+TABLES = {
+    'class': ('file', 'name', 'superclass', 'interfaces', 'access_flags',
+        'source_file'),
+    'field': ('file', 'class', 'name', 'type', 'access_flags'),
+    'method': ('file', 'class', 'name', 'descriptor', 'access_flags',
+        'code_size'),
+    'string': ('file', 'idx', 'value'),
+    'instruction': ('file', 'class', 'method', 'descriptor', 'offset',
+        'opcode', 'mnemonic', 'index', 'ref'),
+}
+
+def _class_records(fname, x):
+    yield 'class', (fname, x.name, x.superclass, x.interfaces,
+        x.access_flags, x.source_file)
+    for y in x.fields:
+        yield 'field', (fname, x.name, y.name, y.type_, y.access_flags)
+    for y in x.methods:
+        yield 'method', (fname, x.name, y.name, y.descriptor,
+            y.access_flags, y.code_size)
+
+class _DexRefs:
+    """Formats the strings, types, fields and methods referenced by dex
+    instructions straight from the id tables, like DalvikInstruction does,
+    without resolving Containers for them. The formatted refs are cached
+    up to cache_size at a time."""
+    def __init__(self, d, cache_size=65536):
+        self.d, self.root = d, d.root
+        self.cache_size, self._cache = cache_size, {}
+
+    def __call__(self, kind, idx):
+        ret = self._cache.get((kind, idx))
+        if ret is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            ret = self._cache[kind, idx] = self._ref(kind, idx)
+        return ret
+
+    def _ref(self, kind, idx):
+        if kind == 'string':
+            return self.d._str_(idx)
+        if kind == 'type':
+            return self.d._desc_(idx)
+        types, strings = self.root.type_id_item, self.root.string_id_item
+        if kind == 'field':
+            x = self.root.field_id_item
+            return '%s->%s:%s' % (types[x.class_idx[idx]],
+                strings[x.name_idx[idx]], types[x.type_idx[idx]])
+        if kind == 'method':
+            x, protos = self.root.method_id_item, self.root.proto_id_item
+            proto = x.proto_idx[idx]
+            return '%s->%s(%s)%s' % (types[x.class_idx[idx]],
+                strings[x.name_idx[idx]], ''.join(self.d._type_list(
+                protos.parameters_off[proto]) or ()),
+                types[protos.return_type_idx[proto]])
+
+def _dex_records(fname, d, instructions):
+    for idx, value in enumerate(d.root.string_id_item):
+        yield 'string', (fname, idx, value)
+
+    ref = _DexRefs(d)
+    for x in model.iter_dex(d):
+        for record in _class_records(fname, x):
+            yield record
+        for y in x.methods if instructions else ():
+            for z in model.dex_instructions(d.data, y):
+                kind = dex.DALVIK_OPCODES[z.opcode][2]
+                yield 'instruction', (fname, x.name, y.name, y.descriptor,
+                    z.offset, z.opcode, dex.DALVIK_OPCODES[z.opcode][0],
+                    z.index, ref(kind, z.index) if z.index is not None
+                    else None)
+
+def _cp_str(pool, idx):
+    # formats a constant pool entry like _constant_pool_str() does
+    x = pool[idx]
+    if x is None:
+        return None
+    if x.tag in ('CONSTANT_Utf8', 'CONSTANT_Integer', 'CONSTANT_Float',
+            'CONSTANT_Long', 'CONSTANT_Double'):
+        return x.value
+    if x.tag in ('CONSTANT_Class', 'CONSTANT_String'):
+        return pool[x.value[0]].value
+    if x.tag == 'CONSTANT_NameAndType':
+        return '%s %s' % (pool[x.value[0]].value, pool[x.value[1]].value)
+    return '%s.%s' % (_cp_str(pool, x.value[0]),
+        _cp_str(pool, x.value[1]))
+
+def _class_file_records(fname, data, instructions):
+    x = model.load_class(data)
+    pool = x.constant_pool
+    for idx, y in enumerate(pool):
+        if y is not None and y.tag == 'CONSTANT_String':
+            yield 'string', (fname, idx, _cp_str(pool, idx))
+
+    for record in _class_records(fname, x):
+        yield record
+    for y in x.methods if instructions else ():
+        code = data[y.code_off:y.code_off+y.code_size]
+        offset = 0
+        while offset < len(code):
+            ins = _java.disassemble(code, offset)
+            yield 'instruction', (fname, x.name, y.name, y.descriptor,
+                offset, ord(code[offset]), ins.rep.split(' ', 1)[0],
+                ins.cp or None, _cp_str(pool, ins.cp) if ins.cp else None)
+            offset += ins.length
+
+def records(obj, fname=None, instructions=True):
+    """Yields (table, row) for everything in a DexFile, ClassFile or the
+    raw data of either, one class at a time. fname ends up in the file
+    column of each row."""
+    if isinstance(obj, java.ClassFile):
+        obj = obj.data
+    if isinstance(obj, dex.DexFile):
+        return _dex_records(fname, obj, instructions)
+    if obj[:4] == 'dex\n':
+        return _dex_records(fname, dex.DexFile(obj, lazy=True),
+            instructions)
+    if obj[:4] == '\xca\xfe\xba\xbe':
+        return _class_file_records(fname, obj, instructions)
+    raise Exception('Not a dex or class file')
+
+def export(obj, writer, fname=None, instructions=True):
+    """Writes all records of a DexFile, ClassFile or the raw data of either
+    to writer, returns the number of records written."""
+    count = 0
+    for table, row in records(obj, fname, instructions):
+        writer.write(table, row)
+        count += 1
+    return count
+
+def _text(value):
+    # the strings of dex files are (modified) utf8, which may be malformed
+    if isinstance(value, str):
+        return value.decode('utf8', 'replace')
+    return value
+
+_encoder = json.JSONEncoder()
+
+class JsonlWriter:
+    """Writes records as JSON lines to a file object."""
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, table, row):
+        record = dict(zip(TABLES[table], row), table=table)
+        try:
+            line = _encoder.encode(record)
+        except UnicodeDecodeError:
+            line = _encoder.encode(dict((key, _text(value))
+                for key, value in record.items()))
+        self.out.write(line + '\n')
+
+    def close(self):
+        self.out.flush()
+
+def _csv_value(value):
+    if isinstance(value, tuple):
+        value = ' '.join(value)
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+class CsvWriter:
+    """Writes records to one CSV file per table, <table>.csv in dirname,
+    starting with a header of the column names. Lists are written space
+    separated, unicode strings utf8 encoded."""
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._files, self._writers = {}, {}
+
+    def _writer(self, table):
+        if table not in self._writers:
+            f = open(os.path.join(self.dirname, table + '.csv'), 'wb')
+            self._files[table] = f
+            self._writers[table] = csv.writer(f)
+            self._writers[table].writerow(TABLES[table])
+        return self._writers[table]
+
+    def write(self, table, row):
+        self._writer(table).writerow(map(_csv_value, row))
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
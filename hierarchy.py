@@ -0,0 +1,199 @@
+"""Class hierarchy across many DexFiles and ClassFiles, e.g., all the
+classes*.dex files of an APK or all class files of a JAR.
+
+The superclass and interface graphs and the virtual method tables of all
+classes are built in a single pass on first use, after which queries such
+as resolving the target of an invoke-virtual or finding all overrides of a
+method are answered from these tables, e.g.,
+
+    h = Hierarchy(obj for _, obj in Archive('app.apk'))
+    h.resolve('Lcom/example/Foo;', 'run', '()V')
+
+Classes are loaded through model, i.e., they are identified by their names
+as stored in the file: type descriptors for dex files and internal names
+for class files. When a class is defined more than once, the first
+definition wins.
+"""
+import dex
+import java
+import model
+import timing
+
+__all__ = ['Hierarchy']
+
+ACC_PRIVATE = 0x0002
+ACC_STATIC = 0x0008
+
+def _virtual(method):
+    # constructors, static and private methods are not dispatched virtually
+    return not method.access_flags & (ACC_PRIVATE | ACC_STATIC) and \
+        method.name[0] != '<'
+
+class Hierarchy:
+    def __init__(self, objs=()):
+        """Indexes the classes of DexFiles, ClassFiles and/or lists of
+        model.ClassDefs."""
+        # class name -> ClassDef
+        self.classes = {}
+        self._subclasses = None
+        for obj in objs:
+            self.add(obj)
+
+    def add(self, obj):
+        """Adds the classes of a DexFile, ClassFile or list of
+        model.ClassDefs, the tables are built again on the next query."""
+        if isinstance(obj, dex.DexFile):
+            obj = model.iter_dex(obj)
+        elif isinstance(obj, java.ClassFile):
+            obj = [model.load_class(obj.data)]
+        for x in obj:
+            self.classes.setdefault(x.name, x)
+        self._subclasses = None
+
+    def _build(self):
+        if self._subclasses is not None:
+            return
+
+        with timing.span('hierarchy.build'):
+            # class name -> names of the classes directly extending it, and
+            # interface name -> names of the classes and interfaces directly
+            # implementing or extending it
+            self._subclasses, self._implementors = {}, {}
+            for x in self.classes.itervalues():
+                if x.superclass:
+                    self._subclasses.setdefault(x.superclass,
+                        []).append(x.name)
+                for y in x.interfaces:
+                    self._implementors.setdefault(y, []).append(x.name)
+
+            # class name -> {(name, descriptor): Method} of the virtual
+            # methods and of the interface methods respectively, tables
+            # which are equal to the one of the superclass are shared
+            self._vtables, self._itables = {}, {}
+            # Method -> Methods directly overriding or implementing it
+            self._overrides = {}
+            for name in self.classes:
+                self._vtable(name)
+        timing.count('hierarchy.classes', len(self.classes))
+
+    def _vtable(self, name):
+        # the superclasses are handled first, walking up the chain until a
+        # class that is done (or unknown) is found, guarding against cycles
+        chain = []
+        while name in self.classes and name not in self._vtables and \
+                name not in chain:
+            chain.append(name)
+            name = self.classes[name].superclass
+
+        table = self._vtables.get(name, {})
+        for name in reversed(chain):
+            itable = self._itable(name)
+            methods = filter(_virtual, self.classes[name].methods)
+            if methods:
+                table = dict(table)
+            for method in methods:
+                key = method.name, method.descriptor
+                for overridden in (table.get(key), itable.get(key)):
+                    if overridden is not None:
+                        self._overrides.setdefault(overridden,
+                            []).append(method)
+                table[key] = method
+            self._vtables[name] = table
+        return table
+
+    def _itable(self, name):
+        # the methods of all interfaces implemented by a class, the more
+        # specific interface wins if a method is declared more than once
+        if name in self._itables:
+            return self._itables[name]
+
+        x = self.classes.get(name)
+        # also guards against cyclic interfaces
+        self._itables[name] = table = {}
+        if x is None:
+            return table
+
+        if x.superclass:
+            table = self._itable(x.superclass)
+        if x.interfaces:
+            table = dict(table)
+        for y in x.interfaces:
+            table.update(self._itable(y))
+            if y in self.classes:
+                table.update(((m.name, m.descriptor), m)
+                    for m in self.classes[y].methods if _virtual(m))
+        self._itables[name] = table
+        return table
+
+    def __len__(self):
+        return len(self.classes)
+
+    def __contains__(self, name):
+        return name in self.classes
+
+    def __getitem__(self, name):
+        return self.classes[name]
+
+    def superclasses(self, name):
+        """Returns the names of the superclasses of a class, nearest first,
+        up to the first one which is not part of the hierarchy."""
+        ret, x = [], self.classes.get(name)
+        while x is not None and x.superclass and \
+                x.superclass not in ret + [name]:
+            ret.append(x.superclass)
+            x = self.classes.get(x.superclass)
+        return ret
+
+    def interfaces(self, name):
+        """Returns the names of all interfaces a class implements, directly
+        or through its superclasses and superinterfaces."""
+        ret, todo = [], [name] + self.superclasses(name)
+        while todo:
+            x = self.classes.get(todo.pop())
+            for y in x.interfaces if x is not None else ():
+                if y not in ret:
+                    ret.append(y)
+                    todo.append(y)
+        return ret
+
+    def _walk(self, node, *graphs):
+        # all nodes reachable from node through the graphs
+        ret, seen, todo = [], set([node]), [node]
+        while todo:
+            node = todo.pop()
+            for graph in graphs:
+                for x in graph.get(node, ()):
+                    if x not in seen:
+                        seen.add(x)
+                        ret.append(x)
+                        todo.append(x)
+        return ret
+
+    def subclasses(self, name):
+        """Returns the names of all classes extending a class, directly or
+        indirectly."""
+        self._build()
+        return self._walk(name, self._subclasses)
+
+    def subtypes(self, name):
+        """Returns the names of all classes and interfaces extending or
+        implementing a class or interface, directly or indirectly."""
+        self._build()
+        return self._walk(name, self._subclasses, self._implementors)
+
+    def resolve(self, class_, name, descriptor):
+        """Returns the Method an invoke-virtual or invoke-interface of
+        class_.name(descriptor) dispatches to for an instance of class_, or
+        None if it is not defined by any class in the hierarchy."""
+        self._build()
+        key = name, descriptor
+        return self._vtables.get(class_, {}).get(key) or \
+            self._itables.get(class_, {}).get(key)
+
+    def overrides(self, class_, name, descriptor):
+        """Returns all Methods overriding or implementing the method which
+        class_.name(descriptor) resolves to, directly or indirectly."""
+        method = self.resolve(class_, name, descriptor)
+        if method is None:
+            return []
+        return self._walk(method, self._overrides)
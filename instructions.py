@@ -0,0 +1,60 @@
+"""Lazily disassembled instructions, shared by ClassFile and DexFile."""
+import collections
+
+__all__ = ['Instructions']
+
+class Instructions(collections.MutableSequence):
+    """The instructions of a method, disassembled on first use.
+
+    Behaves like a list, however, the method is only disassembled once its
+    instructions are actually accessed, by calling disassemble(code). Until
+    then code holds the raw code.
+
+    version is bumped whenever an instruction is set, removed or inserted,
+    so the state of the instructions can be told apart cheaply.
+    """
+    def __init__(self, code, disassemble):
+        self.code = code
+        self._disassemble = disassemble
+        self._list = None
+        self.version = 0
+
+    @property
+    def loaded(self):
+        return self._list is not None
+
+    def _items(self):
+        if self._list is None:
+            self._list = self._disassemble(self.code)
+            self._disassemble = self.code = None
+        return self._list
+
+    def __getitem__(self, idx):
+        return self._items()[idx]
+
+    def __setitem__(self, idx, value):
+        self._items()[idx] = value
+        self.version += 1
+
+    def __delitem__(self, idx):
+        del self._items()[idx]
+        self.version += 1
+
+    def __len__(self):
+        return len(self._items())
+
+    def __iter__(self):
+        return iter(self._items())
+
+    def __nonzero__(self):
+        # a method always has code, no need to disassemble for this
+        return self._list is None or bool(self._list)
+
+    def insert(self, idx, value):
+        self._items().insert(idx, value)
+        self.version += 1
+
+    def __repr__(self):
+        if self._list is None:
+            return '<instructions, not disassembled>'
+        return repr(self._list)
@@ -1,16 +1,43 @@
 from construct import *
 from pyasm2 import java
-import copy
+import collections
+import multiprocessing
+import re
+import struct
 
-__all__ = ['ClassFile', 'JavaMangler', 'Descriptor']
+from instructions import Instructions
+import timing
 
-class _JavaType:
+__all__ = ['ClassFile', 'ConstantPool', 'Instructions', 'JavaMangler',
+    'Descriptor', 'JAVA_OPCODES', 'Label', 'Branch', 'Switch', 'label',
+    'assemble']
+
+class _JavaType(object):
+    """A field type, e.g., "[I", interned and immutable like Descriptors."""
     def __init__(self, depth):
-        self.depth = depth
+        self.__dict__['depth'] = depth
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Java types are immutable')
 
     def __str__(self):
         return '[' * self.depth + self.typ
 
+    def __eq__(self, other):
+        if isinstance(other, (_JavaType, basestring)):
+            return str(self) == other.__str__()
+        return NotImplemented
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __reduce__(self):
+        return _interned, (str(self),)
+
 class _SignedByte(_JavaType): typ = 'B'
 class _UnicodeChar(_JavaType): typ = 'C'
 class _Double(_JavaType): typ = 'D'
@@ -24,54 +51,188 @@ class _Boolean(_JavaType): typ = 'Z'
 class _ClassName(_JavaType):
     typ = 'L'
     def __init__(self, clazz, depth):
-        self.clazz = clazz
-        self.depth = depth
+        self.__dict__.update(clazz=clazz, depth=depth)
 
     def __str__(self):
         return '[' * self.depth + 'L' + self.clazz + ';'
 
-class Descriptor:
-    def __init__(self, s):
-        assert s[0] == '('
-        params, ret = s[1:].split(')')
-
-        table = {
-            'B': _SignedByte, 'C': _UnicodeChar, 'D': _Double, 'F': _Float,
-            'I': _Int, 'J': _Long, 'S': _SignedShort, 'V': _Void,
-            'Z': _Boolean,
-        }
-
-        self.params = []
-        for y in params.split(';'):
-            depth = 0
-            for x in xrange(len(y)):
-                if y[x] == '[':
-                    depth += 1
-                elif y[x] == 'L':
-                    self.params.append(_ClassName(y[x+1:], depth))
-                    break
-                else:
-                    self.params.append(table[y[x]](depth))
-                    depth = 0
+_base_types = {
+    'B': _SignedByte, 'C': _UnicodeChar, 'D': _Double, 'F': _Float,
+    'I': _Int, 'J': _Long, 'S': _SignedShort, 'V': _Void, 'Z': _Boolean,
+}
 
-        depth = 0
-        while ret[depth] == '[':
-            depth += 1
+# a (possibly array) field type, a method descriptor and any type
+_field_type = r'\[*(?:L[^;]+;|[BCDFIJSZ])'
+_field_type_re = re.compile(_field_type)
+_descriptor_re = re.compile(r'\(((?:%s)*)\)(%s|V)$' % (_field_type,
+    _field_type))
+_type_re = re.compile(r'(?:%s|V)$' % _field_type)
 
-        if ret[depth] == 'L':
-            self.ret = _ClassName(ret[depth+1:][:-1], depth)
-        else:
-            self.ret = table[ret[depth]](depth)
+def _parse(s):
+    if s[:1] == '(':
+        m = _descriptor_re.match(s)
+        if m is None:
+            raise ValueError
+        obj = object.__new__(Descriptor)
+        object.__setattr__(obj, '_params', tuple(map(_interned,
+            _field_type_re.findall(m.group(1)))))
+        object.__setattr__(obj, 'ret', _interned(m.group(2)))
+        object.__setattr__(obj, '_str', s)
+        return obj
+
+    if not _type_re.match(s):
+        raise ValueError
+    depth = len(s) - len(s.lstrip('['))
+    if s[depth] == 'L':
+        return _ClassName(s[depth+1:-1], depth)
+    return _base_types[s[depth]](depth)
+
+# descriptor string -> Descriptor or _JavaType, a bounded cache in two
+# generations approximating LRU: entries used since the young generation was
+# started survive once it's full and becomes the old one
+_young, _old, _cache_size = {}, {}, 65536
+
+def _interned(s):
+    # returns the (cached) Descriptor or field type for a descriptor string
+    global _young, _old
+    ret = _young.get(s)
+    if ret is not None:
+        return ret
+
+    ret = _old.get(s)
+    if ret is None:
+        try:
+            ret = _parse(s)
+        except (IndexError, KeyError, ValueError):
+            raise Exception('Invalid descriptor: %r' % s)
+    _young[s] = ret
+    if len(_young) >= _cache_size:
+        _old, _young = _young, {}
+    return ret
+
+class Descriptor(object):
+    """A method descriptor, e.g., "(ILjava/lang/String;)V".
+
+    Descriptor(s) returns the same (immutable) object for recurring
+    descriptors through a bounded cache. Descriptors compare and hash
+    equal to their string, so either can be used as a dict key. Use
+    replace() for a descriptor with other parameters or return type.
+    """
+    __slots__ = '_params', 'ret', '_str'
+
+    def __new__(cls, s):
+        if isinstance(s, Descriptor):
+            return s
+        ret = _interned(s)
+        if not isinstance(ret, Descriptor):
+            raise Exception('Invalid method descriptor: %r' % s)
+        return ret
+
+    @classmethod
+    def from_proto(cls, proto):
+        """Returns the Descriptor of a resolved dex proto_id_item."""
+        return cls('(%s)%s' % (''.join(proto.parameters or ()),
+            proto.return_type))
+
+    @property
+    def params(self):
+        """The parameter types, as a new list every time."""
+        return list(self._params)
+
+    @property
+    def shorty(self):
+        """The dex shorty form, e.g., "VIL" for "(ILjava/lang/String;)V"."""
+        return ''.join('L' if x.depth else x.typ
+            for x in (self.ret,) + self._params)
+
+    def replace(self, params=None, ret=None):
+        """Returns the Descriptor with the given parameter types and/or
+        return type (as types or strings) instead, e.g.,
+        d.replace(params=d.params + ['I'])."""
+        if params is None:
+            params = self._params
+        if ret is None:
+            ret = self.ret
+        return Descriptor('(%s)%s' % (''.join(map(str, params)), ret))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Descriptors are immutable')
+
+    def __eq__(self, other):
+        if isinstance(other, (Descriptor, basestring)):
+            return self._str == other.__str__()
+        return NotImplemented
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    def __hash__(self):
+        return hash(self._str)
+
+    def __reduce__(self):
+        return Descriptor, (self._str,)
 
     def __repr__(self):
         table = {'B': 'byte', 'C': 'char', 'D': 'double', 'F': 'float',
             'I': 'int', 'J': 'long', 'S': 'short', 'V': 'void', 'Z': 'bool'}
         f = lambda x: x.clazz if x.typ == 'L' else table[x.typ]
         g = lambda x: f(x) + '[]' * x.depth
-        return '%s (%s)' % (g(self.ret), ', '.join(map(g, self.params)))
+        return '%s (%s)' % (g(self.ret), ', '.join(map(g, self._params)))
 
     def __str__(self):
-        return '(%s)%s' % (''.join(map(str, self.params)), self.ret)
+        return self._str
+
+def _typed(prefixes, *names):
+    return [x + y for x in prefixes for y in names]
+
+# Java opcode mnemonics, indexed by opcode
+JAVA_OPCODES = (['nop', 'aconst_null', 'iconst_m1'] +
+    _typed('i', *['const_%d' % x for x in xrange(6)]) +
+    _typed('l', 'const_0', 'const_1') +
+    _typed('f', 'const_0', 'const_1', 'const_2') +
+    _typed('d', 'const_0', 'const_1') +
+    ['bipush', 'sipush', 'ldc', 'ldc_w', 'ldc2_w'] +
+    _typed('ilfda', 'load') +
+    _typed('ilfda', 'load_0', 'load_1', 'load_2', 'load_3') +
+    _typed('ilfdabcs', 'aload') +
+    _typed('ilfda', 'store') +
+    _typed('ilfda', 'store_0', 'store_1', 'store_2', 'store_3') +
+    _typed('ilfdabcs', 'astore') +
+    ['pop', 'pop2', 'dup', 'dup_x1', 'dup_x2', 'dup2', 'dup2_x1',
+        'dup2_x2', 'swap'] +
+    [x + y for y in ('add', 'sub', 'mul', 'div', 'rem', 'neg')
+        for x in 'ilfd'] +
+    [x + y for y in ('shl', 'shr', 'ushr', 'and', 'or', 'xor')
+        for x in 'il'] +
+    ['iinc', 'i2l', 'i2f', 'i2d', 'l2i', 'l2f', 'l2d', 'f2i', 'f2l', 'f2d',
+        'd2i', 'd2l', 'd2f', 'i2b', 'i2c', 'i2s', 'lcmp', 'fcmpl', 'fcmpg',
+        'dcmpl', 'dcmpg'] +
+    _typed(['if'], 'eq', 'ne', 'lt', 'ge', 'gt', 'le') +
+    _typed(['if_icmp'], 'eq', 'ne', 'lt', 'ge', 'gt', 'le') +
+    ['if_acmpeq', 'if_acmpne', 'goto', 'jsr', 'ret', 'tableswitch',
+        'lookupswitch'] +
+    _typed('ilfda', 'return') +
+    ['return', 'getstatic', 'putstatic', 'getfield', 'putfield',
+        'invokevirtual', 'invokespecial', 'invokestatic', 'invokeinterface',
+        'invokedynamic', 'new', 'newarray', 'anewarray', 'arraylength',
+        'athrow', 'checkcast', 'instanceof', 'monitorenter', 'monitorexit',
+        'wide', 'multianewarray', 'ifnull', 'ifnonnull', 'goto_w', 'jsr_w',
+        'breakpoint'] +
+    ['unused-%02x' % x for x in xrange(0xcb, 0xfe)] +
+    ['impdep1', 'impdep2'])
+
+assert len(JAVA_OPCODES) == 256
+
+_opcodes = dict((name, op) for op, name in enumerate(JAVA_OPCODES))
+
+def _opcode(op):
+    # the opcode of a mnemonic, opcodes are returned as-is
+    if isinstance(op, basestring):
+        if op not in _opcodes:
+            raise Exception('Unknown mnemonic: %s' % op)
+        return _opcodes[op]
+    return op
 
 def _cstringify(s, maxlen):
     s = s[:min(len(s), maxlen)]
@@ -172,30 +333,528 @@ FieldInfo = Struct('FieldInfo',
     MetaArray(lambda ctx: ctx.attributes_count, AttributeInfo))
 
 MethodInfo = Struct('MethodInfo',
+    Anchor('_start'),
     UBInt16('access_flags'),
     UBInt16('name_index'),
     UBInt16('descriptor_index'),
     UBInt16('attributes_count'),
-    MetaArray(lambda ctx: ctx.attributes_count, AttributeInfo))
+    MetaArray(lambda ctx: ctx.attributes_count, AttributeInfo),
+    Anchor('_end'))
+
+# the fields of each constant pool entry that end up in the class file
+_constant_pool_fields = {
+    'CONSTANT_Class': ('name_index',),
+    'CONSTANT_Fieldref': ('class__index', 'name_and_type_index'),
+    'CONSTANT_Methodref': ('class__index', 'name_and_type_index'),
+    'CONSTANT_InterfaceMethodref': ('class__index', 'name_and_type_index'),
+    'CONSTANT_String': ('string_index',),
+    'CONSTANT_Integer': ('value',),
+    'CONSTANT_Float': ('value',),
+    'CONSTANT_Long': ('value',),
+    'CONSTANT_Double': ('value',),
+    'CONSTANT_NameAndType': ('name_index', 'descriptor_index'),
+    'CONSTANT_Utf8': ('value',),
+}
+
+def _constant_pool_key(x):
+    return (x.tag,) + tuple(x[y] for y in _constant_pool_fields[x.tag])
+
+# 0.0 and -0.0 (and NaNs) would not be told apart by the index
+_unindexed = 'CONSTANT_Float', 'CONSTANT_Double'
+
+class ConstantPool:
+    """The constant pool of a ClassFile, indexed by slot number.
+
+    Slot 0 and the slot following each Long and Double entry are unusable
+    (according to the specification these types take two entries) and
+    hold None. Iterating the pool yields the actual entries only.
+
+    The find_or_add_*() methods return the slot of an existing entry with
+    the given value, or append a new (resolved) entry. They go through an
+    index of the entries by tag and value, which is built on first use.
+    Entries should be altered through update() from then on, in order to
+    keep the index up-to-date.
+    """
+    def __init__(self):
+        self.slots = [None]
+        self.entries = []
+
+        # the location of each parsed entry in the class file and the
+        # values it was parsed with, in order to find out what changed
+        self._offsets = []
+        self._original = []
+
+        # _constant_pool_key() -> slot of the first such entry, and the keys
+        # of which that entry was updated, which are looked up again
+        self._index = None
+        self._stale = set()
 
-def _constant_pool_count(obj, ctx):
-    if not hasattr(ctx, '_constant_pool_count'):
-        ctx._constant_pool_count = ctx.constant_pool_count-1
+        # the number of entries appended or updated since parsing
+        self._changes = 0
 
-    ctx._constant_pool_count -= 1
+    def append(self, x, offset=None):
+        """Appends an entry and returns its slot number."""
+        slot = len(self.slots)
+        if offset is None:
+            self._changes += 1
+        self.slots.append(x)
+        self.entries.append(x)
+        if x.tag[9:] in ('Long', 'Double'):
+            self.slots.append(None)
+        if offset is not None:
+            self._offsets.append(offset)
+            self._original.append(_constant_pool_key(x))
+        self._add_index(x, slot)
+        return slot
 
-    # Long and Double types take two spots..
-    if obj.tag[9:] in ('Long', 'Double'):
-        ctx._constant_pool_count -= 1
+    def _add_index(self, x, slot):
+        if self._index is not None and x.tag not in _unindexed:
+            key = _constant_pool_key(x)
+            if key not in self._stale and \
+                    self._index.get(key, slot) >= slot:
+                self._index[key] = slot
 
-    return not ctx._constant_pool_count
+    def _build_index(self):
+        self._index, self._stale = {}, set()
+        for slot, x in enumerate(self.slots):
+            if x is not None and x.tag not in _unindexed:
+                self._index.setdefault(_constant_pool_key(x), slot)
+
+    def find(self, tag, *values):
+        """Returns the slot of the first entry with the given tag and field
+        values (see _constant_pool_fields), or None."""
+        if self._index is None:
+            self._build_index()
+        key = (tag,) + values
+        if key in self._stale:
+            # the first such entry was updated, there may be another one
+            self._stale.remove(key)
+            for slot, x in enumerate(self.slots):
+                if x is not None and x.tag == tag and \
+                        _constant_pool_key(x) == key:
+                    self._index[key] = slot
+                    break
+        return self._index.get(key)
+
+    def _find_or_add(self, tag, *values):
+        slot = self.find(tag, *values)
+        if slot is not None:
+            return slot
+
+        if len(self.slots) + (tag in ('CONSTANT_Long',
+                'CONSTANT_Double')) >= 0x10000:
+            raise Exception('The constant pool is full')
+
+        # resolved the same way ClassFile does, i.e., each foo_index field
+        # is accompanied by a foo field referring to the entry itself
+        x = Container(tag=tag)
+        for field, value in zip(_constant_pool_fields[tag], values):
+            x[field] = value
+            if field.endswith('_index'):
+                x[field[:-6]] = self.slots[value]
+        return self.append(x)
+
+    def update(self, slot, **fields):
+        """Alters the fields of the entry in the given slot."""
+        x = self.slots[slot]
+        self._changes += 1
+        if self._index is not None and x.tag not in _unindexed:
+            key = _constant_pool_key(x)
+            if self._index.get(key) == slot:
+                del self._index[key]
+                self._stale.add(key)
+        x.update(fields)
+        for field in fields:
+            if field.endswith('_index'):
+                x[field[:-6]] = self.slots[x[field]]
+        self._add_index(x, slot)
+
+    def find_or_add_utf8(self, value):
+        if not isinstance(value, unicode):
+            value = value.decode('utf8')
+        return self._find_or_add('CONSTANT_Utf8', value)
+
+    def find_or_add_class(self, name):
+        return self._find_or_add('CONSTANT_Class',
+            self.find_or_add_utf8(name))
+
+    def find_or_add_string(self, value):
+        return self._find_or_add('CONSTANT_String',
+            self.find_or_add_utf8(value))
+
+    def find_or_add_integer(self, value):
+        return self._find_or_add('CONSTANT_Integer', value)
+
+    def find_or_add_long(self, value):
+        return self._find_or_add('CONSTANT_Long', value)
+
+    def find_or_add_name_and_type(self, name, descriptor):
+        return self._find_or_add('CONSTANT_NameAndType',
+            self.find_or_add_utf8(name), self.find_or_add_utf8(descriptor))
+
+    def _find_or_add_ref(self, tag, class_, name, descriptor):
+        return self._find_or_add(tag, self.find_or_add_class(class_),
+            self.find_or_add_name_and_type(name, descriptor))
+
+    def find_or_add_fieldref(self, class_, name, descriptor):
+        return self._find_or_add_ref('CONSTANT_Fieldref', class_, name,
+            descriptor)
+
+    def find_or_add_methodref(self, class_, name, descriptor):
+        return self._find_or_add_ref('CONSTANT_Methodref', class_, name,
+            descriptor)
+
+    def find_or_add_interface_methodref(self, class_, name, descriptor):
+        return self._find_or_add_ref('CONSTANT_InterfaceMethodref', class_,
+            name, descriptor)
+
+    def changed(self, idx):
+        """Returns whether the idx'th entry (not slot) differs from the
+        class file it was parsed from."""
+        return idx >= len(self._original) or \
+            _constant_pool_key(self.entries[idx]) != self._original[idx]
+
+    def build(self, data):
+        """Serializes the constant pool, copying unchanged entries from the
+        original class file data."""
+        ret = []
+        for idx, x in enumerate(self.entries):
+            if self.changed(idx):
+                if x.tag == 'CONSTANT_Utf8':
+                    x = Container(tag=x.tag, value=_utf8_encode(x.value))
+                ret.append(ConstantPoolInfo.build(x))
+            else:
+                ret.append(data[self._offsets[idx][0]:self._offsets[idx][1]])
+        return ''.join(ret)
+
+    def __getitem__(self, slot):
+        return self.slots[slot]
+
+    def __len__(self):
+        """Returns the number of slots, i.e., the constant_pool_count."""
+        return len(self.slots)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __pretty_str__(self, nesting=1, indentation='    '):
+        return ListContainer(self.entries).__pretty_str__(nesting,
+            indentation)
+
+    __str__ = __pretty_str__
+
+def _utf8_decode(value):
+    # Java encodes "\x00" as "\xc0\x80" in order to prevent null-bytes in
+    # the strings, but this is an illegal encoding according to the utf8
+    # standards, so we have to decode those manually
+    return value.replace('\xc0\x80', '\x00').decode('utf8')
+
+def _utf8_encode(value):
+    return value.encode('utf8').replace('\x00', '\xc0\x80')
+
+class _ConstantPool(Construct):
+    """Parses the constant pool straight into a ConstantPool."""
+    def _parse(self, stream, context):
+        ret = ConstantPool()
+        while len(ret) < context.constant_pool_count:
+            start = stream.tell()
+            x = ConstantPoolInfo._parse(stream, context)
+            if x.tag == 'CONSTANT_Utf8':
+                x.value = _utf8_decode(x.value)
+            ret.append(x, (start, stream.tell()))
+        return ret
+
+    def _build(self, obj, stream, context):
+        for x in obj:
+            if x.tag == 'CONSTANT_Utf8':
+                x = Container(tag=x.tag, value=_utf8_encode(x.value))
+            ConstantPoolInfo._build(x, stream, context)
+
+    def _sizeof(self, context):
+        raise SizeofError('the constant pool is variable-length')
+
+# the if*, goto and jsr instructions with a 16-bit offset, and goto_w and
+# jsr_w with a 32-bit one
+_GOTO, _JSR, _GOTO_W, _JSR_W = 0xa7, 0xa8, 0xc8, 0xc9
+_TABLESWITCH, _LOOKUPSWITCH = 0xaa, 0xab
+_branches = frozenset(range(0x99, 0xa9) + [0xc6, 0xc7])
+_long_branches = frozenset([_GOTO_W, _JSR_W])
+
+def _inverse(op):
+    # ifeq <-> ifne, iflt <-> ifge, ..., ifnull <-> ifnonnull
+    if op >= 0xc6:
+        return op ^ 1
+    return 0x99 + (op - 0x99 ^ 1)
+
+class Label(object):
+    """A position in the instructions of a method, the target of Branches,
+    Switches and exception table entries. Takes up no space."""
+    code, length, cp = '', 0, None
+
+    def __init__(self, name='label'):
+        self.name = name
+        self.rep = name + ':'
+
+    def __str__(self):
+        return self.rep
+
+    __repr__ = __str__
+
+class Branch(object):
+    """An if*, goto or jsr instruction (or goto_w, jsr_w) to a Label.
+
+    Its offset is resolved by assemble(), until then code is the
+    instruction branching to itself."""
+    cp = None
+
+    def __init__(self, op, target):
+        op = _opcode(op)
+        if op not in _branches and op not in _long_branches:
+            raise Exception('Not a branch instruction: %s' %
+                JAVA_OPCODES[op])
+        self.op, self.target = op, target
+        self.code = chr(op) + '\x00' * (4 if op in _long_branches else 2)
+        self.length = len(self.code)
+
+    @property
+    def rep(self):
+        return '%s %s' % (JAVA_OPCODES[self.op], self.target.name)
+
+    def __str__(self):
+        return self.rep
+
+    __repr__ = __str__
+
+class Switch(object):
+    """A tableswitch, of which targets is the list of Labels for the values
+    low, low + 1, ..., or a lookupswitch, of which targets is the list of
+    (value, Label) pairs.
+
+    Its padding and offsets are resolved by assemble(), until then code is
+    the instruction at offset zero branching to itself."""
+    cp = None
+
+    def __init__(self, op, default, targets, low=0):
+        op = _opcode(op)
+        if op not in (_TABLESWITCH, _LOOKUPSWITCH):
+            raise Exception('Not a switch instruction: %s' %
+                JAVA_OPCODES[op])
+        self.op, self.default, self.targets, self.low = \
+            op, default, targets, low
+
+    @property
+    def code(self):
+        return _switch(self, 0, collections.defaultdict(int))
+
+    @property
+    def length(self):
+        return _switch_size(self, 0)
+
+    @property
+    def rep(self):
+        if self.op == _TABLESWITCH:
+            targets = enumerate(self.targets, self.low)
+        else:
+            targets = self.targets
+        return '%s %s' % (JAVA_OPCODES[self.op], ', '.join(['%d: %s' % (
+            x, y.name) for x, y in targets] + ['default: %s' %
+            self.default.name]))
+
+    def __str__(self):
+        return self.rep
+
+    __repr__ = __str__
+
+_symbolic = frozenset([Label, Branch, Switch])
+
+def _switch_size(x, offset):
+    return 1 + (3 - offset) % 4 + (12 + 4 * len(x.targets)
+        if x.op == _TABLESWITCH else 8 + 8 * len(x.targets))
+
+def _switch(x, offset, labels):
+    # encodes a Switch at offset, of which the offsets are 4-byte aligned
+    head = chr(x.op) + '\x00' * ((3 - offset) % 4)
+    if x.op == _TABLESWITCH:
+        return head + struct.pack('>3i%di' % len(x.targets),
+            labels[x.default] - offset, x.low, x.low + len(x.targets) - 1,
+            *[labels[y] - offset for y in x.targets])
+    pairs = []
+    for value, y in sorted(x.targets, key=lambda y: y[0]):
+        pairs += value, labels[y] - offset
+    return head + struct.pack('>2i%di' % len(pairs),
+        labels[x.default] - offset, len(x.targets), *pairs)
+
+_pcs = 'start_pc', 'end_pc', 'handler_pc'
+
+def _exception(values):
+    # an exception table entry from its start_pc, end_pc, handler_pc and
+    # catch_type
+    ret = Container()
+    for key, value in zip(_pcs + ('catch_type',), values):
+        ret[key] = value
+    return ret
+
+def label(instructions, exception_table=()):
+    """Returns the instructions with a Label at every branch target and
+    Branches and Switches in place of the branch instructions, and the
+    exception table with Labels in place of its offsets.
+
+    Instructions may then be inserted, removed and moved around freely,
+    assemble() (and thus ClassFile.build0()) resolves the offsets again.
+    """
+    with timing.span('class.label'):
+        return _label(instructions, exception_table)
+
+def _label(instructions, exception_table):
+    # offset -> Label
+    labels = {}
+    def at(offset):
+        if offset not in labels:
+            labels[offset] = Label('L%d' % offset)
+        return labels[offset]
+
+    converted, offset = [], 0
+    for x in instructions:
+        code = x.code
+        op = ord(code[0])
+        if op in _branches:
+            x = Branch(op, at(offset + struct.unpack('>h', code[1:3])[0]))
+        elif op in _long_branches:
+            x = Branch(op, at(offset + struct.unpack('>i', code[1:5])[0]))
+        elif op == _TABLESWITCH or op == _LOOKUPSWITCH:
+            x = _label_switch(op, code, offset, at)
+        converted.append((offset, x))
+        offset += len(code)
+
+    table = [_exception([at(x[y]) for y in _pcs] + [x.catch_type])
+        for x in exception_table]
+
+    ret = []
+    for offset, x in converted + [(offset, None)]:
+        if offset in labels:
+            ret.append(labels.pop(offset))
+        if x is not None:
+            ret.append(x)
+    if labels:
+        raise Exception('Branch to the middle of an instruction: %d' %
+            min(labels))
+    return ret, table
+
+def _label_switch(op, code, offset, at):
+    p = 1 + (3 - offset) % 4
+    if op == _TABLESWITCH:
+        default, low, high = struct.unpack('>3i', code[p:p+12])
+        count = high - low + 1
+        targets = struct.unpack('>%di' % count, code[p+12:p+12+4*count])
+        return Switch(op, at(offset + default),
+            [at(offset + x) for x in targets], low)
+
+    default, count = struct.unpack('>2i', code[p:p+8])
+    pairs = struct.unpack('>%di' % (2 * count), code[p+8:p+8+8*count])
+    return Switch(op, at(offset + default), [(pairs[x],
+        at(offset + pairs[x+1])) for x in xrange(0, 2 * count, 2)])
+
+def assemble(instructions, exception_table=()):
+    """Encodes the instructions of a method, resolving Labels.
+
+    Returns the code and the exception table with the offsets of its
+    Labels (the very same exception table if it has none). Branches too far
+    from their target for a 16-bit offset are widened: goto and jsr to
+    goto_w and jsr_w, if* to the inverse if* over a goto_w.
+    """
+    if isinstance(instructions, Instructions) and not instructions.loaded:
+        return instructions.code, exception_table
+    with timing.span('class.assemble'):
+        return _assemble(instructions, exception_table)
+
+def _assemble(instructions, exception_table):
+    # the symbolic instructions and the code preceding each of them, only
+    # the former are laid out (again, after widening branches)
+    symbols, chunks, chunk = [], [], []
+    for x in instructions:
+        if x.__class__ in _symbolic:
+            symbols.append(x)
+            chunks.append(''.join(chunk))
+            chunk = []
+        else:
+            chunk.append(x.code)
+    tail = ''.join(chunk)
+    sizes = map(len, chunks)
+
+    # indices of the Branches that need a 32-bit offset, which only grows,
+    # i.e., this is done after one layout unless methods get rather large
+    wide = set()
+    while True:
+        # Label -> offset, and the offset of each symbolic instruction
+        labels, offsets, offset = {}, [], 0
+        for idx, x in enumerate(symbols):
+            offset += sizes[idx]
+            offsets.append(offset)
+            cls = x.__class__
+            if cls is Label:
+                labels[x] = offset
+            elif cls is Switch:
+                offset += _switch_size(x, offset)
+            elif idx in wide:
+                offset += 5 if x.op in (_GOTO, _JSR) else 8
+            else:
+                offset += x.length
+
+        try:
+            grown = False
+            for idx, x in enumerate(symbols):
+                if x.__class__ is Branch and x.op in _branches and \
+                        idx not in wide and not -0x8000 <= \
+                        labels[x.target] - offsets[idx] < 0x8000:
+                    wide.add(idx)
+                    grown = True
+            if not grown:
+                break
+        except KeyError as e:
+            raise Exception('Label not part of the instructions: %s' %
+                e.args[0].name)
+
+    ret = []
+    try:
+        for idx, x in enumerate(symbols):
+            ret.append(chunks[idx])
+            cls, offset = x.__class__, offsets[idx]
+            if cls is Switch:
+                ret.append(_switch(x, offset, labels))
+            elif cls is Branch:
+                delta = labels[x.target] - offset
+                if x.op in _long_branches:
+                    ret.append(struct.pack('>Bi', x.op, delta))
+                elif idx not in wide:
+                    ret.append(struct.pack('>Bh', x.op, delta))
+                elif x.op in (_GOTO, _JSR):
+                    ret.append(struct.pack('>Bi', _GOTO_W if x.op == _GOTO
+                        else _JSR_W, delta))
+                else:
+                    ret.append(struct.pack('>BhBi', _inverse(x.op), 8,
+                        _GOTO_W, delta - 3))
+        ret.append(tail)
+
+        table = exception_table
+        if any(x[y].__class__ is Label for x in table for y in _pcs):
+            table = [_exception([labels[x[y]] if x[y].__class__ is Label
+                else x[y] for y in _pcs] + [x.catch_type]) for x in table]
+    except KeyError as e:
+        raise Exception('Label not part of the instructions: %s' %
+            e.args[0].name)
+
+    code = ''.join(ret)
+    if len(code) > 0xffff:
+        raise Exception('The code of a method is limited to 65535 bytes')
+    return code, table
 
 _ClassFile = Struct('ClassFile',
     Magic('\xca\xfe\xba\xbe'),
     UBInt16('minor_version'),
     UBInt16('major_version'),
     UBInt16('constant_pool_count'),
-    RepeatUntil(_constant_pool_count, ConstantPoolInfo),
+    _ConstantPool('ConstantPoolInfo'),
+    Anchor('_constant_pool_end'),
     UBInt16('access_flags'),
     UBInt16('this_class_index'),
     UBInt16('super_class_index'),
@@ -203,39 +862,56 @@ _ClassFile = Struct('ClassFile',
     MetaArray(lambda ctx: ctx.interfaces_count, UBInt16('interfaces')),
     UBInt16('fields_count'),
     MetaArray(lambda ctx: ctx.fields_count, FieldInfo),
+    Anchor('_methods_start'),
     UBInt16('methods_count'),
     MetaArray(lambda ctx: ctx.methods_count, MethodInfo),
+    Anchor('_methods_end'),
     UBInt16('attributes_count'),
     MetaArray(lambda ctx: ctx.attributes_count, AttributeInfo))
 
+def _unchanged(table, original):
+    # whether an exception table equals the one a method was parsed with
+    fields = _pcs + ('catch_type',)
+    return len(table) == len(original) and all(x[y] == z[y]
+        for x, z in zip(table, original) for y in fields)
+
 class ClassFile:
-    def __init__(self, data):
-        """Parses a Java ClassFile"""
+    def __init__(self, data, root=None):
+        """Parses a Java ClassFile
+
+        root are the structures parse() returned for the same data earlier
+        (e.g., from cache.py), in which case data isn't parsed again.
+        """
         # parse the main structures in the file
-        self.root = _ClassFile.parse(data)
-
-        # fix the constant pool, each entry that has the type Long or Double
-        # needs to be appended with another element (we'll just set it to
-        # None), because the specification is that these types take two
-        # entries
-        for idx, x in enumerate(self.root.ConstantPoolInfo):
-            if x.tag[9:] in ('Long', 'Double'):
-                # CONSTANT_None is a non-existant type.. made up to fix this
-                # weird feature of the specification
-                self.root.ConstantPoolInfo.insert(idx+1,
-                    Container(tag='CONSTANT_None'))
-
-            # we have to manually decode the strings in the Constant Pool
-            # because Java encodes "\x00" as "\xc0\x80" in order to prevent
-            # null-bytes in the strings, but this is an illegal encoding
-            # according to the utf8 standards
-            if x.tag[9:] == 'Utf8':
-                x.value = x.value.replace('\xc0\x80', '\x00').decode('utf8')
+        self.data = data
+        timing.count('class.bytes', len(data))
+        if root is None:
+            with timing.span('class.parse'):
+                root = self.parse(data)
+        self.root = root
+        timing.count('class.constants',
+            len(self.root.ConstantPoolInfo.entries))
+        timing.count('class.methods', self.root.methods_count)
+        with timing.span('class.resolve'):
+            self._resolve()
+
+    @staticmethod
+    def parse(data):
+        """Parses the structures of a class file, including the Code
+        attributes of its methods, without resolving anything."""
+        root = _ClassFile.parse(data)
+        pool = root.ConstantPoolInfo
+        for x in root.MethodInfo:
+            for y in x.AttributeInfo:
+                if pool[y.attribute_name_index].value == 'Code':
+                    y.attribute = CodeAttribute.parse(y.info)
+        return root
 
+    def _resolve(self):
         # resolves an entry from the Constant Pool
         def resolve_cp(obj, key, typ):
             idx = getattr(obj, key + '_index')
-            val = self.root.ConstantPoolInfo[idx-1]
+            val = self.root.ConstantPoolInfo[idx]
             assert val.tag[9:] == typ
             setattr(obj, key, val)
 
@@ -270,88 +946,242 @@ class ClassFile:
 
                 # bit hardcoded, but oke
                 if y.attribute_name.value == 'Code':
-                    y.attribute = CodeAttribute.parse(y.info)
-
                     # resolve CodeAttribute.AttributeInfo
                     for z in y.attribute.AttributeInfo:
                         resolve_cp(z, 'attribute_name', 'Utf8')
 
-                    # disassemble the entire function
-                    y.instructions = [] ; offset = 0
-                    while offset < y.attribute.code_length:
-                        ins = java.disassemble(y.attribute.code, offset)
-                        if ins.cp:
-                            ins.cp = self.root.ConstantPoolInfo[ins.cp-1]
-                            ins.rep += ' ; ' + _constant_pool_str(ins.cp)
-                        offset += ins.length
-                        y.instructions.append(ins)
+                    # the function is disassembled on first use
+                    # y.attribute is kept as parsed, to tell whether the
+                    # method changed, the exception table may be altered
+                    y.instructions = Instructions(y.attribute.code,
+                        self._disassemble)
+                    y.exception_table = [z.copy()
+                        for z in y.attribute.exception_table]
 
         # resolve ClassFile.AttributeInfo
         for x in self.root.AttributeInfo:
             resolve_cp(x, 'attribute_name', 'Utf8')
 
+    def _disassemble(self, code):
+        with timing.span('class.disassemble'):
+            ret = self._disassemble_code(code)
+        timing.count('class.instructions', len(ret))
+        return ret
+
+    def _disassemble_code(self, code):
+        ret, offset = [], 0
+        while offset < len(code):
+            ins = java.disassemble(code, offset)
+            if ins.cp:
+                ins.cp = self.root.ConstantPoolInfo[ins.cp]
+                ins.rep += ' ; ' + _constant_pool_str(ins.cp)
+            offset += ins.length
+            ret.append(ins)
+        return ret
+
     def build0(self, fname=None):
         """Rebuild the ClassFile.
 
-        This function assumes only the instructions of methods are altered.
-        (Does not support a modified exception table by default.)
-        """
-        # duplicate the object, so we can alter it without destroying the
-        # original
-        root = copy.deepcopy(self.root)
-
-        for idx, x in enumerate(root.ConstantPoolInfo):
-            # restore utf8 strings
-            if x.tag[9:] == 'Utf8':
-                x.value = x.value.encode('utf8').replace('\x00', '\xc0\x80')
-            # delete None constants
-            if x.tag[9:] == 'None':
-                del root.ConstantPoolInfo[idx]
-
-        # rebuild all methods
-        for x in root.MethodInfo:
-            for y in x.AttributeInfo:
-                if y.attribute_name.value == 'Code':
-                    y.attribute.code = ''.join(z.code for z in y.instructions)
-                    y.attribute.code_length = len(y.attribute.code)
-                    y.info = CodeAttribute.build(y.attribute)
-                    y.attribute_length = len(y.info)
+        This function assumes only the instructions of methods, their
+        exception tables and the constant pool are altered. Any Labels in
+        either are resolved, see label() and assemble().
 
-        # build the new ClassFile
-        buf = _ClassFile.build(root)
+        Only the modified constant pool entries and methods are encoded,
+        everything else is copied from the original class file.
+        """
+        with timing.span('class.rebuild'):
+            buf = self._build()
         if fname:
             file(fname, 'wb').write(buf)
         return buf
 
+    def _build(self):
+        root, data = self.root, self.data
+
+        buf = [data[:8], struct.pack('>H', len(root.ConstantPoolInfo)),
+            root.ConstantPoolInfo.build(data),
+            data[root._constant_pool_end:root._methods_start],
+            data[root._methods_start:root._methods_start+2]]
+
+        for x in root.MethodInfo:
+            if self._rebuild_method(x):
+                buf.append(MethodInfo.build(x))
+            else:
+                buf.append(data[x._start:x._end])
+
+        buf.append(data[root._methods_end:])
+        return ''.join(buf)
+
+    def _rebuild_method(self, x):
+        """Re-encodes the modified Code attribute of a method, if any.
+
+        The original Code attribute of a method is kept as-is if it was never
+        disassembled or if neither its code nor its exception table differ
+        from the class file it was parsed from.
+        """
+        ret = False
+        for y in x.AttributeInfo:
+            if y.attribute_name.value != 'Code':
+                continue
+
+            code, table = assemble(y.instructions, y.exception_table)
+            if code == y.attribute.code and _unchanged(table,
+                    y.attribute.exception_table):
+                continue
+
+            # (a copy, y.attribute remains the original)
+            attribute = y.attribute.copy()
+            attribute.code = code
+            attribute.code_length = len(code)
+            attribute.exception_table = table
+            attribute.exception_table_length = len(table)
+            y.info = CodeAttribute.build(attribute)
+            y.attribute_length = len(y.info)
+            ret = True
+        return ret
+
     def __str__(self):
         return self.root.__str__()
 
+# the JavaMangler (and its arguments) in forked worker processes
+_worker = None
+
+class _Serial(Exception):
+    """Raised by update_descriptor() in a worker process, as the methods
+    following the one being mangled have to see the update."""
+
+def _mangle_method(idx):
+    self, args = _worker
+    self._forked = True
+    return self._mangle_worker(idx, args)
+
 class JavaMangler:
+    # number of processes to mangle methods with, None to mangle serially
+    processes = None
+    # a peephole.Peephole applied to each method after mangle(), if any,
+    # which requires labels (as its rewrites move instructions around)
+    peephole = None
+    # whether mangle() gets the instructions with Labels, Branches and
+    # Switches (and the exception table with Labels) rather than as
+    # disassembled, see label()
+    labels = False
+
     def __init__(self, fname, *args):
+        if self.peephole is not None and not self.labels:
+            raise Exception('A peephole requires labels, or its rewrites '
+                'would break the branch offsets and exception tables')
+
         self.root = ClassFile(open(fname, 'rb').read())
+        self._forked = False
 
-        for x in self.root.root.MethodInfo:
-            for y in x.AttributeInfo:
-                y.instructions = self.mangle(x.name.value,
-                    Descriptor(x.descriptor.value), y.instructions, x,
-                    *args) or y.instructions
+        if self.processes and self.__class__.update_descriptor.im_func is \
+                JavaMangler.update_descriptor.im_func:
+            self._mangle_parallel(args)
+        else:
+            for x in self.root.root.MethodInfo:
+                self._mangle(x, args)
 
         self.root.build0(fname)
 
+    def _mangle(self, x, args):
+        for y in x.AttributeInfo:
+            if y.attribute_name.value != 'Code':
+                continue
+
+            instructions = y.instructions
+            if self.labels:
+                instructions, y.exception_table = label(instructions,
+                    y.exception_table)
+            y.instructions = self.mangle(x.name.value,
+                Descriptor(x.descriptor.value), instructions, x,
+                *args) or instructions
+            if self.peephole is not None:
+                y.instructions = self.peephole.apply(y.instructions)
+
+    def _mangle_worker(self, idx, args):
+        # mangles a single method in a worker process, returns the new code
+        # and exception table of its Code attributes, or None if it altered
+        # the constant pool
+        x = self.root.root.MethodInfo[idx]
+        pool = self.root.root.ConstantPoolInfo
+        changes = pool._changes
+        try:
+            self._mangle(x, args)
+        except _Serial:
+            return None
+        if pool._changes != changes:
+            return None
+
+        ret = []
+        for attr, y in enumerate(x.AttributeInfo):
+            if y.attribute_name.value == 'Code':
+                code, table = assemble(y.instructions, y.exception_table)
+                if code != y.attribute.code or not _unchanged(table,
+                        y.attribute.exception_table):
+                    # (as tuples, Containers don't pickle as-is)
+                    ret.append((attr, code, [(z.start_pc, z.end_pc,
+                        z.handler_pc, z.catch_type) for z in table]))
+        return ret
+
+    def _mangle_parallel(self, args):
+        """Mangles the methods over a pool of forked worker processes.
+
+        The methods are mangled independently, but with the same result as
+        when mangled serially. That is, the first method which alters the
+        constant pool (e.g., through update_descriptor()) and all methods
+        following it are mangled (again) serially, as they may depend on
+        it. Any other changes mangle() makes to anything other than the
+        returned instructions are lost. (This relies on fork(), i.e., the
+        workers inherit the parsed ClassFile rather than receiving a copy of
+        it.)
+        """
+        global _worker
+        methods = self.root.root.MethodInfo
+
+        _worker = self, args
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            results = pool.map(_mangle_method, xrange(len(methods)),
+                max(1, len(methods) / self.processes / 4))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker = None
+
+        for x, codes in zip(methods, results):
+            if codes is None:
+                break
+            for attr, code, table in codes:
+                y = x.AttributeInfo[attr]
+                y.instructions = Instructions(code,
+                    self.root._disassemble)
+                y.exception_table = map(_exception, table)
+
+        if None in results:
+            for x in methods[results.index(None):]:
+                self._mangle(x, args)
+
     def mangle(self, name, descriptor, instructions, method_info):
         pass
 
     def update_descriptor(self, descriptor, value):
-        for x in self.root.root.ConstantPoolInfo:
-            if x.tag[9:] == 'Utf8' and x.value == descriptor.__str__():
-                x.value = value.__str__()
-                return
-        raise Exception('unknown descriptor: ' + descriptor)
+        pool = self.root.root.ConstantPoolInfo
+        if self._forked:
+            # (counted as a change in case mangle() swallows the exception)
+            pool._changes += 1
+            raise _Serial
+
+        slot = pool.find('CONSTANT_Utf8', descriptor.__str__())
+        if slot is None:
+            raise Exception('unknown descriptor: %s' % descriptor)
+        pool.update(slot, value=value.__str__())
 
 if __name__ == '__main__':
-    import sys, jsbeautifier
+    import sys
     a = ClassFile(file(sys.argv[1], 'rb').read())
-    #print jsbeautifier.beautify(a.__str__())
     for x in a.root.MethodInfo:
         print 'function: %s, descriptor: %s' % (x.name.value,
             x.descriptor.value)
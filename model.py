@@ -0,0 +1,281 @@
+"""Compact, read-only object model of DexFile and ClassFile contents.
+
+DexFile and ClassFile expose construct Containers, which are convenient but
+take several hundred bytes per item. The classes in this module use
+__slots__ instead and are decoded straight from the raw bytes, strings
+(names, descriptors) are shared between all items referencing them. This is
+meant for holding many (multi-dex) applications in memory at once, use
+DexFile and ClassFile to inspect or modify a single file.
+
+Class names are kept as stored in the file, i.e., type descriptors
+("Lcom/example/Foo;") for dex files and internal names ("com/example/Foo")
+for class files. Methods refer to their raw instructions through code_off
+and code_size, which are decoded into Instructions on request.
+"""
+from array import array
+from pyasm2 import java as _java
+import struct
+import sys
+
+import dex
+import java
+
+__all__ = ['ClassDef', 'Field', 'Method', 'CpEntry', 'Instruction',
+    'load_dex', 'iter_dex', 'load_class', 'dex_instructions',
+    'java_instructions']
+
+class ClassDef(object):
+    __slots__ = ('name', 'superclass', 'interfaces', 'access_flags',
+        'source_file', 'fields', 'methods', 'constant_pool')
+
+    def __init__(self, name, superclass, interfaces, access_flags,
+            source_file, fields, methods, constant_pool=None):
+        self.name, self.superclass = name, superclass
+        self.interfaces, self.access_flags = interfaces, access_flags
+        self.source_file = source_file
+        self.fields, self.methods = fields, methods
+        self.constant_pool = constant_pool
+
+    def __repr__(self):
+        return '<class %s, %d fields, %d methods>' % (self.name,
+            len(self.fields), len(self.methods))
+
+class Field(object):
+    __slots__ = 'class_', 'name', 'type_', 'access_flags'
+
+    def __init__(self, class_, name, type_, access_flags):
+        self.class_, self.name = class_, name
+        self.type_, self.access_flags = type_, access_flags
+
+    def __repr__(self):
+        return '<field %s.%s %s>' % (self.class_, self.name, self.type_)
+
+class Method(object):
+    """A method, code_off and code_size give the location of its raw
+    instructions in the file (both are zero for methods without code)."""
+    __slots__ = ('class_', 'name', 'descriptor', 'access_flags', 'code_off',
+        'code_size')
+
+    def __init__(self, class_, name, descriptor, access_flags, code_off=0,
+            code_size=0):
+        self.class_, self.name = class_, name
+        self.descriptor, self.access_flags = descriptor, access_flags
+        self.code_off, self.code_size = code_off, code_size
+
+    def __repr__(self):
+        return '<method %s.%s %s>' % (self.class_, self.name,
+            self.descriptor)
+
+class CpEntry(object):
+    """A constant pool entry, value is the constant itself for Utf8,
+    Integer, Float, Long and Double entries and a tuple of slot numbers
+    for all other entries."""
+    __slots__ = 'tag', 'value'
+
+    def __init__(self, tag, value):
+        self.tag, self.value = tag, value
+
+    def __repr__(self):
+        return '<%s %r>' % (self.tag, self.value)
+
+class Instruction(object):
+    """A decoded instruction, offset and length are in code units for
+    Dalvik (bytes for Java), index is the string/type/field/method (or
+    constant pool) index the instruction refers to, if any."""
+    __slots__ = 'offset', 'opcode', 'length', 'index'
+
+    def __init__(self, offset, opcode, length, index=None):
+        self.offset, self.opcode = offset, opcode
+        self.length, self.index = length, index
+
+    def __repr__(self):
+        return '<instruction 0x%02x at %d>' % (self.opcode, self.offset)
+
+def load_dex(data):
+    """Returns a list of ClassDefs for each class defined in a dex file."""
+    return list(iter_dex(dex.DexFile(data, lazy=True)))
+
+def iter_dex(d):
+    """Yields a ClassDef for each class defined in a (lazy) DexFile, one at a
+    time, straight from its raw class definitions and class data."""
+    data, root, header = d.data, d.root, d.root.header
+    strings, types = root.string_id_item, root.type_id_item
+    field_ids, method_ids = root.field_id_item, root.method_id_item
+    protos = root.proto_id_item
+
+    # descriptors are shared by all methods with the same proto
+    descriptors = {}
+    def descriptor(idx):
+        if idx not in descriptors:
+            descriptors[idx] = intern('(%s)%s' % (''.join(
+                d._type_list(protos.parameters_off[idx]) or ()),
+                types[protos.return_type_idx[idx]]))
+        return descriptors[idx]
+
+    class_defs = array('I', data[header.class_defs_off:
+        header.class_defs_off+header.class_defs_size*32])
+    if sys.byteorder != 'little':
+        class_defs.byteswap()
+
+    for off in xrange(0, len(class_defs), 8):
+        class_idx, access_flags, superclass_idx, interfaces_off, \
+            source_file_idx, _, class_data_off, _ = class_defs[off:off+8]
+
+        fields, methods = [], []
+        if class_data_off:
+            class_data = dex.ClassData(data, class_data_off)
+            for field_idx, flags in class_data.fields():
+                fields.append(Field(types[field_ids.class_idx[field_idx]],
+                    strings[field_ids.name_idx[field_idx]],
+                    types[field_ids.type_idx[field_idx]], flags))
+
+            for method_idx, flags, code_off in class_data.methods():
+                code_size = 0
+                if code_off:
+                    code_size, = struct.unpack('<I',
+                        data[code_off+12:code_off+16])
+                    code_off, code_size = code_off + 16, code_size * 2
+                methods.append(Method(types[method_ids.class_idx[method_idx]],
+                    strings[method_ids.name_idx[method_idx]],
+                    descriptor(method_ids.proto_idx[method_idx]), flags,
+                    code_off, code_size))
+
+        yield ClassDef(types[class_idx], d._desc_(superclass_idx),
+            tuple(d._type_list(interfaces_off) or ()), access_flags,
+            d._str_(source_file_idx), fields, methods)
+
+# the format of the non-Utf8 constant pool entries, by tag
+_cp_formats = {
+    3: ('CONSTANT_Integer', struct.Struct('>i')),
+    4: ('CONSTANT_Float', struct.Struct('>f')),
+    5: ('CONSTANT_Long', struct.Struct('>q')),
+    6: ('CONSTANT_Double', struct.Struct('>d')),
+    7: ('CONSTANT_Class', struct.Struct('>H')),
+    8: ('CONSTANT_String', struct.Struct('>H')),
+    9: ('CONSTANT_Fieldref', struct.Struct('>HH')),
+    10: ('CONSTANT_Methodref', struct.Struct('>HH')),
+    11: ('CONSTANT_InterfaceMethodref', struct.Struct('>HH')),
+    12: ('CONSTANT_NameAndType', struct.Struct('>HH')),
+}
+
+_u2, _u4, _member = struct.Struct('>H'), struct.Struct('>I'), \
+    struct.Struct('>4H')
+
+def _attributes(data, offset):
+    # yields (name_index, offset of the info) for each attribute, followed
+    # by the offset right after the attributes
+    count, = _u2.unpack_from(data, offset)
+    offset += 2
+    for _ in xrange(count):
+        name_index, = _u2.unpack_from(data, offset)
+        length, = _u4.unpack_from(data, offset + 2)
+        yield name_index, offset + 6
+        offset += 6 + length
+    yield None, offset
+
+def load_class(data):
+    """Returns the ClassDef of a class file."""
+    if data[:4] != '\xca\xfe\xba\xbe':
+        raise Exception('Invalid class file magic')
+
+    count, = _u2.unpack_from(data, 8)
+    pool, offset = [None], 10
+    while len(pool) < count:
+        tag = ord(data[offset])
+        if tag == 1:
+            length, = _u2.unpack_from(data, offset + 1)
+            pool.append(CpEntry('CONSTANT_Utf8',
+                java._utf8_decode(data[offset+3:offset+3+length])))
+            offset += 3 + length
+            continue
+
+        if tag not in _cp_formats:
+            raise Exception('Unknown constant pool tag: %d' % tag)
+        name, fmt = _cp_formats[tag]
+        value = fmt.unpack_from(data, offset + 1)
+        pool.append(CpEntry(name, value if tag >= 7 else value[0]))
+        offset += 1 + fmt.size
+        # Long and Double entries take two slots
+        if tag in (5, 6):
+            pool.append(None)
+
+    def utf8(idx):
+        return pool[idx].value if idx else None
+
+    def class_name(idx):
+        return utf8(pool[idx].value[0]) if idx else None
+
+    access_flags, this, super_, interfaces = \
+        struct.unpack_from('>4H', data, offset)
+    offset += 8
+    name = class_name(this)
+    interfaces = tuple(class_name(x) for x in
+        struct.unpack_from('>%dH' % interfaces, data, offset))
+    offset += 2 * len(interfaces)
+
+    fields_count, = _u2.unpack_from(data, offset)
+    fields, offset = [], offset + 2
+    for _ in xrange(fields_count):
+        flags, name_index, descriptor_index, _ = \
+            _member.unpack_from(data, offset)
+        fields.append(Field(name, utf8(name_index), utf8(descriptor_index),
+            flags))
+        for _, offset in _attributes(data, offset + 6):
+            pass
+
+    methods_count, = _u2.unpack_from(data, offset)
+    methods, offset = [], offset + 2
+    for _ in xrange(methods_count):
+        flags, name_index, descriptor_index, _ = \
+            _member.unpack_from(data, offset)
+        code_off = code_size = 0
+        for attr, offset in _attributes(data, offset + 6):
+            if attr is not None and utf8(attr) == 'Code':
+                code_size, = _u4.unpack_from(data, offset + 4)
+                code_off = offset + 8
+        methods.append(Method(name, utf8(name_index),
+            utf8(descriptor_index), flags, code_off, code_size))
+
+    source_file = None
+    for attr, offset in _attributes(data, offset):
+        if attr is not None and utf8(attr) == 'SourceFile':
+            source_file = utf8(_u2.unpack_from(data, offset)[0])
+
+    return ClassDef(name, class_name(super_), interfaces, access_flags,
+        source_file, fields, methods, pool)
+
+def dex_instructions(data, method):
+    """Decodes the instructions of a Method from a dex file. Payloads
+    (switch tables and array data) are skipped."""
+    insns = array('H', data[method.code_off:method.code_off+method.code_size])
+    if sys.byteorder != 'little':
+        insns.byteswap()
+
+    ret, pc, count = [], 0, len(insns)
+    while pc < count:
+        op = insns[pc] & 0xff
+        if not op and insns[pc] > 0xff:
+            pc += dex._payload_length(insns, pc)
+            continue
+
+        length, kind, wide = dex._insn_info[op]
+        index = None
+        if kind:
+            index = insns[pc+1]
+            if wide:
+                index |= insns[pc+2] << 16
+        ret.append(Instruction(pc, op, length, index))
+        pc += length
+    return ret
+
+def java_instructions(data, method):
+    """Decodes the instructions of a Method from a class file, index being
+    the constant pool slot referenced by the instruction (if any)."""
+    code = data[method.code_off:method.code_off+method.code_size]
+    ret, offset = [], 0
+    while offset < len(code):
+        ins = _java.disassemble(code, offset)
+        ret.append(Instruction(offset, ord(code[offset]), ins.length,
+            ins.cp or None))
+        offset += ins.length
+    return ret
@@ -0,0 +1,186 @@
+"""Peephole rewriting of the instructions of Java methods.
+
+A Rule is a sequence of instruction patterns and what to replace the
+matching instructions with. Each pattern matches an opcode (a mnemonic, an
+opcode, a list of either, or None for any instruction) and optionally the
+constant pool entry the instruction refers to, e.g.,
+
+    p = Peephole([
+        Rule([Ins('ldc_w'), Ins('pop')], []),
+        Rule([Ins('ldc', cp=lambda x: x.tag == 'CONSTANT_String'),
+            Ins('invokestatic', cp='a/B.decrypt (Ljava/lang/String;)'
+            'Ljava/lang/String;')], decrypt),
+    ])
+    instructions = p.apply(instructions)
+
+All rules are compiled into a single automaton over opcodes (Aho-Corasick
+style, with wildcards), of which the states are built as they are first
+needed and shared by all methods the Peephole is applied to. Each method is
+scanned once, the constant pool and other predicates are only evaluated for
+the instructions of a candidate match. JavaMangler.peephole applies one to
+every method after mangle(), which requires JavaMangler.labels.
+
+Branch offsets are only kept intact for instructions with Labels (see
+java.label() and JavaMangler.labels), in which case matches never span a
+Label, i.e., a branch target.
+"""
+import java
+import timing
+
+__all__ = ['Ins', 'Rule', 'Peephole']
+
+def _cp_value(x):
+    # the value a cp pattern is compared against, see Ins
+    if x.tag in ('CONSTANT_Integer', 'CONSTANT_Float', 'CONSTANT_Long',
+            'CONSTANT_Double'):
+        return x.value
+    if x.tag == 'CONSTANT_String':
+        return x.string.value
+    return java._constant_pool_str(x)
+
+class Ins:
+    def __init__(self, op=None, cp=None, where=None):
+        """Matches an instruction with the given opcode(s), constant pool
+        entry and for which where(instruction) is true.
+
+        cp is either the value of the entry (the string of a String, the
+        name of a Class, "class.name descriptor" of a field or method ref,
+        the number of a numeric constant) or a predicate on the resolved
+        entry, instructions without an entry never match it.
+        """
+        if op is not None and not isinstance(op, (list, tuple, set,
+                frozenset)):
+            op = op,
+        self.opcodes = None if op is None else frozenset(map(java._opcode,
+            op))
+        self.cp, self.where = cp, where
+
+    def matches(self, ins):
+        if self.cp is not None:
+            if not ins.cp:
+                return False
+            if callable(self.cp):
+                if not self.cp(ins.cp):
+                    return False
+            elif _cp_value(ins.cp) != self.cp:
+                return False
+        return self.where is None or self.where(ins)
+
+    def __repr__(self):
+        if self.opcodes is None:
+            return '<ins *>'
+        return '<ins %s>' % '|'.join(sorted(java.JAVA_OPCODES[x]
+            for x in self.opcodes))
+
+class Rule:
+    def __init__(self, pattern, replace):
+        """Replaces instructions matching the pattern, a list of Ins.
+
+        replace is either the list of instructions to replace them with or
+        a function which is called with the matched instructions and
+        returns such a list, or None to leave them as-is.
+        """
+        if not pattern:
+            raise Exception('A rule needs at least one instruction')
+        self.pattern, self.replace = list(pattern), replace
+
+    def rewrite(self, instructions):
+        if callable(self.replace):
+            return self.replace(instructions)
+        return list(self.replace)
+
+class Peephole:
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        # the states of the automaton, each being the set of partially
+        # matched rules as (rule, position) and the rules that matched
+        # completely when entering it, longest first: state -> id
+        self._states = {}
+        # id -> partially matched rules, {opcode: id} and matched rules
+        self._positions, self._transitions, self._accepts = [], [], []
+        self._start = self._state(frozenset(), ())
+
+    def _state(self, positions, accepts):
+        key = positions, accepts
+        if key not in self._states:
+            self._states[key] = len(self._transitions)
+            self._positions.append(positions)
+            self._transitions.append({})
+            self._accepts.append(accepts)
+        return self._states[key]
+
+    def _step(self, state, op):
+        # builds the transition from state for opcode op, matching may start
+        # at any instruction
+        following, accepts = set(), []
+        for rule, pos in self._positions[state].union((x, 0)
+                for x in xrange(len(self.rules))):
+            opcodes = self.rules[rule].pattern[pos].opcodes
+            if opcodes is not None and op not in opcodes:
+                continue
+            if pos + 1 == len(self.rules[rule].pattern):
+                accepts.append(rule)
+            else:
+                following.add((rule, pos + 1))
+
+        accepts.sort(key=lambda x: (-len(self.rules[x].pattern), x))
+        ret = self._transitions[state][op] = self._state(
+            frozenset(following), tuple(accepts))
+        return ret
+
+    def apply(self, instructions):
+        """Returns the rewritten instructions, or the very same instructions
+        if nothing changed.
+
+        A match is rewritten as soon as its last instruction is seen (the
+        longest one, if several end there, then the first rule) and
+        matching resumes after it, i.e., replacements are not matched
+        again within the same pass.
+        """
+        with timing.span('class.peephole'):
+            return self._apply(instructions)
+
+    def _apply(self, instructions):
+        transitions, accepts = self._transitions, self._accepts
+        ret, state, changed = [], self._start, False
+        for ins in instructions:
+            ret.append(ins)
+            if not ins.code:
+                # a Label, matches don't span branch targets
+                state = self._start
+                continue
+            op = ord(ins.code[0])
+            following = transitions[state].get(op)
+            if following is None:
+                following = self._step(state, op)
+            state = following
+            for idx in accepts[state]:
+                rule = self.rules[idx]
+                count = len(rule.pattern)
+                matched = ret[-count:]
+                if not all(x.matches(y) for x, y in zip(rule.pattern,
+                        matched)):
+                    continue
+                replacement = rule.rewrite(matched)
+                if replacement is None:
+                    continue
+                ret[-count:] = replacement
+                state, changed = self._start, True
+                timing.count('class.peephole_rewrites')
+                break
+        return ret if changed else instructions
+
+    def apply_class(self, classfile):
+        """Applies the rules to the Code of every method of a ClassFile,
+        returns the number of methods that changed."""
+        count = 0
+        for x in classfile.root.MethodInfo:
+            for y in x.AttributeInfo:
+                if y.attribute_name.value != 'Code':
+                    continue
+                instructions = self.apply(y.instructions)
+                if instructions is not y.instructions:
+                    y.instructions = instructions
+                    count += 1
+        return count
@@ -0,0 +1,308 @@
+"""Command line interface to sbi.
+
+    python sbi.py batch [-j workers] [-t timeout] [-p] [-o out.jsonl]
+        <path>..
+    python sbi.py bench [-s small|large] [-r repeat] [-o bench.jsonl]
+    python sbi.py export [-f jsonl|csv] [-n] [-o out] <path>..
+
+Each argument is either a directory, which is walked recursively, a sample,
+or @ followed by a file listing one sample per line ("-" for stdin).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import select
+import signal
+import sys
+import time
+
+import bench
+import dex
+import export
+import java
+import timing
+
+class Timeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise Timeout()
+
+def _summarize_dex(fname):
+    with dex.DexFile.open(fname) as d:
+        return {
+            'type': 'dex',
+            'classes': len(d.root.class_def_item),
+            'methods': len(d.root.method_id_item),
+            'fields': len(d.root.field_id_item),
+            'strings': len(d.root.string_id_item),
+        }
+
+def _summarize_class(fname):
+    c = java.ClassFile(open(fname, 'rb').read())
+    return {
+        'type': 'class',
+        'class': c.root.this_class.name.value,
+        'classes': 1,
+        'methods': len(c.root.MethodInfo),
+        'fields': len(c.root.FieldInfo),
+        'strings': sum(1 for x in c.root.ConstantPoolInfo
+            if x.tag == 'CONSTANT_String'),
+    }
+
+def summarize(fname, timeout=None, profile=False):
+    """Parses a single .dex or .class file and returns a summary.
+
+    Any error, including running into the timeout (in seconds), is reported
+    in the summary rather than raised. With profile the time spent in each
+    phase of parsing the file is included as well (see timing.py).
+    """
+    ret, start = {'file': fname}, time.time()
+    if timeout:
+        signal.signal(signal.SIGALRM, _alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    with timing.record() as stats:
+        try:
+            with open(fname, 'rb') as f:
+                magic = f.read(4)
+            if magic == 'dex\n':
+                ret.update(_summarize_dex(fname))
+            elif magic == '\xca\xfe\xba\xbe':
+                ret.update(_summarize_class(fname))
+            else:
+                ret['error'] = 'not a dex or class file'
+        except Timeout:
+            ret['error'] = 'timeout after %ss' % timeout
+        except Exception as e:
+            ret['error'] = '%s: %s' % (e.__class__.__name__, e)
+        finally:
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    ret['duration'] = round(time.time() - start, 6)
+    if profile:
+        ret['profile'] = stats.as_dict()
+    return ret
+
+def _work(conn, timeout, profile):
+    # the loop of a batch worker, summarizing the files it's sent until it
+    # receives None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        fname = conn.recv()
+        if fname is None:
+            break
+        conn.send(summarize(fname, timeout, profile))
+
+class _Worker:
+    # a batch worker process and the sample it's busy with, if any
+    def __init__(self, timeout, profile):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_work,
+            args=(child, timeout, profile))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.fname, self.start, self.count = None, None, 0
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def send(self, fname):
+        self.conn.send(fname)
+        self.fname, self.start = fname, time.time()
+        self.count += 1
+
+    def result(self, error):
+        # the summary of the current sample when the worker didn't report it
+        return {'file': self.fname, 'error': error,
+            'duration': round(time.time() - self.start, 6)}
+
+    def stop(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except (IOError, OSError):
+                pass
+            self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+def samples(paths):
+    """Yields all samples from the given directories, files and file lists,
+    the latter being "-" (stdin) or @ followed by the name of the list."""
+    for path in paths:
+        if path == '-' or path.startswith('@'):
+            f = sys.stdin if path == '-' else open(path[1:])
+            try:
+                for line in f:
+                    if line.strip():
+                        yield line.strip()
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fname in sorted(files):
+                    yield os.path.join(root, fname)
+        else:
+            yield path
+
+# seconds a worker gets on top of the timeout before it's killed, i.e.,
+# when the timer in summarize() can't interrupt it (e.g., in C code)
+GRACE = 5
+
+def batch(paths, out, workers=None, timeout=60, profile=False,
+        maxtasks=256):
+    """Summarizes all samples over a number of worker processes.
+
+    Summaries are written to out as JSON lines in the order they complete.
+    Workers which don't report back within the timeout (plus GRACE seconds)
+    are killed, as are workers which die (e.g., crash or are killed for
+    running out of memory), and the sample is reported as having timed out
+    or crashed. Workers are also recycled every maxtasks samples so a single
+    pathological sample can't hog memory for the rest of the run.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    fnames, running = samples(paths), []
+
+    def write(ret):
+        out.write(json.dumps(ret) + '\n')
+        out.flush()
+
+    try:
+        while True:
+            # hand out samples to idle workers, starting workers as needed
+            idle = [x for x in running if x.fname is None]
+            while fnames is not None and (idle or len(running) < workers):
+                fname = next(fnames, None)
+                if fname is None:
+                    fnames = None
+                    break
+                if idle:
+                    worker = idle.pop()
+                else:
+                    worker = _Worker(timeout, profile)
+                    running.append(worker)
+                worker.send(fname)
+
+            busy = [x for x in running if x.fname is not None]
+            if not busy:
+                break
+
+            wait = None
+            if timeout:
+                deadline = min(x.start for x in busy) + timeout + GRACE
+                wait = max(deadline - time.time(), 0)
+            ready = select.select(busy, [], [], wait)[0]
+
+            for worker in busy:
+                if worker in ready:
+                    try:
+                        ret = worker.conn.recv()
+                    except (EOFError, IOError):
+                        worker.process.join()
+                        ret = worker.result('worker died (exit code %s)' %
+                            worker.process.exitcode)
+                elif timeout and time.time() >= worker.start + timeout + \
+                        GRACE:
+                    ret = worker.result('timeout after %ss' % timeout)
+                    worker.kill()
+                else:
+                    continue
+
+                write(ret)
+                worker.fname = None
+                if not worker.process.is_alive() or \
+                        worker.count >= maxtasks:
+                    worker.stop()
+                    running.remove(worker)
+    finally:
+        for worker in running:
+            worker.kill()
+
+def export_all(paths, writer, instructions=True):
+    """Exports all samples one after another, see export.py."""
+    for fname in samples(paths):
+        with open(fname, 'rb') as f:
+            magic = f.read(4)
+        if magic == 'dex\n':
+            with dex.DexFile.open(fname) as d:
+                export.export(d, writer, fname, instructions)
+        elif magic == '\xca\xfe\xba\xbe':
+            export.export(open(fname, 'rb').read(), writer, fname,
+                instructions)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='sbi')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('batch', help='summarize many dex/class files')
+    p.add_argument('paths', nargs='+', metavar='path')
+    p.add_argument('-j', '--workers', type=int, default=None,
+        help='number of worker processes (default: cpu count)')
+    p.add_argument('-t', '--timeout', type=float, default=60,
+        help='timeout per file in seconds, 0 to disable (default: 60)')
+    p.add_argument('-p', '--profile', action='store_true',
+        help='include the time spent in each phase per file')
+    p.add_argument('-o', '--output', default='-',
+        help='JSONL output file (default: stdout)')
+
+    p = commands.add_parser('bench', help='benchmark the parsing phases')
+    p.add_argument('-s', '--size', choices=sorted(bench.SIZES),
+        default='small', help='size of the synthetic inputs (default: small)')
+    p.add_argument('-r', '--repeat', type=int, default=3,
+        help='number of runs per phase, the fastest one counts (default: 3)')
+    p.add_argument('-o', '--output', default='bench.jsonl',
+        help='JSONL file to compare against and append the results to '
+        '(default: bench.jsonl)')
+
+    p = export_parser = commands.add_parser('export', help='export the '
+        'classes, fields, methods, strings and instructions of dex/class '
+        'files')
+    p.add_argument('paths', nargs='+', metavar='path')
+    p.add_argument('-f', '--format', choices=('jsonl', 'csv'),
+        default='jsonl', help='JSON lines or a CSV file per table '
+        '(default: jsonl)')
+    p.add_argument('-n', '--no-instructions', action='store_true',
+        help='leave out the instructions')
+    p.add_argument('-o', '--output', default='-',
+        help='JSONL output file (default: stdout) or the directory for the '
+        'CSV files (required for csv)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'batch':
+        out = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            batch(args.paths, out, args.workers, args.timeout, args.profile)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    elif args.command == 'bench':
+        results = bench.run(args.size, args.repeat)
+        bench.report(results, sys.stdout, args.size, args.repeat,
+            args.output)
+    elif args.command == 'export':
+        if args.format == 'csv':
+            if args.output == '-':
+                export_parser.error('-f csv requires an output directory '
+                    '(-o)')
+            if not os.path.isdir(args.output):
+                os.makedirs(args.output)
+            writer = export.CsvWriter(args.output)
+        else:
+            writer = export.JsonlWriter(sys.stdout if args.output == '-'
+                else open(args.output, 'w'))
+        try:
+            export_all(args.paths, writer, not args.no_instructions)
+        finally:
+            writer.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,74 @@
+"""Tests of cache.py.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import bench
+import cache
+import dex
+import java
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = cache.ParseCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _entries(self):
+        return [x for _, x, _ in self.cache._entries()]
+
+    def test_class(self):
+        data = bench.class_file(methods=5)
+        first = self.cache.classfile(data)
+        self.assertEqual(len(self._entries()), 1)
+        self.assertEqual(str(first), str(java.ClassFile(data)))
+
+        c = self.cache.classfile(data)
+        self.assertEqual(str(c), str(first))
+        self.assertEqual(c.build0(), data)
+        self.assertEqual(bench._modified(data).build0(),
+            self._modified(c).build0())
+        self.assertEqual(c.root.ConstantPoolInfo.find_or_add_utf8('Code'),
+            first.root.ConstantPoolInfo.find('CONSTANT_Utf8', u'Code'))
+
+    def _modified(self, c):
+        for y in bench._code_attributes(c):
+            y.instructions.append(y.instructions[-1])
+        return c
+
+    def test_dex(self):
+        data = bench.dex_file()
+        first = self.cache.dexfile(data)
+        self.assertEqual(str(first), str(dex.DexFile(data)))
+
+        d = self.cache.dexfile(data)
+        self.assertEqual(str(d), str(first))
+        self.assertEqual(d.build0(), data)
+        code = d.root.class_def_item[0].class_data_item.direct_methods[0] \
+            .code_item
+        self.assertEqual(code.instructions[0].ref, 's000000')
+        self.assertEqual(d.root.data.value, first.root.data.value)
+
+    def test_invalid(self):
+        data = bench.class_file(methods=5)
+        expected = str(self.cache.classfile(data))
+        fname, = self._entries()
+        for content in ('', 'SBIC', 'SBIC\x00\x00\x00\x00garbage',
+                open(fname, 'rb').read()[:-10], 'x' * 100):
+            with open(fname, 'wb') as f:
+                f.write(content)
+            self.assertEqual(str(self.cache.classfile(data)), expected)
+
+    def test_evict(self):
+        self.cache.max_size = 1
+        self.cache.classfile(bench.class_file(methods=5))
+        self.assertEqual(self._entries(), [])
+
+if __name__ == '__main__':
+    unittest.main()
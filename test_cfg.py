@@ -0,0 +1,91 @@
+"""Tests of cfg.py, on the synthetic files of bench.py.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+import unittest
+
+import bench
+import cfg
+import dex
+import java
+
+class TestJava(unittest.TestCase):
+    def setUp(self):
+        self.c = java.ClassFile(bench.class_file(methods=3))
+        self.method = self.c.root.MethodInfo[0]
+        self.code, = [y for y in self.method.AttributeInfo
+            if y.attribute_name.value == 'Code']
+
+    def test_blocks(self):
+        # iconst_0, ifeq, goto and the rest of the method, the handler of
+        # which is its last instruction
+        g = cfg.method_cfg(self.c, self.method)
+        self.assertEqual(list(g.offsets), [0, 4, 7, 29, 30])
+        self.assertEqual(list(g.successors(0)), [1, 2])
+        self.assertEqual(list(g.successors(1)), [2])
+        self.assertEqual(list(g.successors(2)), [3])
+        self.assertEqual(list(g.handlers(2)), [3])
+        self.assertEqual(list(g.order()), [0, 1, 2, 3])
+        self.assertEqual(list(g.dominators()), [0, 0, 0, 2])
+        self.assertTrue(g.dominates(0, 3))
+        self.assertFalse(g.dominates(1, 2))
+        self.assertEqual(g.block_at(5), 1)
+
+    def test_labels(self):
+        g = cfg.method_cfg(self.c, self.method)
+        instructions, table = java.label(self.code.instructions,
+            self.code.exception_table)
+        h = cfg.java_cfg(instructions, table)
+        self.assertEqual([list(g.successors(x)) for x in xrange(len(g))],
+            [list(h.successors(x)) for x in xrange(len(h))])
+
+    def test_cached(self):
+        g = cfg.method_cfg(self.c, self.method)
+        self.assertIs(cfg.method_cfg(self.c, self.method), g)
+
+        # altered through the Instructions
+        self.code.instructions.append(self.code.instructions[-1])
+        h = cfg.method_cfg(self.c, self.method)
+        self.assertIsNot(h, g)
+        self.assertIs(cfg.method_cfg(self.c, self.method), h)
+
+        # replaced
+        self.code.instructions = list(self.code.instructions)[:-1]
+        self.assertIsNot(cfg.method_cfg(self.c, self.method), h)
+
+        g = cfg.method_cfg(self.c, self.method)
+        cfg.invalidate(self.c, self.method)
+        self.assertIsNot(cfg.method_cfg(self.c, self.method), g)
+
+class TestDex(unittest.TestCase):
+    def test_cached(self):
+        d = dex.DexFile(bench.dex_file())
+        for x in d.root.class_def_item:
+            method = x.class_data_item.direct_methods[0]
+            g = cfg.method_cfg(d, method)
+            self.assertEqual(list(g.order()), range(len(g)))
+            self.assertIs(cfg.method_cfg(d, method), g)
+
+        instructions = method.code_item.instructions
+        del instructions[0]
+        self.assertIsNot(cfg.method_cfg(d, method), g)
+
+    def test_tries(self):
+        d = dex.DexFile(bench.dex_file(tries=True))
+        method = d.root.class_def_item[0].class_data_item.direct_methods[0]
+        g = cfg.method_cfg(d, method)
+        # (the handler, the last block, is covered by the try as well)
+        self.assertEqual([list(g.handlers(x)) for x in xrange(len(g))],
+            [[len(g) - 1]] * len(g))
+
+        # the tries still hold for code of the same length
+        instructions = method.code_item.instructions
+        instructions[-2] = dex.DalvikInstruction(0x12, [0, 1])
+        self.assertIsNot(cfg.method_cfg(d, method), g)
+
+        # but no longer once the code moved
+        instructions.insert(0, dex.DalvikInstruction(0))
+        self.assertRaises(Exception, cfg.method_cfg, d, method)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,363 @@
+"""Tests of dex.py, on the synthetic dex files of bench.py.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+from array import array
+import hashlib
+import os
+import random
+import struct
+import tempfile
+import unittest
+import zlib
+
+import bench
+import dex
+
+def _string_pool(strings, padding=''):
+    # a StringPool of the given strings, separated by padding
+    data, offsets = 'x', array('I')
+    for x in strings:
+        offsets.append(len(data))
+        data += dex._uleb128x(len(x)) + x + '\x00' + padding
+    return dex.StringPool(data, offsets)
+
+class TestLEB128(unittest.TestCase):
+    values = [0, 1, 63, 64, 127, 128, 300, 16383, 16384, 2**21, 2**28,
+        2**32 - 1]
+
+    def test_uleb128(self):
+        for x in self.values:
+            data = bytearray(dex._uleb128x(x))
+            self.assertEqual(dex._uleb128(data), (len(data), x))
+            self.assertEqual(dex._uleb128p1(bytearray(dex._uleb128p1x(
+                x - 1))), (len(dex._uleb128p1x(x - 1)), x - 1))
+        self.assertEqual(len(dex._uleb128x(2**32 - 1)), 5)
+        self.assertRaises(Exception, dex._uleb128, bytearray('\x80\x80'))
+        self.assertRaises(Exception, dex._uleb128, bytearray('\xff' * 5))
+
+    def test_sleb128(self):
+        for x in self.values[:-1] + [-1, -64, -65, -128, -2**31]:
+            data = bytearray(dex._sleb128x(x))
+            self.assertEqual(dex._sleb128(data), (len(data), x))
+
+    def test_array(self):
+        data = 'xx' + ''.join(map(dex._uleb128x, self.values)) + 'yy'
+        values, end = dex.uleb128_array(data, 2, len(self.values))
+        self.assertEqual(values.tolist(), self.values)
+        self.assertEqual(end, len(data) - 2)
+
+    def test_truncated(self):
+        data = ''.join(map(dex._uleb128x, self.values))
+        self.assertRaises(dex.FieldError, dex.uleb128_array, data, 0,
+            len(self.values) + 1)
+        self.assertRaises(dex.FieldError, dex.uleb128_array, data[:-1], 0,
+            len(self.values))
+        self.assertRaises(dex.FieldError, dex.uleb128_array, 'xx', 2, 1)
+        self.assertRaises(dex.FieldError, dex.ULEB128('x').parse, '\x80')
+        self.assertRaises(dex.FieldError, dex.ULEB128('x').parse, '')
+
+    def test_construct(self):
+        for x in self.values:
+            self.assertEqual(dex.ULEB128('x').parse(dex._uleb128x(x) +
+                'trailing'), x)
+            self.assertEqual(dex.ULEB128('x').build(x), dex._uleb128x(x))
+
+class TestStringPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = _string_pool(['fooA', 'bar', 'fooB', 'xyz'])
+
+    def test_getitem(self):
+        self.assertEqual(list(self.pool), ['fooA', 'bar', 'fooB', 'xyz'])
+        self.assertEqual(self.pool[1:3], ['bar', 'fooB'])
+
+    def test_find(self):
+        self.assertEqual(self.pool.find('foo'), [0, 2])
+        self.assertEqual(self.pool.find('o'), [0, 2])
+        self.assertEqual(self.pool.find('Abar'), [])
+        self.assertEqual(self.pool.find('qux'), [])
+        self.assertEqual(self.pool.find('\x04'), [])
+
+    def test_search(self):
+        self.assertEqual(self.pool.search('foo.*'), [0, 2])
+        self.assertEqual(self.pool.search('^...$'), [1, 3])
+        self.assertEqual(self.pool.search('B$'), [2])
+        self.assertEqual(self.pool.search('^o'), [])
+        self.assertEqual(self.pool.search('A.*b'), [])
+
+    def test_padding(self):
+        pool = _string_pool(['ab', 'cd'], padding='zz\x00')
+        self.assertEqual(pool.find('z'), [])
+        self.assertEqual(pool.find('c'), [1])
+        self.assertEqual(pool.search('z'), [])
+
+class TestClassData(unittest.TestCase):
+    def test_decode(self):
+        # 1 static field, 2 instance fields, 1 direct method and 2 virtual
+        # methods, of which the indices restart at the instance fields and
+        # virtual methods
+        values = [1, 2, 1, 2, 5, 8, 3, 1, 4, 2, 300, 1, 0x10001, 200000,
+            7, 1, 2, 1, 99]
+        data = 'xx' + ''.join(dex._uleb128x(x) for x in values) + 'yy'
+        x = dex.ClassData(data, 2)
+        self.assertEqual(x.end, len(data) - 2)
+        self.assertEqual(list(x.fields()), [(5, 8), (3, 1), (7, 2)])
+        self.assertEqual(list(x.methods()), [(300, 1, 0x10001),
+            (200000, 7, 1), (200002, 1, 99)])
+
+def _signed(data):
+    # whether the checksum and signature of a dex file are valid
+    return data[12:32] == hashlib.sha1(data[32:]).digest() and \
+        struct.unpack('<I', data[8:12])[0] == zlib.adler32(data[12:]) & \
+        0xffffffff
+
+class TestDexFile(unittest.TestCase):
+    # see bench.dex_file()
+    classes, methods, fields, strings, blocks = 3, 4, 2, 10, 2
+
+    def setUp(self):
+        self.data = bench.dex_file(self.classes, self.methods, self.fields,
+            self.strings, self.blocks)
+
+    def test_id_tables(self):
+        for lazy in (False, True):
+            d = dex.DexFile(self.data, lazy=lazy)
+            header = d.root.header
+            methods = d.root.method_id_item
+            self.assertEqual(len(methods), self.classes * self.methods)
+            for idx, x in enumerate(methods):
+                self.assertEqual((x.class_idx, x.proto_idx, x.name_idx),
+                    struct.unpack_from('<2HI', self.data,
+                    header.method_ids_off + idx * 8))
+            self.assertEqual(methods[-1].name, 'm%05d' % (self.methods - 1))
+            self.assertEqual(str(methods[1].proto.descriptor), '(I)V')
+            self.assertRaises(IndexError, methods.__getitem__, len(methods))
+            self.assertEqual(d.root.field_id_item[0].type_, 'I')
+            self.assertEqual(list(d.root.type_id_item), ['I'] +
+                ['Lcom/bench/C%05d;' % x for x in xrange(self.classes)] +
+                ['Ljava/lang/Object;', 'V'])
+
+    def test_id_items(self):
+        d = dex.DexFile(self.data, lazy=True)
+        methods = d.root.method_id_item
+        x = methods[1]
+        self.assertIs(methods[1], x)
+        self.assertIs(methods[-len(methods) + 1], x)
+        self.assertIs(x.proto, d.root.proto_id_item[x.proto_idx])
+        methods[1].name = 'renamed'
+        self.assertEqual(methods[1].name, 'renamed')
+        self.assertEqual([y.name for y in methods][1], 'renamed')
+        self.assertEqual(methods.name_idx[1], x.name_idx)
+
+    def test_copy(self):
+        d = dex.DexFile(self.data, lazy=True)
+        x = d.root.class_def_item[0]
+        y = x.copy()
+        self.assertEqual(y.class_idx, x.class_idx)
+        self.assertEqual(y.class_, x.class_)
+        self.assertEqual(y.class_data_item.direct_methods[0].code_off,
+            x.class_data_item.direct_methods[0].code_off)
+        self.assertIsNone(y.static_values)
+        self.assertNotIn('static_values', x)
+        y.class_idx = 0
+        self.assertNotEqual(x.class_idx, 0)
+
+    def test_xrefs(self):
+        d = dex.DexFile(self.data, lazy=True)
+        xrefs, count = d.xrefs(), self.classes * self.methods
+        strings = d.root.string_id_item
+        expected = {'string': {}, 'field': {}, 'method': {}}
+        for x in xrange(count):
+            for y in xrange(self.blocks):
+                pc = y * 7
+                expected['string'].setdefault(strings.find('s%06d' % ((x + y)
+                    % self.strings))[0], []).append((x, pc))
+                expected['field'].setdefault((x + y) % (self.classes *
+                    self.fields), []).append((x, pc + 2))
+                expected['method'].setdefault((x + y) % count,
+                    []).append((x, pc + 4))
+        for kind, refs in expected.items():
+            for idx, locations in refs.items():
+                self.assertEqual(sorted(xrefs.refs(kind, idx)),
+                    sorted(locations))
+        self.assertEqual(xrefs.refs('type', 0), [])
+
+    def test_disassemble(self):
+        d = dex.DexFile(self.data)
+        code = d.root.class_def_item[0].class_data_item.direct_methods[0] \
+            .code_item
+        self.assertEqual([x.mnemonic for x in code.instructions],
+            ['const-string', 'sget', 'invoke-static'] * self.blocks +
+            ['if-eqz', 'const/4', 'return-void'])
+        self.assertEqual(code.instructions[0].ref, 's000000')
+        self.assertEqual(dex.assemble(code.instructions), code.insns)
+
+    def test_round_trip(self):
+        # every opcode, decoded from random code units, encodes to code
+        # units which decode to the same operands again
+        rnd = random.Random(1)
+        for op in xrange(1, 256):
+            length = dex._insn_info[op][0]
+            for _ in xrange(20):
+                insns = [op | rnd.randrange(256) << 8] + \
+                    [rnd.randrange(0x10000) for _ in xrange(length - 1)]
+                x, = dex.disassemble(insns)
+                y, = dex.disassemble(x.units)
+                self.assertEqual((x.op, x.operands), (y.op, y.operands))
+                self.assertEqual(y.units, x.units)
+
+    def test_high16(self):
+        # const/high16 v1, 0x12340000, const/high16 v0, 0x80000000 and
+        # const-wide/high16 v2, 0x8000000000000000
+        insns = [0x0115, 0x1234, 0x0015, 0x8000, 0x0219, 0x8000]
+        x = dex.disassemble(insns)
+        self.assertEqual([y.operands for y in x], [[1, 0x12340000],
+            [0, -0x80000000], [2, -2**63]])
+        self.assertEqual(str(x[0]), 'const/high16 v1, #305397760')
+        self.assertEqual(dex.assemble(x).tolist(), insns)
+        x[0].operands[1] = -0x10000
+        self.assertEqual(x[0].units, [0x0115, 0xffff])
+
+    def test_payloads(self):
+        # a packed-switch, sparse-switch and fill-array-data payload
+        insns = [0x0100, 2, 0, 0, 4, 0, 6, 0, 0x0200, 1, 5, 0, 7, 0,
+            0x0300, 1, 3, 0, 0x0201, 0x0003, 0x000e]
+        x = dex.disassemble(insns)
+        self.assertEqual([y.mnemonic for y in x], ['packed-switch-payload',
+            'sparse-switch-payload', 'fill-array-data-payload',
+            'return-void'])
+        self.assertEqual(dex.assemble(x).tolist(), insns)
+
+    def test_build_unchanged(self):
+        for lazy in (False, True):
+            self.assertEqual(dex.DexFile(self.data, lazy=lazy).build0(),
+                self.data)
+
+    def _code_items(self, d):
+        for x in d.root.class_def_item:
+            for y in x.class_data_item.direct_methods:
+                yield y.code_item
+
+    def test_build_patched(self):
+        # same size, patched in place
+        d = dex.DexFile(self.data)
+        for x in self._code_items(d):
+            x.instructions[-2].operands[1] = 5
+        data = d.build0()
+        self.assertEqual(len(data), len(self.data))
+        self.assertTrue(_signed(data))
+        for x in self._code_items(dex.DexFile(data)):
+            self.assertEqual(x.instructions[-2].operands[1], 5)
+
+    def test_build_resized(self):
+        # larger code items, the data section is laid out again
+        d = dex.DexFile(self.data)
+        for x in self._code_items(d):
+            x.instructions.insert(0, dex.DalvikInstruction(0))
+        data = d.build0()
+        self.assertTrue(_signed(data))
+        e = dex.DexFile(data)
+        self.assertEqual(e.root.header.file_size, len(data))
+        for x, y in zip(self._code_items(d), self._code_items(e)):
+            self.assertEqual(map(str, x.instructions),
+                map(str, y.instructions))
+        self.assertEqual(list(e.root.string_id_item),
+            list(d.root.string_id_item))
+        self.assertEqual(e.build0(), data)
+
+    def test_build_tries(self):
+        data = bench.dex_file(tries=True)
+        d = dex.DexFile(data)
+        for x in self._code_items(d):
+            x.instructions[-2].operands[1] = 5
+        patched = d.build0()
+        self.assertTrue(_signed(patched))
+        self.assertEqual(len(patched), len(data))
+        self.assertEqual(dex.DexFile(patched).build0(), patched)
+
+        # resized code items would keep their tries as they are
+        x = next(self._code_items(d))
+        x.instructions.insert(0, dex.DalvikInstruction(0))
+        self.assertRaises(Exception, d.build0)
+
+    def test_build_debug_info(self):
+        # (any offset the layout knows of, there's no debug_info_item)
+        d = dex.DexFile(self.data)
+        code_off = d.root.class_def_item[0].class_data_item \
+            .direct_methods[0].code_off
+        data = bytearray(self.data)
+        struct.pack_into('<I', data, code_off + 8,
+            d.root.string_id_item.offsets[0])
+        d = dex.DexFile(str(data))
+        x = next(self._code_items(d))
+        x.instructions.insert(0, dex.DalvikInstruction(0))
+        self.assertRaises(Exception, d.build0)
+
+def _value(typ, arg, payload=''):
+    return chr(arg << 5 | typ) + payload
+
+class TestAnnotations(unittest.TestCase):
+    def test_encoded_value(self):
+        for data, expected in (
+                (_value(0x00, 0, '\xff'), -1),
+                (_value(0x02, 1, '\x00\x80'), -32768),
+                (_value(0x03, 1, '\xff\xff'), 0xffff),
+                (_value(0x04, 0, '\x80'), -128),
+                (_value(0x04, 3, '\xff\xff\xff\x7f'), 0x7fffffff),
+                (_value(0x06, 7, '\xff' * 8), -1),
+                (_value(0x10, 1, '\x80\x3f'), 1.0),
+                (_value(0x11, 1, '\x04\x40'), 2.5),
+                (_value(0x1e, 0), None),
+                (_value(0x1f, 1), True),
+                (_value(0x1f, 0), False)):
+            x, end = dex._encoded_value(data + 'x', 0)
+            self.assertEqual(end, len(data))
+            self.assertEqual(x.value, expected)
+
+        x, end = dex._encoded_value(_value(0x17, 1, '\x34\x12'), 0)
+        self.assertEqual((x.value_type, x.index, end),
+            ('VALUE_STRING', 0x1234, 3))
+        self.assertRaises(Exception, dex._encoded_value, '\x05', 0)
+
+    def test_nested(self):
+        # an annotation of type 3 with an array of a byte and an annotation
+        inner = dex._uleb128x(4) + dex._uleb128x(0)
+        array_ = dex._uleb128x(2) + _value(0x00, 0, '\x07') + \
+            _value(0x1d, 0, inner)
+        item = '\x01' + dex._uleb128x(3) + dex._uleb128x(1) + \
+            dex._uleb128x(9) + _value(0x1c, 0, array_)
+        x, end = dex._annotation_item(item, 0)
+        self.assertEqual(end, len(item))
+        self.assertEqual(x.visibility, 'VISIBILITY_RUNTIME')
+        annotation = x.encoded_annotation
+        self.assertEqual((annotation.type_idx, annotation.size), (3, 1))
+        element = annotation.elements[0]
+        self.assertEqual(element.name_idx, 9)
+        values = element.value['values']
+        self.assertEqual(values[0].value, 7)
+        self.assertEqual((values[1].type_idx, values[1].elements), (4, []))
+
+    def test_annotation_set(self):
+        item = '\x02' + dex._uleb128x(5) + dex._uleb128x(0)
+        data = struct.pack('<2I', 1, 8) + item
+        x, end = dex._annotation_set_item(data, 0)
+        self.assertEqual(end, 8)
+        self.assertEqual(x.annotation_off_item[0].annotation_item.visibility,
+            'VISIBILITY_SYSTEM')
+
+class TestOpen(unittest.TestCase):
+    def test_close(self):
+        fd, fname = tempfile.mkstemp(suffix='.dex')
+        try:
+            os.write(fd, bench.dex_file())
+            os.close(fd)
+            with dex.DexFile.open(fname) as d:
+                self.assertEqual(len(d.root.class_def_item), 4)
+                data = d.data
+            # (an unmapped mmap raises ValueError on any access)
+            self.assertRaises(ValueError, data.size)
+        finally:
+            os.unlink(fname)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+"""Tests of java.py, on the synthetic class files of bench.py.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+from pyasm2 import java as _java
+import os
+import struct
+import tempfile
+import unittest
+
+import bench
+import java
+
+def _code_attributes(c):
+    return list(bench._code_attributes(c))
+
+class TestBuild(unittest.TestCase):
+    def setUp(self):
+        self.data = bench.class_file(methods=3)
+
+    def test_unchanged(self):
+        c = java.ClassFile(self.data)
+        self.assertEqual(c.build0(), self.data)
+        for y in _code_attributes(c):
+            list(y.instructions)
+        self.assertEqual(c.build0(), self.data)
+
+    def test_build_twice(self):
+        c = bench._modified(self.data)
+        first = c.build0()
+        self.assertNotEqual(first, self.data)
+        self.assertEqual(c.build0(), first)
+
+    def test_modified(self):
+        c = bench._modified(self.data)
+        d = java.ClassFile(c.build0())
+        for x, y in zip(_code_attributes(c), _code_attributes(d)):
+            self.assertEqual(map(str, x.instructions),
+                map(str, y.instructions))
+
+    def test_exception_table(self):
+        c = java.ClassFile(self.data)
+        y = _code_attributes(c)[0]
+        y.exception_table.append(java._exception((0, 1, 1, 0)))
+        data = c.build0()
+        self.assertNotEqual(data, self.data)
+        self.assertEqual(c.build0(), data)
+        self.assertEqual(len(_code_attributes(java.ClassFile(data))[0]
+            .attribute.exception_table), 2)
+
+        # undoing the change restores the original method
+        del y.exception_table[-1]
+        self.assertEqual(c.build0(), self.data)
+
+_nop, _return = _java.disassemble('\x00', 0), _java.disassemble('\xb1', 0)
+
+class TestAssemble(unittest.TestCase):
+    def test_label_round_trip(self):
+        c = java.ClassFile(bench.class_file(methods=3))
+        for y in _code_attributes(c):
+            instructions, table = java.label(y.instructions,
+                y.exception_table)
+            self.assertTrue(any(x.__class__ is java.Label
+                for x in instructions))
+            self.assertTrue(all(x.start_pc.__class__ is java.Label
+                for x in table))
+            code, table = java.assemble(instructions, table)
+            self.assertEqual(code, y.attribute.code)
+            self.assertTrue(java._unchanged(table,
+                y.attribute.exception_table))
+
+    def test_unloaded(self):
+        c = java.ClassFile(bench.class_file(methods=1))
+        y, = _code_attributes(c)
+        self.assertEqual(java.assemble(y.instructions, y.exception_table),
+            (y.attribute.code, y.exception_table))
+        self.assertFalse(y.instructions.loaded)
+
+    def test_short(self):
+        target = java.Label()
+        code, _ = java.assemble([java.Branch('goto', target), _nop, target,
+            _return])
+        self.assertEqual(code, '\xa7\x00\x04\x00\xb1')
+
+    def test_widen(self):
+        target, back = java.Label('far'), java.Label('back')
+        filler = [_nop] * 0x8000
+        table = [java._exception((back, target, target, 0))]
+        code, table = java.assemble([back, java.Branch('ifeq', target),
+            java.Branch('goto', target)] + filler + [target, _return,
+            java.Branch('goto', back)], table)
+
+        # ifne +8, goto_w far, goto_w far, the nops, return, goto_w back
+        far = 8 + 5 + 0x8000
+        self.assertEqual(code[:13], struct.pack('>BhBiBi', 0x9a, 8, 0xc8,
+            far - 3, 0xc8, far - 8))
+        self.assertEqual(code[far:], struct.pack('>BBi', 0xb1, 0xc8,
+            -far - 1))
+        self.assertEqual((table[0].start_pc, table[0].end_pc), (0, far))
+
+    def test_switch(self):
+        for pad in xrange(4):
+            default, one = java.Label('default'), java.Label('one')
+            code, _ = java.assemble([_nop] * pad + [java.Switch(
+                'tableswitch', default, [one], low=5), one, _nop, default,
+                _return])
+            start = pad + 1 + (3 - pad) % 4
+            self.assertEqual(start % 4, 0)
+            self.assertEqual(code[:start], '\x00' * pad + '\xaa' +
+                '\x00' * (start - pad - 1))
+            end = start + 16
+            self.assertEqual(struct.unpack('>4i', code[start:end]),
+                (end + 1 - pad, 5, 5, end - pad))
+            self.assertEqual(code[end:], '\x00\xb1')
+
+    def test_unknown_label(self):
+        self.assertRaises(Exception, java.assemble, [java.Branch('goto',
+            java.Label())])
+
+class TestDescriptor(unittest.TestCase):
+    def test_parse(self):
+        d = java.Descriptor('(I[JLjava/lang/String;)[Z')
+        self.assertEqual(d.params, ['I', '[J', 'Ljava/lang/String;'])
+        self.assertEqual(d.params[2].clazz, 'java/lang/String')
+        self.assertEqual(d.ret, '[Z')
+        self.assertEqual(d.shorty, 'LILL')
+        self.assertEqual(str(d), '(I[JLjava/lang/String;)[Z')
+        self.assertEqual(repr(d), 'bool[] (int, long[], java/lang/String)')
+        self.assertIs(java.Descriptor('(I[JLjava/lang/String;)[Z'), d)
+        self.assertEqual({d: 1}['(I[JLjava/lang/String;)[Z'], 1)
+        self.assertRaises(Exception, java.Descriptor, '(I')
+        self.assertRaises(Exception, java.Descriptor, 'I')
+
+    def test_replace(self):
+        d = java.Descriptor('(I)V')
+        params = d.params
+        params.append('J')
+        self.assertEqual(d.params, ['I'])
+        self.assertEqual(str(d.replace(params=params)), '(IJ)V')
+        self.assertEqual(str(d.replace(ret='Ljava/lang/Object;')),
+            '(I)Ljava/lang/Object;')
+        self.assertRaises(AttributeError, setattr, d, 'ret', 'I')
+
+class TestConstantPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = java.ClassFile(bench.class_file(methods=3)).root \
+            .ConstantPoolInfo
+
+    def test_find_or_add(self):
+        count = len(self.pool)
+        code = self.pool.find('CONSTANT_Utf8', u'Code')
+        self.assertIsNotNone(code)
+        self.assertEqual(self.pool.find_or_add_utf8('Code'), code)
+        ref = self.pool.find_or_add_methodref('Bench', 'm00001', '(I)V')
+        self.assertEqual(self.pool[ref].tag, 'CONSTANT_Methodref')
+        self.assertEqual(len(self.pool), count)
+
+        slot = self.pool.find_or_add_methodref('Bench', 'new', '()V')
+        self.assertEqual(len(self.pool), count + 4)
+        self.assertEqual(self.pool[slot].name_and_type.name.value, u'new')
+        self.assertEqual(self.pool.find_or_add_methodref('Bench', 'new',
+            '()V'), slot)
+
+        slot = self.pool.find_or_add_long(1 << 40)
+        self.assertEqual(len(self.pool), count + 6)
+        self.assertIsNone(self.pool[slot+1])
+
+    def test_update_duplicate(self):
+        first = self.pool.find_or_add_utf8('dup')
+        second = self.pool.append(java.Container(tag='CONSTANT_Utf8',
+            value=u'dup'))
+        self.assertEqual(self.pool.find('CONSTANT_Utf8', u'dup'), first)
+
+        self.pool.update(first, value=u'other')
+        self.assertEqual(self.pool.find('CONSTANT_Utf8', u'dup'), second)
+        self.assertEqual(self.pool.find_or_add_utf8('dup'), second)
+        self.assertEqual(self.pool.find('CONSTANT_Utf8', u'other'), first)
+
+        # the first one again once it's restored
+        self.pool.update(first, value=u'dup')
+        self.assertEqual(self.pool.find('CONSTANT_Utf8', u'dup'), first)
+        self.pool.update(first, value=u'other')
+        self.pool.update(second, value=u'other')
+        self.assertIsNone(self.pool.find('CONSTANT_Utf8', u'dup'))
+        self.assertEqual(self.pool.find('CONSTANT_Utf8', u'other'), first)
+
+class _Mangler(java.JavaMangler):
+    # duplicates the return of the methods which see the marker in the
+    # constant pool, which the second method adds
+    def mangle(self, name, descriptor, instructions, method_info):
+        pool = self.root.root.ConstantPoolInfo
+        if self.marked(pool):
+            return list(instructions) + [instructions[-1]]
+        if name == 'm00001':
+            self.mark(pool)
+
+class _Descriptors(_Mangler):
+    def marked(self, pool):
+        return pool.find('CONSTANT_Utf8', u'(J)V') is not None
+
+    def mark(self, pool):
+        self.update_descriptor(java.Descriptor('(I)V'),
+            java.Descriptor('(J)V'))
+
+class _Constants(_Mangler):
+    def marked(self, pool):
+        return pool.find('CONSTANT_Utf8', u'marker') is not None
+
+    def mark(self, pool):
+        pool.find_or_add_utf8('marker')
+
+class TestJavaMangler(unittest.TestCase):
+    def setUp(self):
+        self.data = bench.class_file(methods=8)
+        self.fname = tempfile.mktemp(suffix='.class')
+
+    def tearDown(self):
+        if os.path.exists(self.fname):
+            os.unlink(self.fname)
+
+    def _mangled(self, cls, processes):
+        with open(self.fname, 'wb') as f:
+            f.write(self.data)
+        cls.processes = processes
+        try:
+            cls(self.fname)
+        finally:
+            cls.processes = None
+        return open(self.fname, 'rb').read()
+
+    def _compare(self, cls):
+        serial = self._mangled(cls, None)
+        self.assertNotEqual(serial, self.data)
+        self.assertEqual(self._mangled(cls, 2), serial)
+
+    def test_descriptors(self):
+        self._compare(_Descriptors)
+
+    def test_constants(self):
+        self._compare(_Constants)
+
+    def test_independent(self):
+        class _Appending(java.JavaMangler):
+            def mangle(self, name, descriptor, instructions, method_info):
+                return list(instructions) + [instructions[-1]]
+        self._compare(_Appending)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""Tests of peephole.py, the compiled rules against a naive matcher.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+import os
+import random
+import tempfile
+import unittest
+
+import bench
+import java
+import peephole
+from peephole import Ins, Rule
+
+def _naive(rules, instructions):
+    # tries every rule at every instruction, longest first, then in order
+    order = sorted(xrange(len(rules)), key=lambda x: (-len(rules[x].pattern),
+        x))
+    ret, base = [], 0
+    for ins in instructions:
+        ret.append(ins)
+        if not ins.code:
+            base = len(ret)
+            continue
+        for idx in order:
+            rule = rules[idx]
+            count = len(rule.pattern)
+            if len(ret) - base < count:
+                continue
+            matched = ret[-count:]
+            if not all((x.opcodes is None or ord(y.code[0]) in x.opcodes)
+                    and x.matches(y) for x, y in zip(rule.pattern, matched)):
+                continue
+            replacement = rule.rewrite(matched)
+            if replacement is None:
+                continue
+            ret[-count:] = replacement
+            base = len(ret)
+            break
+    return ret
+
+_mnemonics = ['iconst_0', 'ifeq', 'goto', 'ldc_w', 'pop', 'ldc2_w', 'pop2',
+    'invokestatic', 'return']
+
+_cps = [
+    lambda x: x.tag == 'CONSTANT_Long',
+    lambda x: x.tag == 'CONSTANT_String',
+    'Bench.m00001 (I)V',
+    's000002',
+    0.5,
+]
+
+class TestPeephole(unittest.TestCase):
+    def setUp(self):
+        c = java.ClassFile(bench.class_file(methods=4))
+        self.pool = []
+        for y in bench._code_attributes(c):
+            self.pool.extend(y.instructions)
+        self.pool.extend(java.Label() for _ in xrange(4))
+
+    def _ins(self, r):
+        op = r.choice([None, None, r.choice(_mnemonics),
+            r.sample(_mnemonics, 2), r.sample(_mnemonics, 3)])
+        cp = r.choice([None, None, None] + _cps)
+        where = r.choice([None, None, lambda x: x.length > 1])
+        return Ins(op, cp=cp, where=where)
+
+    def _rule(self, r):
+        pattern = [self._ins(r) for _ in xrange(r.randint(1, 3))]
+        replace = r.choice([
+            [],
+            [x for x in r.sample(self.pool, 2) if x.code],
+            lambda x: None,
+            lambda x: x[::-1],
+            lambda x: x[:1],
+        ])
+        return Rule(pattern, replace)
+
+    def test_naive(self):
+        r = random.Random(1)
+        for _ in xrange(200):
+            rules = [self._rule(r) for _ in xrange(r.randint(1, 6))]
+            p = peephole.Peephole(rules)
+            for _ in xrange(10):
+                instructions = [r.choice(self.pool)
+                    for _ in xrange(r.randint(0, 40))]
+                expected = _naive(rules, instructions)
+                ret = p.apply(instructions)
+                self.assertEqual(map(id, ret), map(id, expected))
+
+    def test_labels(self):
+        # ldc_w "s000000", pop
+        ldc, pop, label = self.pool[3], self.pool[4], java.Label()
+        p = peephole.Peephole([Rule([Ins('ldc_w'), Ins('pop')], [])])
+        instructions = [ldc, label, pop]
+        self.assertIs(p.apply(instructions), instructions)
+        self.assertEqual(p.apply([ldc, pop, label]), [label])
+
+    def test_unchanged(self):
+        p = peephole.Peephole([Rule([Ins('nop')], [])])
+        self.assertIs(p.apply(self.pool), self.pool)
+        self.assertRaises(Exception, Rule, [], [])
+        self.assertRaises(Exception, Ins, 'no_such_mnemonic')
+
+class _Mangler(java.JavaMangler):
+    # removes the strings the bench methods load and discard
+    labels = True
+    peephole = peephole.Peephole([Rule([Ins('ldc_w'), Ins('pop')], [])])
+
+    def mangle(self, name, descriptor, instructions, method_info):
+        pass
+
+class TestJavaMangler(unittest.TestCase):
+    def setUp(self):
+        self.fname = tempfile.mktemp(suffix='.class')
+        with open(self.fname, 'wb') as f:
+            f.write(bench.class_file(methods=3))
+
+    def tearDown(self):
+        os.unlink(self.fname)
+
+    def test_labels(self):
+        _Mangler(self.fname)
+        c = java.ClassFile(open(self.fname, 'rb').read())
+        for y in bench._code_attributes(c):
+            self.assertNotIn(0x13, [ord(x.code[0]) for x in y.instructions])
+            # (label() fails on branches to the middle of an instruction)
+            instructions, table = java.label(y.instructions,
+                y.exception_table)
+            self.assertEqual(java.assemble(instructions, table)[0],
+                y.attribute.code)
+
+    def test_without_labels(self):
+        class _Unlabeled(_Mangler):
+            labels = False
+        data = open(self.fname, 'rb').read()
+        self.assertRaises(Exception, _Unlabeled, self.fname)
+        self.assertEqual(open(self.fname, 'rb').read(), data)
+
+if __name__ == '__main__':
+    unittest.main()
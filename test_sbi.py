@@ -0,0 +1,98 @@
+"""Tests of the sbi command line.
+
+    python -m unittest discover -p 'test_*.py'
+"""
+from StringIO import StringIO
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+import bench
+import sbi
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fname = os.path.join(self.path, 'Bench.class')
+        with open(self.fname, 'wb') as f:
+            f.write(bench.class_file(methods=2))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_csv_requires_directory(self):
+        stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+        cwd = os.getcwd()
+        os.chdir(self.path)
+        try:
+            self.assertRaises(SystemExit, sbi.main, ['export', '-f', 'csv',
+                self.fname])
+        finally:
+            os.chdir(cwd)
+            sys.stderr = stderr
+        self.assertFalse(os.path.exists(os.path.join(self.path, '-')))
+
+    def test_csv(self):
+        out = os.path.join(self.path, 'out')
+        sbi.main(['export', '-f', 'csv', '-o', out, self.fname])
+        self.assertTrue(os.listdir(out))
+
+def _summarize_class(fname):
+    # runs in the (forked) workers of TestBatch
+    if fname.endswith('Crash.class'):
+        os._exit(3)
+    if fname.endswith('Hang.class'):
+        # as if stuck in C code, which the timer can't interrupt
+        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+        time.sleep(60)
+    return _original(fname)
+
+_original = sbi._summarize_class
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in ('A', 'Crash', 'Hang', 'B'):
+            with open(os.path.join(self.path, name + '.class'), 'wb') as f:
+                f.write(bench.class_file(methods=2))
+        sbi._summarize_class, self.grace = _summarize_class, sbi.GRACE
+        sbi.GRACE = 0.5
+
+    def tearDown(self):
+        sbi._summarize_class, sbi.GRACE = _original, self.grace
+        shutil.rmtree(self.path)
+
+    def _batch(self, **kwargs):
+        out = StringIO()
+        sbi.batch([self.path], out, timeout=0.5, **kwargs)
+        ret = [json.loads(x) for x in out.getvalue().splitlines()]
+        return dict((os.path.basename(x['file']), x) for x in ret)
+
+    def test_watchdog(self):
+        for kwargs in ({'workers': 2}, {'workers': 1, 'maxtasks': 1}):
+            start = time.time()
+            ret = self._batch(**kwargs)
+            self.assertLess(time.time() - start, 10)
+            self.assertEqual(sorted(ret), ['A.class', 'B.class',
+                'Crash.class', 'Hang.class'])
+            self.assertEqual(ret['A.class']['methods'], 2)
+            self.assertEqual(ret['B.class']['methods'], 2)
+            self.assertEqual(ret['Crash.class']['error'],
+                'worker died (exit code 3)')
+            self.assertEqual(ret['Hang.class']['error'],
+                'timeout after 0.5s')
+
+    def test_samples(self):
+        listing = os.path.join(self.path, 'list')
+        with open(listing, 'w') as f:
+            f.write('a.apk\n\nb\n')
+        self.assertEqual(list(sbi.samples(['x.jar', 'y', 'z.dex',
+            '@' + listing])), ['x.jar', 'y', 'z.dex', 'a.apk', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
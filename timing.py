@@ -0,0 +1,93 @@
+"""Per-phase timing of parsing a file, for finding pathological inputs.
+
+Instrumentation is off by default. Within a record() block the phases of
+DexFile and ClassFile (parsing, resolving, disassembling, ...) are timed as
+named spans and their number of items and bytes are counted, e.g.,
+
+    with timing.record() as stats:
+        ClassFile(data)
+    print stats.to_json()
+
+Spans with the same name are accumulated. Outside of a record() block
+span() and count() do next to nothing.
+"""
+import contextlib
+import json
+import timeit
+
+__all__ = ['Stats', 'record', 'span', 'count']
+
+# the Stats currently being recorded, if any
+_current = None
+
+class Stats:
+    def __init__(self):
+        # name -> [seconds, calls]
+        self.spans = {}
+        # name -> count
+        self.counters = {}
+
+    def as_dict(self):
+        return {
+            'spans': dict((name, {'seconds': round(seconds, 6),
+                'calls': calls}) for name, (seconds, calls) in
+                self.spans.items()),
+            'counters': dict(self.counters),
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def __repr__(self):
+        return '<stats, %d spans, %d counters>' % (len(self.spans),
+            len(self.counters))
+
+class _Span(object):
+    __slots__ = 'stats', 'name', 'start'
+
+    def __init__(self, stats, name):
+        self.stats, self.name = stats, name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, *exc_info):
+        duration = timeit.default_timer() - self.start
+        span = self.stats.spans.get(self.name)
+        if span is None:
+            span = self.stats.spans[self.name] = [0.0, 0]
+        span[0] += duration
+        span[1] += 1
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_span = _NoSpan()
+
+def span(name):
+    """Returns a context manager timing the named phase."""
+    if _current is None:
+        return _no_span
+    return _Span(_current, name)
+
+def count(name, value=1):
+    """Adds value to the named counter."""
+    if _current is not None:
+        _current.counters[name] = _current.counters.get(name, 0) + value
+
+@contextlib.contextmanager
+def record():
+    """Records the spans and counters of the enclosed code into the Stats
+    it yields. Records may be nested, the inner one takes precedence."""
+    global _current
+    previous, _current = _current, Stats()
+    try:
+        yield _current
+    finally:
+        _current = previous